@@ -0,0 +1,109 @@
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Tuple
+import glob
+import gzip
+import json
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+class ResponseArchive:
+    """Append-only archive of raw product API responses.
+
+    Responses are written as gzip JSONL segments in `archive_dir`. Each record
+    is its own gzip member, so a segment is still one valid gzip stream, and a
+    sidecar `.idx` file stores `product_code, offset, length` for every record,
+    which lets a single response be read back without decompressing the whole
+    segment. Every writer starts a new segment, so a crash mid-write can only
+    truncate the tail of that run's last segment.
+
+    Args:
+        archive_dir (str): directory holding the segments
+        segment_bytes (int): compressed size after which a new segment is started
+        writer_id (str): suffix for segment names, lets several processes archive to one directory
+    """
+    def __init__(self, archive_dir: str, segment_bytes: int = SEGMENT_BYTES, writer_id: str = None):
+        self.archive_dir = archive_dir
+        self.writer_id = writer_id
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.segment = None
+        self.index = None
+        self.segment_number = len(self.segments())
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.archive_dir, "responses-*.jsonl.gz")))
+
+    def _open_segment(self):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.segment_number += 1
+        suffix = f"-{self.writer_id}" if self.writer_id else ""
+        path = os.path.join(self.archive_dir, f"responses-{self.segment_number:05d}{suffix}.jsonl.gz")
+        self.segment = open(path, 'ab')
+        self.index = open(path.replace(".jsonl.gz", ".idx"), 'a')
+        logger.info(f"Archiving responses to {path}")
+
+    def write(self, product_code: str, data: Dict):
+        """Appends one response as a compressed JSON line and indexes its offset."""
+        record = json.dumps({
+            'product_code': product_code,
+            'fetched_at': datetime.now(timezone.utc).isoformat(),
+            'data': data
+        }, separators=(',', ':'))
+        member = gzip.compress(record.encode() + b'\n')
+        with self.lock:
+            if self.segment is None or self.segment.tell() >= self.segment_bytes:
+                self.close()
+                self._open_segment()
+            offset = self.segment.tell()
+            self.segment.write(member)
+            self.segment.flush()
+            self.index.write(f"{product_code}\t{offset}\t{len(member)}\n")
+            self.index.flush()
+
+    def read(self, product_code: str) -> Dict:
+        """Returns the most recently archived response for a product, or None."""
+        for path in reversed(self.segments()):
+            index_path = path.replace(".jsonl.gz", ".idx")
+            if not os.path.exists(index_path):
+                continue
+            location = None
+            with open(index_path) as index:
+                for line in index:
+                    code, offset, length = line.rstrip('\n').split('\t')
+                    if code == product_code:
+                        location = (int(offset), int(length))
+            if location:
+                with open(path, 'rb') as segment:
+                    segment.seek(location[0])
+                    return json.loads(gzip.decompress(segment.read(location[1])))['data']
+        return None
+
+    def replay(self) -> Iterator[Tuple[str, Dict]]:
+        """Yields (product_code, response) for every archived response, oldest first."""
+        for product_code, _, data in self.replay_records():
+            yield product_code, data
+
+    def replay_records(self) -> Iterator[Tuple[str, str, Dict]]:
+        """Yields (product_code, fetched_at, response) for every archived response, oldest first.
+        fetched_at is the ISO 8601 UTC time the response was archived."""
+        for path in self.segments():
+            try:
+                with gzip.open(path, 'rt') as segment:
+                    for line in segment:
+                        record = json.loads(line)
+                        yield record['product_code'], record.get('fetched_at'), record['data']
+            except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+                logger.error(f"Truncated archive segment {path}: {e}")
+
+    def close(self):
+        if self.segment:
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+            self.index = None
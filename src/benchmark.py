@@ -0,0 +1,120 @@
+from typing import Dict
+import tempfile
+import argparse
+import os
+import logging
+from db_util import configure_logging, connections
+from driver_util import DriverPool, ChromeDriverFactory
+from metrics import crawl_metrics
+from stub_server import FixtureSite, StubServer, BRAND_LIST_PATH
+from webscraper import (MAX_IN_FLIGHT, REQUESTS_PER_SECOND, BROWSER_POOL_SIZE, PAGES_PER_DRIVER, REPORT_DIR,
+                        ProductScraper, create_tables, crawl_brand_list, crawl_brand_pages, crawl_sitemaps,
+                        get_remaining_product_codes)
+
+logger = logging.getLogger(__name__)
+
+
+def run_benchmark(site: FixtureSite, db_file: str, latency: float = 0.0, jitter: float = 0.0,
+                  error_rate: float = 0.0, discovery: str = 'sitemap', max_in_flight: int = MAX_IN_FLIGHT,
+                  requests_per_second: float = REQUESTS_PER_SECOND, lean_browser: bool = True,
+                  projection: bool = False) -> Dict:
+    """Runs the crawl pipeline against a local StubServer serving `site` and returns the benchmark results.
+
+    Product urls are discovered from the stub's sitemaps, or with discovery='browser' by scrolling its
+    brand pages in Selenium exactly as in a browser crawl, with the lean browser profile unless
+    lean_browser is False.
+
+    Returns:
+        Dict: products per second, p50/p99 product API latency, response bytes and parse time per
+            product and database insert rate
+    """
+    crawl_metrics.reset()
+    create_tables(db_file)
+    with StubServer(site, latency=latency, jitter=jitter, error_rate=error_rate) as server:
+        if discovery == 'browser':
+            driver_factory = ChromeDriverFactory(lean=lean_browser)
+            driver_pool = DriverPool(driver_factory, size=BROWSER_POOL_SIZE, max_pages_per_driver=PAGES_PER_DRIVER)
+            try:
+                brands = crawl_brand_list(db_file, driver_pool, f"{server.url}{BRAND_LIST_PATH}")
+                crawl_brand_pages(db_file, brands, driver_pool, base_url=server.url)
+            finally:
+                driver_pool.close()
+        else:
+            crawl_sitemaps(db_file, base_url=server.url)
+
+        report = ProductScraper.fetch_product_details(
+            db_file, get_remaining_product_codes(db_file), base_url=server.url, max_in_flight=max_in_flight,
+            requests_per_second=requests_per_second, checkpoint=True, projection=projection
+        )
+        stub_requests = server.requests
+
+    stages = crawl_metrics.summary()['stages']
+    product_api = stages.get('product_api', {}).get('latency_seconds', {})
+    parsing = stages.get('parse_product_json', {'items': 0, 'bytes': 0, 'latency_seconds': {'mean': 0.0}})
+    inserts = stages.get('insert_batch', {'items': 0, 'count': 0, 'latency_seconds': {'mean': 0.0}})
+    insert_seconds = inserts['count'] * inserts['latency_seconds']['mean']
+    results = {
+        'products': report['succeeded'],
+        'failed': report['failed'],
+        'elapsed_seconds': report['elapsed_seconds'],
+        'products_per_second': report['products_per_second'],
+        'request_latency_p50': product_api.get('p50', 0.0),
+        'request_latency_p99': product_api.get('p99', 0.0),
+        'response_bytes_per_product': parsing['bytes'] / parsing['items'] if parsing['items'] else 0.0,
+        'parse_seconds_per_product': parsing['latency_seconds']['mean'],
+        'db_rows_inserted': inserts['items'],
+        'db_insert_rows_per_second': inserts['items'] / insert_seconds if insert_seconds else 0.0,
+        'stub_requests': stub_requests,
+        'settings': {'latency': latency, 'jitter': jitter, 'error_rate': error_rate, 'discovery': discovery,
+                     'max_in_flight': max_in_flight, 'requests_per_second': requests_per_second,
+                     'lean_browser': lean_browser, 'projection': projection}
+    }
+    logger.info(f"Benchmark: {results['products_per_second']:.2f} products/s, "
+                f"p50 {results['request_latency_p50'] * 1000:.1f}ms, p99 {results['request_latency_p99'] * 1000:.1f}ms, "
+                f"{results['db_insert_rows_per_second']:.0f} rows/s inserted")
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the crawl pipeline against a local stub server.")
+    parser.add_argument("--fixture-dir", default=None,
+                        help="recorded fixtures to serve, a synthetic site is generated when omitted")
+    parser.add_argument("--archive-dir", default=None, help="also serve product responses from this archive")
+    parser.add_argument("--save-fixtures", default=None, help="write the generated site to this directory")
+    parser.add_argument("--brands", type=int, default=10)
+    parser.add_argument("--products-per-brand", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every stub response")
+    parser.add_argument("--jitter", type=float, default=0.05, help="up to this many extra seconds per response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of product requests answered with 503")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument("--requests-per-second", type=float, default=REQUESTS_PER_SECOND)
+    parser.add_argument("--discovery", choices=("sitemap", "browser"), default="sitemap",
+                        help="find product urls from the stub's sitemaps or by scrolling its brand pages in a browser")
+    parser.add_argument("--full-browser", action="store_true",
+                        help="with browser discovery, load every resource instead of the lean browser profile")
+    parser.add_argument("--projection", action="store_true", help="request and keep only the product fields stored")
+    parser.add_argument("--db-file", default=None, help="database to crawl into, a temporary one by default")
+    parser.add_argument("--report-dir", default=REPORT_DIR)
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.fixture_dir:
+        site = FixtureSite.load(args.fixture_dir, args.archive_dir)
+    else:
+        site = FixtureSite.generate(args.brands, args.products_per_brand)
+        if args.save_fixtures:
+            site.save(args.save_fixtures)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_benchmark(site, args.db_file or os.path.join(tmp_dir, "benchmark.db"), args.latency,
+                                args.jitter, args.error_rate, args.discovery, args.max_in_flight,
+                                args.requests_per_second, not args.full_browser, args.projection)
+        connections.close_all()
+    crawl_metrics.write_report(args.report_dir, extra=results)
+    print(f"products/s            {results['products_per_second']:.2f}")
+    print(f"request latency p50   {results['request_latency_p50'] * 1000:.1f} ms")
+    print(f"request latency p99   {results['request_latency_p99'] * 1000:.1f} ms")
+    print(f"response size         {results['response_bytes_per_product'] / 1024:.1f} KiB/product")
+    print(f"json parse time       {results['parse_seconds_per_product'] * 1000:.2f} ms/product")
+    print(f"db insert rate        {results['db_insert_rows_per_second']:.0f} rows/s")
@@ -2,7 +2,6 @@ import glob
 import json
 import pandas as pd
 import re
-from webscraper import drop_duplicate_product_urls
 
 
 def expand_product_options(df):
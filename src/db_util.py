@@ -1,43 +1,131 @@
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterable, Callable
+from contextlib import contextmanager
+import itertools
+import threading
+import time
 import sqlite3
+import queue
+import json
+import os
 import logging
+from metrics import crawl_metrics
+from product_fields import typed_columns
 
 # TODO backup db before insert 
-# TODO error logs
-# CREATE TABLE IF NOT EXISTS error_logs (
-#     id INTEGER PRIMARY KEY AUTOINCREMENT,
-#     row_data TEXT,
-#     error_message TEXT,
-#     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-# );
 
 # TODO Integrate email or webhook notifications to alert of: Successful runs. Issues like failed rows or missing tables.
 
 
-logging.basicConfig(
-    level=logging.INFO,  # Set to DEBUG for more detailed logs
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("db_operations.log"),  # Logs to a file
-        logging.StreamHandler()  # Logs to the console
-    ]
+logger = logging.getLogger(__name__)
+
+
+def configure_logging(log_file: str = "db_operations.log", level=logging.INFO):
+    """Logs to a file and the console. Called by entry points, never at import time."""
+    logging.basicConfig(
+        level=level,  # Set to DEBUG for more detailed logs
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),  # Logs to a file
+            logging.StreamHandler()  # Logs to the console
+        ]
+    )
+
+
+# applied to every connection ConnectionManager opens
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -64000),  # KiB, negative sizes are in KiB rather than pages
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
 )
+CACHED_STATEMENTS = 256
+BUSY_TIMEOUT = 10
+BULK_CHUNK_SIZE = 1000
+WRITE_QUEUE_SIZE = 10000
+WRITE_GROUP_SIZE = 500
+WRITE_GROUP_INTERVAL = 1.0
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 6 * 60 * 60
 
-logger = logging.getLogger(__name__)
 
+class ConnectionManager:
+    """Long-lived, tuned SQLite connections, one per database file per thread.
 
-def get_db_connection(db_file: str):
-    """Context manager for SQLite database connection.
+    Connections are opened on first use with SQLITE_PRAGMAS applied (WAL
+    journaling, relaxed synchronous, a larger page cache and memory mapped
+    reads) and a prepared statement cache, then reused by every later query
+    on the same thread. A forked child process never reuses its parent's
+    connections, it opens its own.
 
-    Yields:
-        conn: sqlite3 database connection
+    Args:
+        pragmas (Tuple): (name, value) pragmas run on every new connection
+        cached_statements (int): prepared statements kept per connection
     """
-    try:
+    def __init__(self, pragmas: Tuple = SQLITE_PRAGMAS, cached_statements: int = CACHED_STATEMENTS):
+        self.pragmas = pragmas
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.open_connections = []
+        self.pid = os.getpid()
+
+    def _open(self, db_file: str) -> sqlite3.Connection:
         logger.info(f"Connecting to database: {db_file}")
-        conn = sqlite3.connect(db_file, timeout=10)
+        # connections stay on the thread that opened them, close_all may run on another thread
+        conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, cached_statements=self.cached_statements,
+                               check_same_thread=False)
+        for name, value in self.pragmas:
+            conn.execute(f"PRAGMA {name}={value}")
+        with self.lock:
+            self.open_connections.append(conn)
         return conn
-    finally:
-        logger.info(f"Database connection closed.")
+
+    def connection(self, db_file: str) -> sqlite3.Connection:
+        """Returns this thread's connection to db_file, opening it on first use."""
+        if os.getpid() != self.pid:
+            # forked: the inherited connections belong to the parent, drop them without closing
+            self.local = threading.local()
+            self.open_connections = []
+            self.pid = os.getpid()
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        if db_file not in connections:
+            connections[db_file] = self._open(db_file)
+        return connections[db_file]
+
+    def close(self, db_file: str):
+        """Closes the calling thread's connection to db_file, if it has one."""
+        conn = getattr(self.local, 'connections', {}).pop(db_file, None)
+        if conn is None:
+            return
+        with self.lock:
+            if conn in self.open_connections:
+                self.open_connections.remove(conn)
+        conn.close()
+
+    def close_all(self):
+        """Closes every connection this process opened, on any thread. Later queries reconnect."""
+        with self.lock:
+            open_connections, self.open_connections = self.open_connections, []
+            self.local = threading.local()
+        for conn in open_connections:
+            conn.close()
+        logger.info(f"Closed {len(open_connections)} database connections.")
+
+
+connections = ConnectionManager()
+
+
+def get_db_connection(db_file: str) -> sqlite3.Connection:
+    """Returns the calling thread's long-lived connection to db_file.
+
+    Used as `with get_db_connection(db_file) as conn:`, the block runs as one
+    transaction that is committed, or rolled back if it raises. The
+    connection stays open for the next query.
+    """
+    return connections.connection(db_file)
 
 
 def execute_query(db_file: str, sql_query: str, params: Tuple = ()):
@@ -60,92 +148,357 @@ def execute_query(db_file: str, sql_query: str, params: Tuple = ()):
         raise
 
 
-def insert_batch(db_file: str, sql_query: str, batch_data: List[Tuple]):
-    """Executes a batch insert into the database.
+def select_query(db_file: str, sql_query: str, params: Tuple = ()) -> List[Tuple]:
+    """Executes a read query and returns all rows.
 
     Args:
-        db_file (str): _description_
-        sql_query (str): _description_
-        batch_data (List[Tuple]): _description_
+        db_file (str): path to SQLite database
+        sql_query (str): SELECT statement
+        params (Tuple, optional): query parameters. Defaults to ().
     """
-    logger.info(batch_data)
     try:
         with get_db_connection(db_file) as conn:
             cursor = conn.cursor()
-            logger.debug(f"Executing batch insert: {sql_query} | Batch size: {len(batch_data)}")
-            cursor.executemany(sql_query, batch_data)
-            conn.commit()
-            logger.info(f"Batch insert successful. {len(batch_data)} rows inserted.")
+            logger.debug(f"Executing query: {sql_query} | Params: {params}")
+            cursor.execute(sql_query, params)
+            return cursor.fetchall()
     except sqlite3.Error as e:
-        logger.error(f"Batch insert error: {e}")
+        logger.error(f"SQLite error: {e}")
         raise
 
 
+def insert_batch(db_file: str, sql_query: str, batch_data: Iterable[Tuple]):
+    """Executes a batch insert into the database, see bulk_load.
+
+    Args:
+        db_file (str): path to SQLite database
+        sql_query (str): INSERT statement with one placeholder per column
+        batch_data (Iterable[Tuple]): rows to insert
+    """
+    return bulk_load(db_file, sql_query, batch_data)
+
+
+def bulk_load(db_file: str, sql_query: str, rows: Iterable[Tuple], chunk_size: int = BULK_CHUNK_SIZE) -> int:
+    """Inserts rows from any iterable or generator, committing every chunk_size rows.
+
+    Each chunk runs in its own explicit transaction, so memory stays at one
+    chunk however many rows are loaded, and a failure only rolls back the
+    chunk in progress. Only row counts and timings are logged, never the rows.
+
+    Args:
+        db_file (str): path to SQLite database
+        sql_query (str): INSERT statement with one placeholder per column
+        rows (Iterable[Tuple]): rows to insert, consumed lazily
+        chunk_size (int): rows per transaction
+
+    Returns:
+        int: number of rows inserted, or queued while a BackgroundWriter is open for db_file
+    """
+    writer = background_writers.get(db_file)
+    if writer is not None and threading.current_thread() is not writer.thread:
+        return writer.put_rows(sql_query, rows)
+    conn = get_db_connection(db_file)
+    rows = iter(rows)
+    total = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            with crawl_metrics.measure('insert_batch') as measurement:
+                conn.execute("BEGIN")
+                try:
+                    conn.executemany(sql_query, chunk)
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+                measurement.items = len(chunk)
+            total += len(chunk)
+            logger.debug(f"Committed chunk of {len(chunk)} rows, {total} in total")
+    except sqlite3.Error as e:
+        logger.error(f"Batch insert error after {total} rows: {e}")
+        raise
+    logger.info(f"Batch insert successful. {total} rows inserted in {time.perf_counter() - start:.3f}s.")
+    return total
+
+
+background_writers = {}
+
+
+class BackgroundWriter:
+    """Dedicated writer thread that owns the connection to one database.
+
+    While it is open, every insert_batch and bulk_load for db_file, from any
+    thread, puts its rows on a bounded queue and returns at once. The writer
+    commits them in groups of `group_size` rows, or `group_interval` seconds
+    after the first row of a group arrived, whichever comes first. Callers
+    block when `max_queued` writes are waiting. Rows written inside a `unit`
+    block are queued together and committed all or nothing. A group that
+    fails is replayed unit by unit so one bad row only loses its own unit,
+    and the unit's on_error callback is called with the error, on the writer
+    thread. Other statements and reads still run on the caller's connection,
+    call flush first when they depend on queued rows. Closing flushes every
+    queued row.
+
+    Usage:
+        with BackgroundWriter(db_file) as writer:
+            with writer.unit(product_code, on_error=lambda error: ...):
+                insert_product_detail_rows(db_file, rows)
+                mark_crawl_completed(db_file, phase, [product_code])
+            writer.flush()
+
+    Args:
+        db_file (str): path to SQLite database
+        max_queued (int): writes queued before callers block, a unit counts once
+        group_size (int): rows per transaction
+        group_interval (float): longest a queued row waits for its group to commit, in seconds
+    """
+    def __init__(self, db_file: str, max_queued: int = WRITE_QUEUE_SIZE, group_size: int = WRITE_GROUP_SIZE,
+                 group_interval: float = WRITE_GROUP_INTERVAL):
+        self.db_file = db_file
+        self.group_size = group_size
+        self.group_interval = group_interval
+        self.pending = queue.Queue(maxsize=max_queued)
+        self.stats = {'queued': 0, 'written': 0, 'failed': 0, 'commits': 0}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread = None
+
+    def __enter__(self):
+        if self.db_file in background_writers:
+            raise RuntimeError(f"A background writer is already open for {self.db_file}")
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+        background_writers[self.db_file] = self
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def put_rows(self, sql_query: str, rows: Iterable[Tuple]) -> int:
+        """Queues rows for sql_query, blocking while the queue is full. Returns the number queued.
+
+        Inside a unit block the rows are held back and queued with the rest of the unit.
+        """
+        unit = getattr(self.local, 'unit', None)
+        if unit is not None:
+            writes = [(sql_query, row) for row in rows]
+            unit[1].extend(writes)
+            return len(writes)
+        count = 0
+        for row in rows:
+            self.pending.put((None, [(sql_query, row)], None))
+            count += 1
+        with self.lock:
+            self.stats['queued'] += count
+        return count
+
+    @contextmanager
+    def unit(self, key, on_error: Callable = None):
+        """Queues every row the block writes on this thread as one all or nothing write.
+
+        Nothing is queued if the block raises. If committing the unit fails,
+        on_error(error) is called on the writer thread, writes it makes go
+        straight to the database.
+
+        Args:
+            key: names the unit in logs, e.g. a product code
+            on_error (Callable): takes the sqlite3.Error the unit failed with
+        """
+        if getattr(self.local, 'unit', None) is not None:
+            # nested units join the outer one
+            yield
+            return
+        self.local.unit = unit = (key, [], on_error)
+        try:
+            yield
+        finally:
+            self.local.unit = None
+        if unit[1]:
+            self.pending.put(unit)
+            with self.lock:
+                self.stats['queued'] += len(unit[1])
+
+    def flush(self):
+        """Blocks until every row queued so far is committed."""
+        flushed = threading.Event()
+        self.pending.put(flushed)
+        flushed.wait()
+
+    def close(self) -> Dict:
+        """Commits every queued row, stops the writer thread and returns write counts."""
+        if background_writers.get(self.db_file) is self:
+            del background_writers[self.db_file]
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+            logger.info(f"Background writer finished: {self.stats}")
+        return dict(self.stats)
+
+    def _run(self):
+        try:
+            self._write_groups(get_db_connection(self.db_file))
+        finally:
+            # the writer thread's connection would otherwise stay open after the thread ends
+            connections.close(self.db_file)
+
+    def _write_groups(self, conn):
+        group = []
+        rows = 0
+        deadline = None
+        while True:
+            timeout = max(0.0, deadline - time.monotonic()) if group else None
+            try:
+                item = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                item = 'commit'
+            if isinstance(item, tuple):
+                group.append(item)
+                rows += len(item[1])
+                if len(group) == 1:
+                    deadline = time.monotonic() + self.group_interval
+                if rows < self.group_size:
+                    continue
+            self._commit(conn, group)
+            group = []
+            rows = 0
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+    @staticmethod
+    def _execute(conn, units):
+        conn.execute("BEGIN")
+        try:
+            writes = itertools.chain.from_iterable(writes for _, writes, _ in units)
+            for sql_query, items in itertools.groupby(writes, key=lambda write: write[0]):
+                conn.executemany(sql_query, [row for _, row in items])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _commit(self, conn, group):
+        if not group:
+            return
+        rows = sum(len(writes) for _, writes, _ in group)
+        written = rows
+        failed_units = []
+        with crawl_metrics.measure('insert_batch') as measurement:
+            try:
+                self._execute(conn, group)
+            except sqlite3.Error as e:
+                logger.error(f"Group of {rows} rows failed, retrying unit by unit: {e}")
+                written = 0
+                for unit in group:
+                    try:
+                        self._execute(conn, [unit])
+                        written += len(unit[1])
+                    except sqlite3.Error as e:
+                        logger.error(f"Background write of {unit[0] or 'a row'} failed: {e}")
+                        failed_units.append((unit, e))
+            measurement.items = written
+        with self.lock:
+            self.stats['written'] += written
+            self.stats['failed'] += rows - written
+            self.stats['commits'] += 1
+        logger.debug(f"Committed group of {written} rows")
+        for (key, _, on_error), error in failed_units:
+            if on_error is None:
+                continue
+            try:
+                on_error(error)
+            except Exception as e:
+                logger.error(f"Error callback of {key} failed: {e}")
+
+
+@contextmanager
+def background_writes(db_file: str):
+    """Runs the block with a BackgroundWriter for db_file, unless one is already open, and flushes it on exit."""
+    writer = background_writers.get(db_file)
+    if writer is not None:
+        try:
+            yield writer
+        finally:
+            writer.flush()
+        return
+    with BackgroundWriter(db_file) as writer:
+        yield writer
+
+
+@contextmanager
+def write_unit(db_file: str, key, on_error: Callable = None):
+    """Groups the block's writes to db_file into one BackgroundWriter unit, see BackgroundWriter.unit.
+
+    Without a background writer open for db_file the writes run directly, and a failed write raises to the caller.
+    """
+    writer = background_writers.get(db_file)
+    if writer is None or threading.current_thread() is writer.thread:
+        yield
+        return
+    with writer.unit(key, on_error):
+        yield
+
+
+# product_details insert column order, rows built by ProductScraper.iter_product_rows follow it
+PRODUCT_DETAILS_COLUMNS = (
+    'target_url', 'full_product_url', 'product_code', 'loves_count', 'rating', 'reviews', 'brand_source_id',
+    'category_id', 'category_name', 'category_url',
+    'sku_id', 'brand_name', 'display_name', 'ingredients', 'limited_edition',
+    'first_access', 'limited_time_offer', 'new_product', 'online_only',
+    'few_left', 'out_of_stock', 'price', 'max_purchase_quantity', 'size', 'type',
+    'url', 'variation_type', 'variation_value',
+    'returnable', 'finish_refinement', 'size_refinement', 'short_description', 'long_description',
+    'suggested_usage'
+)
+# compress_product_data record keys, same order, brand_source_id is called brand_id in records
+PRODUCT_RECORD_KEYS = tuple('brand_id' if column == 'brand_source_id' else column for column in PRODUCT_DETAILS_COLUMNS)
+
+# parsed from price and size when a row is inserted, see product_fields.typed_columns
+PRODUCT_DETAILS_TYPED_COLUMNS = ('price_cents', 'size_amount', 'size_unit', 'unit_price_cents')
+PRICE_INDEX = PRODUCT_DETAILS_COLUMNS.index('price')
+SIZE_INDEX = PRODUCT_DETAILS_COLUMNS.index('size')
+INSERTED_PRODUCT_DETAILS_COLUMNS = PRODUCT_DETAILS_COLUMNS + PRODUCT_DETAILS_TYPED_COLUMNS
+
+# a product's SKU rows are replaced in place, product_details holds one row per (product_code, sku_id)
+insert_product_details_query = f"""
+    INSERT INTO product_details ({', '.join(INSERTED_PRODUCT_DETAILS_COLUMNS)})
+    VALUES ({', '.join('?' for _ in INSERTED_PRODUCT_DETAILS_COLUMNS)})
+    ON CONFLICT(product_code, sku_id) DO UPDATE SET
+    {', '.join(f'{column}=excluded.{column}' for column in INSERTED_PRODUCT_DETAILS_COLUMNS)}
+"""
+
+
+def insert_product_detail_rows(db_file: str, rows: Iterable[Tuple]):
+    """Inserts product_details rows already in PRODUCT_DETAILS_COLUMNS order.
+    Price in cents, size amount and unit, and unit price are parsed from each row on the way in.
+    Args:
+        db_file: (str)
+        rows: (Iterable[Tuple]) a list or a generator
+    """
+    typed_rows = (tuple(row) + typed_columns(row[PRICE_INDEX], row[SIZE_INDEX]) for row in rows)
+    insert_batch(db_file, insert_product_details_query, typed_rows)
+
+
 def insert_product_details(db_file:str, products: List[Dict], table_name: str):
     """
     Args:
         db_file: (str)
-        products: (List[Dict])
+        products: (List[Dict]) compress_product_data records
         table_name: str
     """
-    sql_query = """
-        INSERT INTO product_details (
-            target_url, full_product_url, product_code, loves_count, rating, reviews, brand_source_id,
-            category_id, category_name, category_url,
-            sku_id, brand_name, display_name, ingredients, limited_edition,
-            first_access, limited_time_offer, new_product, online_only,
-            few_left, out_of_stock, price, max_purchase_quantity, size, type,
-            url, variation_type, variation_value,
-            returnable, finish_refinement, size_refinement, short_description, long_description,
-            suggested_usage
-        ) VALUES (
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
-        )
-        """
-    batch_data = [(
-            product.get("target_url"),
-            product.get("full_product_url"),
-            product.get("product_code"),
-            product.get("loves_count"),
-            product.get("rating"),
-            product.get("reviews"),
-            product.get("brand_id"),
-            product.get("category_id"),
-            product.get("category_name"),
-            product.get("category_url"),
-            product.get("sku_id"),
-            product.get("brand_name"),
-            product.get("display_name"),
-            product.get("ingredients"),
-            product.get("limited_edition"),
-            product.get("first_access"),
-            product.get("limited_time_offer"),
-            product.get("new_product"),
-            product.get("online_only"),
-            product.get("few_left"),
-            product.get("out_of_stock"),
-            product.get("price"),
-            product.get("max_purchase_quantity"),
-            product.get("size"),
-            product.get("type"),
-            product.get("url"),
-            product.get("variation_type"),
-            product.get("variation_value"),
-            product.get("returnable"),
-            product.get("finish_refinement"),
-            product.get("size_refinement"),
-            product.get("short_description"),
-            product.get("long_description"),
-            product.get("suggested_usage") 
-        ) for product in products]
-    
-    insert_batch(db_file, sql_query, batch_data)
+    batch_data = (tuple(product.get(key) for key in PRODUCT_RECORD_KEYS) for product in products)
+    insert_product_detail_rows(db_file, batch_data)
 
 
 def insert_brand_products(db_file: str, brand_id: int, data: List[str], table_name: str):
-    """Inserts brand products into the database scraped from brand pages.
+    """Upserts brand products into the database scraped from brand pages.
     Product urls used in downstream API calls to get product details.
+    A product already stored keeps its brand when the new row has none, e.g. from a sitemap.
     Args:
         db_file: (str)
         data: (List[Dict])
@@ -155,24 +508,74 @@ def insert_brand_products(db_file: str, brand_id: int, data: List[str], table_na
     sql_query = """
         INSERT INTO products (brand_id, product_url, sku, product_code)
         VALUES (?, ?, ?, ?)
+        ON CONFLICT(product_code) DO UPDATE SET
+        brand_id=COALESCE(excluded.brand_id, products.brand_id), product_url=excluded.product_url, sku=excluded.sku
     """
     # insert_batch(db_file, sql_query, [(brand_id, *data) for data in data])
-    insert_batch(db_file, sql_query, [(data) for data in data])
+    insert_batch(db_file, sql_query, data)
 
 
 # Function to insert data into the 'brands' table
 def insert_brands_data(db_file: str, data: List, table_name:str):
-    """Inserts brand data into the database.
+    """Upserts brand data into the database, a brand keeps its id across runs.
     Args:
         db_file: (str)
         data: (List[Dict])
         table_name: str
     """
-    sql_query = """INSERT INTO brands (brand_name, brand_url) VALUES (?, ?)"""
+    sql_query = """
+        INSERT INTO brands (brand_name, brand_url) VALUES (?, ?)
+        ON CONFLICT(brand_url) DO UPDATE SET brand_name=excluded.brand_name
+    """
     batch_data = [(brand["brand_name"], brand["brand_url"]) for brand in data]
     insert_batch(db_file, sql_query, batch_data)
 
 
+def mark_crawl_completed(db_file: str, phase: str, item_keys: List[str]):
+    """Records items finished in a crawl phase so a restarted crawl skips them.
+    Args:
+        db_file: (str)
+        phase: (str) one of the crawl phase names, e.g. 'brand_pages'
+        item_keys: (List[str]) brand urls or product codes
+    """
+    sql_query = """INSERT OR IGNORE INTO crawl_state (phase, item_key) VALUES (?, ?)"""
+    insert_batch(db_file, sql_query, [(phase, item_key) for item_key in item_keys])
+
+
+def get_crawl_completed(db_file: str, phase: str) -> set:
+    """Returns the item keys already finished in a crawl phase."""
+    rows = select_query(db_file, """SELECT item_key FROM crawl_state WHERE phase=?""", (phase,))
+    return {item_key for (item_key,) in rows}
+
+
+def reset_crawl_state(db_file: str):
+    """Forgets all checkpoints so the next crawl starts from scratch."""
+    execute_query(db_file, """DELETE FROM crawl_state""")
+
+
+def get_content_hashes(db_file: str, product_code: str) -> Tuple[str, Dict[str, str]]:
+    """Returns the stored content hash of a product and of each of its SKUs.
+
+    Returns:
+        (product_hash, {sku_id: sku_hash}), product_hash is None for products never stored
+    """
+    product_rows = select_query(db_file, """SELECT content_hash FROM product_hashes WHERE product_code=?""", (product_code,))
+    sku_rows = select_query(db_file, """SELECT sku_id, content_hash FROM sku_hashes WHERE product_code=?""", (product_code,))
+    return (product_rows[0][0] if product_rows else None), dict(sku_rows)
+
+
+def save_content_hashes(db_file: str, product_code: str, product_hash: str, sku_hashes: Dict[str, str]):
+    """Upserts the content hashes of a product and its SKUs, stamping when the product last changed."""
+    insert_batch(db_file, """
+        INSERT INTO product_hashes (product_code, content_hash) VALUES (?, ?)
+        ON CONFLICT(product_code) DO UPDATE SET content_hash=excluded.content_hash, changed_at=CURRENT_TIMESTAMP
+    """, [(product_code, product_hash)])
+    insert_batch(db_file, """
+        INSERT INTO sku_hashes (sku_id, product_code, content_hash) VALUES (?, ?, ?)
+        ON CONFLICT(sku_id) DO UPDATE SET content_hash=excluded.content_hash, changed_at=CURRENT_TIMESTAMP
+    """, [(sku_id, product_code, sku_hash) for sku_id, sku_hash in sku_hashes.items()])
+
+
 create_brands_table_query = """
 CREATE TABLE IF NOT EXISTS brands (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -234,4 +637,287 @@ CREATE TABLE IF NOT EXISTS product_details (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (product_code) REFERENCES products(product_code)
 )
-"""
\ No newline at end of file
+"""
+
+create_crawl_state_table_query = """
+CREATE TABLE IF NOT EXISTS crawl_state (
+    phase TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (phase, item_key)
+)
+"""
+
+create_product_hashes_table_query = """
+CREATE TABLE IF NOT EXISTS product_hashes (
+    product_code TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+create_sku_hashes_table_query = """
+CREATE TABLE IF NOT EXISTS sku_hashes (
+    sku_id TEXT PRIMARY KEY,
+    product_code TEXT,
+    content_hash TEXT NOT NULL,
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+
+# (table, row id column, unique index, natural key columns) upserts conflict on
+NATURAL_KEYS = (
+    ('brands', 'id', 'brands_brand_url_key', ('brand_url',)),
+    ('products', 'product_id', 'products_product_code_key', ('product_code',)),
+    ('product_details', 'id', 'product_details_sku_key', ('product_code', 'sku_id')),
+)
+
+
+def _add_natural_keys(conn: sqlite3.Connection):
+    """Creates the unique indexes in NATURAL_KEYS, first removing duplicates left by earlier append-only runs.
+
+    The newest row of each key is kept, except for brands where the oldest is kept and products are
+    pointed at it, so brand ids stay stable. Rows with a NULL key are left alone.
+    """
+    existing = {name for (name,) in conn.execute("""SELECT name FROM sqlite_master WHERE type='index'""")}
+    for table, id_column, index_name, columns in NATURAL_KEYS:
+        if index_name in existing:
+            continue
+        key = ', '.join(columns)
+        not_null = ' AND '.join(f'{column} IS NOT NULL' for column in columns)
+        keep = 'MIN' if table == 'brands' else 'MAX'
+        if table == 'brands':
+            conn.execute("""
+                UPDATE products SET brand_id = (
+                    SELECT MIN(kept.id) FROM brands kept JOIN brands old ON old.brand_url = kept.brand_url
+                    WHERE old.id = products.brand_id
+                ) WHERE brand_id IN (SELECT id FROM brands)
+            """)
+        removed = conn.execute(f"""
+            DELETE FROM {table} WHERE {not_null}
+            AND {id_column} NOT IN (SELECT {keep}({id_column}) FROM {table} WHERE {not_null} GROUP BY {key})
+        """).rowcount
+        conn.execute(f"""CREATE UNIQUE INDEX {index_name} ON {table} ({key})""")
+        logger.info(f"Added unique key {index_name}, removed {removed} duplicate rows from {table}.")
+
+
+def _add_typed_price_and_size(conn: sqlite3.Connection):
+    """Adds PRODUCT_DETAILS_TYPED_COLUMNS and fills them in for rows stored before they existed."""
+    for column, column_type in zip(PRODUCT_DETAILS_TYPED_COLUMNS, ('INTEGER', 'REAL', 'TEXT', 'REAL')):
+        conn.execute(f"""ALTER TABLE product_details ADD COLUMN {column} {column_type}""")
+    rows = conn.execute("""SELECT id, price, size FROM product_details""")
+    conn.executemany(f"""
+        UPDATE product_details SET {', '.join(f'{column}=?' for column in PRODUCT_DETAILS_TYPED_COLUMNS)} WHERE id=?
+    """, (typed_columns(price, size) + (row_id,) for row_id, price, size in rows.fetchall()))
+    conn.execute("""CREATE INDEX product_details_price_cents ON product_details (price_cents)""")
+    conn.execute("""CREATE INDEX product_details_unit_price ON product_details (size_unit, unit_price_cents)""")
+
+
+# price and stock flags whose changes are recorded in price_history
+PRICE_HISTORY_COLUMNS = ('price_cents', 'price', 'out_of_stock', 'few_left')
+_price_history_changed = ' OR '.join(f'NEW.{column} IS NOT latest.{column}' for column in PRICE_HISTORY_COLUMNS)
+_record_price_history = f"""
+    INSERT INTO price_history (sku_id, product_code, {', '.join(PRICE_HISTORY_COLUMNS)})
+    SELECT NEW.sku_id, NEW.product_code, {', '.join(f'NEW.{column}' for column in PRICE_HISTORY_COLUMNS)}
+    WHERE NEW.sku_id IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM (
+            SELECT * FROM price_history WHERE sku_id = NEW.sku_id ORDER BY observed_at DESC, id DESC LIMIT 1
+        ) latest WHERE NOT ({_price_history_changed})
+    );
+"""
+
+create_price_history_statements = [
+    """
+    CREATE TABLE price_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sku_id TEXT NOT NULL,
+        product_code TEXT,
+        price_cents INTEGER,
+        price TEXT,
+        out_of_stock BOOLEAN,
+        few_left BOOLEAN,
+        observed_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+    )
+    """,
+    # price of a SKU at time T
+    """CREATE INDEX price_history_sku_time ON price_history (sku_id, observed_at)""",
+    # every change since time T
+    """CREATE INDEX price_history_time ON price_history (observed_at)""",
+    # one row per change: inserts and updates of product_details only add a row when price or stock differs,
+    # compared with the latest row by observed_at then id, so rows written in the same millisecond stay in order
+    f"""
+    CREATE TRIGGER product_details_price_history_insert AFTER INSERT ON product_details
+    BEGIN {_record_price_history} END
+    """,
+    f"""
+    CREATE TRIGGER product_details_price_history_update
+    AFTER UPDATE OF {', '.join(PRICE_HISTORY_COLUMNS)} ON product_details
+    BEGIN {_record_price_history} END
+    """,
+    # rows stored before the history existed are its first observations
+    f"""
+    INSERT INTO price_history (sku_id, product_code, {', '.join(PRICE_HISTORY_COLUMNS)}, observed_at)
+    SELECT sku_id, product_code, {', '.join(PRICE_HISTORY_COLUMNS)}, created_at
+    FROM product_details WHERE sku_id IS NOT NULL
+    """,
+]
+
+
+# Schema migrations, applied in order by migrate. Each is a list of SQL statements or a callable taking the
+# connection, and runs in one transaction together with the PRAGMA user_version bump that records it.
+# The create_*_table_query statements are the version 0 schema. Never edit a released migration, append a new one.
+MIGRATIONS = (
+    # 1: unique natural keys for upserts
+    _add_natural_keys,
+    # 2: secondary indexes for the crawl's lookups, see test_db_util for the query plans they serve
+    [
+        """CREATE INDEX IF NOT EXISTS products_brand_id ON products (brand_id)""",
+        """CREATE INDEX IF NOT EXISTS product_details_sku_id ON product_details (sku_id)""",
+        """CREATE INDEX IF NOT EXISTS sku_hashes_product_code ON sku_hashes (product_code, sku_id, content_hash)""",
+        """CREATE INDEX IF NOT EXISTS product_hashes_changed_at ON product_hashes (changed_at)""",
+    ],
+    # 3: price in cents, size amount and unit, and unit price as typed, indexed columns
+    _add_typed_price_and_size,
+    # 4: price and stock history, one row per change
+    create_price_history_statements,
+    # 5: dead letters, products that failed with their error and payload, see record_dead_letters
+    [
+        """
+        CREATE TABLE dead_letters (
+            product_code TEXT PRIMARY KEY,
+            stage TEXT,
+            error_type TEXT,
+            error TEXT,
+            payload TEXT,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            first_failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            next_retry_at TIMESTAMP
+        )
+        """,
+        """CREATE INDEX dead_letters_next_retry_at ON dead_letters (next_retry_at)""",
+    ],
+)
+
+
+def get_schema_version(db_file: str) -> int:
+    """Returns the number of migrations applied to db_file."""
+    return select_query(db_file, """PRAGMA user_version""")[0][0]
+
+
+def migrate(db_file: str, migrations=MIGRATIONS) -> int:
+    """Applies the migrations db_file has not seen yet, tracked with PRAGMA user_version.
+
+    Expects the tables from the create_*_table_query statements to exist.
+
+    Returns:
+        int: schema version after migrating
+    """
+    version = get_schema_version(db_file)
+    for number, migration in enumerate(migrations[version:], start=version + 1):
+        start = time.perf_counter()
+        conn = get_db_connection(db_file)
+        conn.execute("BEGIN")
+        try:
+            if callable(migration):
+                migration(conn)
+            else:
+                for statement in migration:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={number}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        logger.info(f"Migrated {db_file} to schema version {number} in {time.perf_counter() - start:.3f}s.")
+    return max(version, len(migrations))
+
+
+def get_price_at(db_file: str, sku_id: str, at: str) -> Tuple:
+    """Returns (price_cents, price, out_of_stock, few_left) of a SKU at time `at`, None before it was first seen.
+
+    Args:
+        at (str): 'YYYY-MM-DD HH:MM:SS' UTC timestamp, compared as text like CURRENT_TIMESTAMP
+    """
+    rows = select_query(db_file, f"""
+        SELECT {', '.join(PRICE_HISTORY_COLUMNS)} FROM price_history
+        WHERE sku_id=? AND observed_at<=? ORDER BY observed_at DESC, id DESC LIMIT 1
+    """, (sku_id, at))
+    return rows[0] if rows else None
+
+
+def get_price_changes_since(db_file: str, since: str, limit: int = None) -> List[Tuple]:
+    """Returns every price or stock change after `since`, oldest first.
+
+    Returns:
+        List[Tuple]: (sku_id, product_code, price_cents, price, out_of_stock, few_left, observed_at)
+    """
+    return select_query(db_file, f"""
+        SELECT sku_id, product_code, {', '.join(PRICE_HISTORY_COLUMNS)}, observed_at FROM price_history
+        WHERE observed_at>? ORDER BY observed_at, id LIMIT ?
+    """, (since, -1 if limit is None else limit))
+
+
+def stamp_price_history(db_file: str, product_code: str, after_id: int, observed_at: str):
+    """Sets observed_at of the price_history rows of a product added after row after_id, e.g. to when a
+    replayed response was originally fetched."""
+    execute_query(db_file, """UPDATE price_history SET observed_at=? WHERE id>? AND product_code=?""",
+                  (observed_at, after_id, product_code))
+
+
+def get_last_price_history_id(db_file: str) -> int:
+    """Returns the id of the newest price_history row, 0 when there is none."""
+    return select_query(db_file, """SELECT COALESCE(MAX(id), 0) FROM price_history""")[0][0]
+
+
+def dead_letter_row(product_code: str, stage: str, error: BaseException, payload=None) -> Tuple:
+    """Builds a record_dead_letters row, payload is the raw response body or the decoded JSON it failed on."""
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', errors='replace')
+    if payload is not None and not isinstance(payload, str):
+        payload = json.dumps(payload, default=str)
+    return product_code, stage, type(error).__name__, str(error), payload
+
+
+def record_dead_letters(db_file: str, rows: Iterable[Tuple]):
+    """Upserts failed products into dead_letters, scheduling each one's next retry with exponential backoff.
+
+    The first failure is retried after RETRY_BASE_DELAY seconds, each further failure doubles the
+    delay up to RETRY_MAX_DELAY.
+    Args:
+        db_file: (str)
+        rows: (Iterable[Tuple]) dead_letter_row tuples
+    """
+    insert_batch(db_file, f"""
+        INSERT INTO dead_letters (product_code, stage, error_type, error, payload, next_retry_at)
+        VALUES (?, ?, ?, ?, ?, datetime('now', '+{RETRY_BASE_DELAY} seconds'))
+        ON CONFLICT(product_code) DO UPDATE SET
+        stage=excluded.stage, error_type=excluded.error_type, error=excluded.error, payload=excluded.payload,
+        attempts=dead_letters.attempts + 1, last_failed_at=CURRENT_TIMESTAMP,
+        next_retry_at=datetime('now', printf('+%d seconds',
+                                             min({RETRY_MAX_DELAY}, {RETRY_BASE_DELAY} << dead_letters.attempts)))
+    """, rows)
+
+
+def clear_dead_letters(db_file: str, product_codes: Iterable[str]):
+    """Removes products that have since been stored from dead_letters."""
+    insert_batch(db_file, """DELETE FROM dead_letters WHERE product_code=?""",
+                 ((product_code,) for product_code in product_codes))
+
+
+def get_due_dead_letters(db_file: str, max_attempts: int, limit: int = None) -> List[str]:
+    """Returns product codes whose next retry is due and that have failed fewer than max_attempts times."""
+    rows = select_query(db_file, """
+        SELECT product_code FROM dead_letters
+        WHERE next_retry_at <= CURRENT_TIMESTAMP AND attempts < ?
+        ORDER BY next_retry_at LIMIT ?
+    """, (max_attempts, -1 if limit is None else limit))
+    return [product_code for (product_code,) in rows]
+
+
+def get_next_dead_letter_retry(db_file: str, max_attempts: int) -> str:
+    """Returns when the earliest retry of a product with attempts left is due, None if there is none."""
+    return select_query(db_file, """
+        SELECT MIN(next_retry_at) FROM dead_letters WHERE attempts < ?
+    """, (max_attempts,))[0][0]
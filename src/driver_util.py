@@ -0,0 +1,219 @@
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium import webdriver
+from contextlib import contextmanager
+from typing import Callable
+import threading
+import fcntl
+import queue
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.50 Safari/537.36'
+BROWSER_CACHE_DIR = 'data/browser_cache/'
+BROWSER_CACHE_SIZE = 200 * 1024 * 1024
+# a lean browser only needs the DOM and its scripts to find product tile hrefs
+LEAN_BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.avif', '*.svg', '*.ico', '*.mp4', '*.webm',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*googletagmanager.com*', '*google-analytics.com*', '*doubleclick.net*', '*facebook.net*', '*facebook.com/tr*',
+    '*hotjar.com*', '*bat.bing.com*', '*pinterest.com*', '*analytics.tiktok.com*', '*criteo.*', '*quantummetric.com*',
+    '*adsrvr.org*', '*demdex.net*', '*omtrdc.net*', '*everesttech.net*', '*branch.io*', '*bazaarvoice.com*'
+]
+LEAN_CONTENT_SETTINGS = {
+    'profile.managed_default_content_settings.images': 2,
+    'profile.managed_default_content_settings.notifications': 2,
+    'profile.managed_default_content_settings.geolocation': 2,
+    'profile.managed_default_content_settings.media_stream': 2,
+}
+
+
+def chrome_options(user_agent: str = USER_AGENT, lean: bool = False, cache_dir: str = None) -> Options:
+    """Headless Chrome options used by the crawl.
+
+    With lean, images are disabled through content settings and background features the crawl never
+    uses are switched off. With cache_dir, the HTTP cache is kept in that directory instead of the
+    throwaway profile, so scripts and stylesheets survive driver restarts.
+    """
+    options = Options()
+    options.add_argument("--headless")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    options.add_experimental_option('useAutomationExtension', False)
+    options.add_argument('user-agent={0}'.format(user_agent))
+    if lean:
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_argument("--disable-extensions")
+        options.add_argument("--disable-background-networking")
+        options.add_argument("--disable-component-update")
+        options.add_argument("--disable-sync")
+        options.add_argument("--mute-audio")
+        options.add_experimental_option("prefs", LEAN_CONTENT_SETTINGS)
+    if cache_dir:
+        options.add_argument(f"--disk-cache-dir={os.path.abspath(cache_dir)}")
+        options.add_argument(f"--disk-cache-size={BROWSER_CACHE_SIZE}")
+    return options
+
+
+def block_urls(driver, patterns=LEAN_BLOCKED_URLS):
+    """Makes the browser drop requests matching any of the wildcard patterns, through the DevTools protocol."""
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': list(patterns)})
+    except (AttributeError, WebDriverException) as e:
+        logger.warning(f"Request blocking unavailable, loading every resource: {e}")
+
+
+def create_chrome_driver(lean: bool = False, cache_dir: str = None):
+    """Launches a headless Chrome. Nothing is launched until a pool or caller asks for a driver."""
+    driver = webdriver.Chrome(options=chrome_options(lean=lean, cache_dir=cache_dir))
+    if lean:
+        block_urls(driver)
+    return driver
+
+
+class ChromeDriverFactory:
+    """Driver factory for DriverPool that gives every live Chrome its own persistent cache directory.
+
+    Chrome's disk cache cannot be shared by browsers running at the same time, so drivers take
+    numbered slots under `cache_dir`, each held with a file lock while its browser runs. Slots are
+    reused by the next driver, in this pool, a later pool or another process, so the cache stays
+    warm across driver recycling and crawl restarts.
+
+    Args:
+        lean (bool): block images, fonts and trackers, see chrome_options and LEAN_BLOCKED_URLS
+        cache_dir (str): parent of the per driver cache directories, None to use a throwaway cache
+    """
+    def __init__(self, lean: bool = True, cache_dir: str = BROWSER_CACHE_DIR):
+        self.lean = lean
+        self.cache_dir = cache_dir
+        self.slot_locks = {}
+        self.lock = threading.Lock()
+
+    def _take_slot(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        slot = 0
+        while True:
+            lock_file = open(os.path.join(self.cache_dir, f"slot{slot}.lock"), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return os.path.join(self.cache_dir, f"slot{slot}"), lock_file
+            except OSError:
+                lock_file.close()
+                slot += 1
+
+    def __call__(self):
+        if not self.cache_dir:
+            return create_chrome_driver(lean=self.lean)
+        with self.lock:
+            slot_dir, lock_file = self._take_slot()
+        try:
+            driver = create_chrome_driver(lean=self.lean, cache_dir=slot_dir)
+        except Exception:
+            lock_file.close()
+            raise
+        with self.lock:
+            self.slot_locks[id(driver)] = lock_file
+        return driver
+
+    def release(self, driver):
+        """Frees the cache slot of a driver that has quit."""
+        with self.lock:
+            lock_file = self.slot_locks.pop(id(driver), None)
+        if lock_file:
+            lock_file.close()
+
+
+class DriverPool:
+    """Pool of reusable WebDriver instances.
+
+    Drivers are launched on demand up to `size`, handed out one caller at a
+    time, health checked before every borrow and recycled after
+    `max_pages_per_driver` page loads so long crawls do not accumulate browser
+    memory. A factory with a `release(driver)` method, like ChromeDriverFactory,
+    is told about every driver the pool quits.
+
+    Args:
+        driver_factory (Callable): returns a new WebDriver
+        size (int): maximum number of live drivers, also the useful number of parallel scrapers
+        max_pages_per_driver (int): borrows after which a driver is quit and replaced
+    """
+    def __init__(self, driver_factory: Callable, size: int = 2, max_pages_per_driver: int = 25):
+        self.driver_factory = driver_factory
+        self.size = size
+        self.max_pages_per_driver = max_pages_per_driver
+        self.idle = queue.Queue()
+        self.launched = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_launch = self.launched < self.size
+            if can_launch:
+                self.launched += 1
+        if can_launch:
+            return self._launch()
+        return self.idle.get()
+
+    def _launch(self):
+        try:
+            logger.info("Launching WebDriver")
+            return [self.driver_factory(), 0]
+        except Exception:
+            with self.lock:
+                self.launched -= 1
+            raise
+
+    def _retire(self, driver):
+        try:
+            driver.quit()
+        except WebDriverException as e:
+            logger.warning(f"Error quitting WebDriver: {e}")
+        release = getattr(self.driver_factory, 'release', None)
+        if release:
+            release(driver)
+
+    @staticmethod
+    def is_healthy(driver) -> bool:
+        """A driver is healthy if its browser still answers WebDriver commands."""
+        try:
+            driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    @contextmanager
+    def driver(self):
+        """Borrows a healthy driver, replacing it first if it has crashed or served enough pages."""
+        entry = self._acquire()
+        if entry[1] >= self.max_pages_per_driver or not self.is_healthy(entry[0]):
+            logger.info(f"Recycling WebDriver after {entry[1]} pages")
+            self._retire(entry[0])
+            entry = self._launch()
+        try:
+            yield entry[0]
+        finally:
+            entry[1] += 1
+            if self.closed:
+                self._retire(entry[0])
+            else:
+                self.idle.put(entry)
+
+    def close(self):
+        """Quits every idle driver. Drivers still borrowed are quit when returned."""
+        self.closed = True
+        while True:
+            try:
+                driver, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._retire(driver)
@@ -0,0 +1,185 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable
+import threading
+import random
+import time
+import logging
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket shared by all fetch threads.
+
+    Caps the global request rate at `requests_per_second` no matter how many
+    requests are in flight. `burst` tokens can be spent back to back before
+    callers have to wait.
+    """
+    def __init__(self, requests_per_second: float, burst: int = 1):
+        if requests_per_second <= 0:
+            raise ValueError("requests_per_second must be positive")
+        self.rate = requests_per_second
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed to go out."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def record(self, latency: float, status_code: int = None, error: bool = False):
+        """Feedback hook for adaptive limiters, a fixed-rate limiter ignores it."""
+
+
+THROTTLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Rate limiter that tunes its rate from observed latency and errors.
+
+    The rate grows additively while responses are fast and successful, shrinks
+    gently when latency exceeds `target_latency`, and is halved on 429/5xx
+    responses or errors. After a throttled response every caller is held back
+    by a jittered exponential backoff. The rate never exceeds `max_rate`.
+
+    Args:
+        max_rate (float): hard ceiling in requests per second
+        initial_rate (float): starting rate, defaults to half the ceiling
+        min_rate (float): floor the rate never drops below
+        target_latency (float): seconds above which a response counts as slow
+        base_backoff (float): first backoff in seconds, doubled per consecutive failure
+        max_backoff (float): longest backoff in seconds
+    """
+    def __init__(self, max_rate: float, initial_rate: float = None, min_rate: float = 0.05,
+                 target_latency: float = 2.0, base_backoff: float = 1.0, max_backoff: float = 60.0):
+        super().__init__(initial_rate or max_rate / 2, burst=1)
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, self.rate)
+        self.target_latency = target_latency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.increase_step = max_rate / 20
+        self.consecutive_failures = 0
+        self.blocked_until = 0.0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                wait_time = self.blocked_until - time.monotonic()
+            if wait_time <= 0:
+                break
+            time.sleep(wait_time)
+        super().acquire()
+
+    def record(self, latency: float, status_code: int = None, error: bool = False):
+        with self.lock:
+            if error or status_code in THROTTLE_STATUS_CODES:
+                self.consecutive_failures += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.consecutive_failures - 1))
+                self.blocked_until = max(self.blocked_until, time.monotonic() + random.uniform(0, backoff))
+                logger.warning(f"Backing off up to {backoff:.1f}s, rate now {self.rate:.2f}/s "
+                               f"(status {status_code}, error {error})")
+                return
+            self.consecutive_failures = 0
+            if latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+
+class ConcurrentProductFetcher:
+    """Fetches product details on a thread pool with bounded parallelism.
+
+    Workers only do network I/O. Finished responses are handed to `handle_fn`
+    on the calling thread as they complete, so database writes stay on a
+    single connection path. Products whose fetch or handling raised are
+    handed to `error_fn`, also on the calling thread.
+
+    Args:
+        fetch_fn (Callable): takes a product code, returns the API response
+        handle_fn (Callable): takes (product_code, response), stores the result
+        max_in_flight (int): maximum number of requests running at once
+        requests_per_second (float): ceiling of the global request budget across all workers
+        limiter (RateLimiter): overrides the default AdaptiveRateLimiter
+        error_fn (Callable): takes (product_code, exception, payload), payload is the response handle_fn
+            failed on, the body of an HTTP error response or of a response that could not be decoded, or None
+    """
+    def __init__(self, fetch_fn: Callable, handle_fn: Callable, max_in_flight: int = 8,
+                 requests_per_second: float = 2.0, limiter: RateLimiter = None, error_fn: Callable = None):
+        self.fetch_fn = fetch_fn
+        self.handle_fn = handle_fn
+        self.error_fn = error_fn
+        self.max_in_flight = max_in_flight
+        self.limiter = limiter or AdaptiveRateLimiter(requests_per_second)
+
+    def _fetch(self, product_code):
+        self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            result = self.fetch_fn(product_code)
+        except requests.HTTPError as e:
+            self.limiter.record(time.perf_counter() - start, status_code=e.response.status_code)
+            raise
+        except requests.RequestException:
+            self.limiter.record(time.perf_counter() - start, error=True)
+            raise
+        self.limiter.record(time.perf_counter() - start)
+        return result
+
+    def _collect(self, done, pending_codes, report):
+        for future in done:
+            product_code = pending_codes.pop(future)
+            try:
+                response = future.result()
+            except Exception as e:
+                logger.error(f"Failed to fetch product {product_code}: {e}")
+                # the body of an HTTP error response, or the document a JSONDecodeError could not decode
+                error_response = getattr(e, 'response', None)
+                payload = error_response.text if error_response is not None else getattr(e, 'doc', None)
+                self._fail(product_code, e, payload, report)
+                continue
+            try:
+                self.handle_fn(product_code, response)
+                report['succeeded'] += 1
+            except Exception as e:
+                logger.error(f"Failed to store product {product_code}: {e}")
+                self._fail(product_code, e, response, report)
+
+    def _fail(self, product_code, error, payload, report):
+        report['failed'] += 1
+        if self.error_fn:
+            self.error_fn(product_code, error, payload)
+
+    def run(self, product_codes: Iterable[str]) -> Dict:
+        """Fetches every product code and returns a throughput report."""
+        report = {'requested': 0, 'succeeded': 0, 'failed': 0}
+        start = time.perf_counter()
+        pending_codes = {}
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            for product_code in product_codes:
+                if len(pending_codes) >= self.max_in_flight:
+                    done, _ = wait(pending_codes, return_when=FIRST_COMPLETED)
+                    self._collect(done, pending_codes, report)
+                pending_codes[executor.submit(self._fetch, product_code)] = product_code
+                report['requested'] += 1
+            while pending_codes:
+                done, _ = wait(pending_codes, return_when=FIRST_COMPLETED)
+                self._collect(done, pending_codes, report)
+
+        report['elapsed_seconds'] = time.perf_counter() - start
+        report['products_per_second'] = report['succeeded'] / report['elapsed_seconds'] if report['elapsed_seconds'] else 0.0
+        logger.info(f"Fetched {report['succeeded']}/{report['requested']} products in "
+                    f"{report['elapsed_seconds']:.1f}s ({report['products_per_second']:.2f} products/s)")
+        return report
@@ -0,0 +1,195 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from contextlib import contextmanager
+from collections import deque
+from typing import Dict, Tuple
+import requests
+import os
+import threading
+import queue
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEADERS = {
+    'Content-Type': 'application/json',
+    'User-Agent': 'Mozilla/5.0'
+}
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+REQUEST_TIMEOUT = 30
+
+
+class SessionPool:
+    """Pool of keep-alive `requests` sessions shared by the crawl.
+
+    The site is visited once to collect cookies, and every session in the
+    pool reuses them along with its open connections. Idempotent requests are
+    retried with exponential backoff by urllib3, and the latency of every
+    request is recorded. Requests time out after `timeout` seconds unless
+    the caller passes its own, so a stalled socket cannot hold a session
+    forever. Pools whose requests go through an
+    AdaptiveRateLimiter should pass retry_status_codes=() so throttle
+    responses reach the limiter instead of being retried here.
+
+    Args:
+        base_url (str): site root used for the one-time warm-up request
+        size (int): number of sessions, should match the number of fetch threads
+        max_retries (int): retries for connection errors and retry_status_codes
+        backoff_factor (float): urllib3 backoff factor between retries
+        retry_status_codes (Tuple): response statuses retried by urllib3
+        timeout (float): default connect and read timeout of each request, in seconds
+    """
+    def __init__(self, base_url: str, size: int = 8, max_retries: int = 3, backoff_factor: float = 0.5,
+                 headers: Dict = None, retry_status_codes: Tuple = RETRY_STATUS_CODES,
+                 timeout: float = REQUEST_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.headers = headers or DEFAULT_HEADERS
+        self.sessions = queue.Queue()
+        self.warmed_up = False
+        self.warm_up_lock = threading.Lock()
+        self.latencies = deque(maxlen=100000)
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=retry_status_codes,
+                      allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+        self.all_sessions = []
+        for _ in range(size):
+            session = requests.Session()
+            session.headers.update(self.headers)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.sessions.put(session)
+            self.all_sessions.append(session)
+
+    def _warm_up(self, session):
+        """Visits the site once and shares the resulting cookies with every session."""
+        with self.warm_up_lock:
+            if self.warmed_up:
+                return
+            session.get(self.base_url, headers={'User-Agent': self.headers['User-Agent']},
+                        cookies={'cookie_name': 'cookie_value'}, timeout=self.timeout)
+            # borrowers block on this lock until warm-up ends, so no other session is mid-request
+            for other in self.all_sessions:
+                if other is not session:
+                    other.cookies.update(session.cookies)
+            self.warmed_up = True
+            logger.info(f"Session pool warmed up against {self.base_url}")
+
+    @contextmanager
+    def session(self):
+        """Borrows a warmed-up session, blocking until one is free."""
+        session = self.sessions.get()
+        try:
+            if not self.warmed_up:
+                self._warm_up(session)
+            yield session
+        finally:
+            self.sessions.put(session)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET through a pooled session, recording the request latency."""
+        kwargs.setdefault('timeout', self.timeout)
+        with self.session() as session:
+            start = time.perf_counter()
+            try:
+                return session.get(url, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+
+    def latency_summary(self) -> Dict:
+        """Returns count, mean and percentile latencies in seconds."""
+        samples = sorted(self.latencies)
+        if not samples:
+            return {'count': 0}
+        return {
+            'count': len(samples),
+            'mean': sum(samples) / len(samples),
+            'p50': samples[int(0.50 * (len(samples) - 1))],
+            'p95': samples[int(0.95 * (len(samples) - 1))],
+            'max': samples[-1]
+        }
+
+    def close(self):
+        for session in self.all_sessions:
+            session.close()
+
+
+class SwatchDownloader:
+    """Background image downloader with bounded concurrency.
+
+    Downloads run on `workers` threads, each with its own keep-alive session,
+    so queuing an image never blocks the API crawl unless `max_pending`
+    downloads are already waiting. Files already on disk (or already queued)
+    are skipped, and bodies are streamed to a `.part` file that is renamed
+    into place only once complete.
+
+    Args:
+        workers (int): number of concurrent downloads
+        max_pending (int): queued downloads before submit blocks
+    """
+    def __init__(self, workers: int = 4, max_pending: int = 1000, chunk_size: int = 64 * 1024):
+        self.chunk_size = chunk_size
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.stats = {'queued': 0, 'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def submit(self, url: str, path: str) -> bool:
+        """Queues url to be saved at path. Returns False if the file exists or is already queued."""
+        with self.lock:
+            if path in self.seen or os.path.exists(path):
+                self.stats['skipped'] += 1
+                return False
+            self.seen.add(path)
+            self.stats['queued'] += 1
+        self.pending.put((url, path))
+        return True
+
+    def _worker(self):
+        session = requests.Session()
+        session.headers.update({'User-Agent': DEFAULT_HEADERS['User-Agent']})
+        while True:
+            item = self.pending.get()
+            if item is None:
+                session.close()
+                return
+            url, path = item
+            try:
+                self._download(session, url, path)
+            except (requests.RequestException, OSError) as e:
+                logger.error(f"Failed to download {url}: {e}")
+                self._count('failed')
+
+    def _download(self, session, url, path):
+        with session.get(url, stream=True, timeout=30) as response:
+            if response.status_code != 200:
+                logger.error(f"Failed to download image {url}: HTTP {response.status_code}")
+                self._count('failed')
+                return
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            part_path = f"{path}.part"
+            size = 0
+            with open(part_path, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    file.write(chunk)
+                    size += len(chunk)
+            os.replace(part_path, path)
+        self._count('downloaded')
+        self._count('bytes', size)
+
+    def close(self) -> Dict:
+        """Waits for queued downloads to finish and returns download counts."""
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
+        logger.info(f"Swatch downloads finished: {self.stats}")
+        return dict(self.stats)
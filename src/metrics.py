@@ -0,0 +1,160 @@
+from contextlib import contextmanager
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict
+import threading
+import json
+import math
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+MAX_SAMPLES = 10000
+COUNTERS = (
+    ('crawl_stage_total', 'count', 'Stage executions'),
+    ('crawl_stage_errors_total', 'errors', 'Stage executions that raised'),
+    ('crawl_stage_bytes_total', 'bytes', 'Bytes transferred by the stage'),
+    ('crawl_stage_items_total', 'items', 'Items produced or written by the stage'),
+)
+
+
+class StageMetrics:
+    """Counts, errors, bytes and latency histogram for one crawl stage."""
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.items = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.samples = deque(maxlen=MAX_SAMPLES)
+
+    def observe(self, seconds, error=False, nbytes=0, items=0):
+        self.count += 1
+        self.errors += int(error)
+        self.bytes += nbytes
+        self.items += items
+        self.latency_sum += seconds
+        self.samples.append(seconds)
+        for i, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, q):
+        samples = sorted(self.samples)
+        return samples[int(q * (len(samples) - 1))] if samples else 0.0
+
+    def summary(self) -> Dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'error_rate': self.errors / self.count if self.count else 0.0,
+            'bytes': self.bytes,
+            'items': self.items,
+            'latency_seconds': {
+                'mean': self.latency_sum / self.count if self.count else 0.0,
+                'p50': self.percentile(0.50),
+                'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99),
+                'max': max(self.samples) if self.samples else 0.0,
+                'histogram': {('+Inf' if math.isinf(b) else str(b)): n for b, n in zip(LATENCY_BUCKETS, self.buckets)}
+            }
+        }
+
+
+class Measurement:
+    """Handle yielded by CrawlMetrics.measure so callers can attach bytes and item counts."""
+    def __init__(self):
+        self.bytes = 0
+        self.items = 0
+
+
+class CrawlMetrics:
+    """Thread-safe per-stage instrumentation for a crawl run.
+
+    Stages are timed with `measure`, which records latency, and counts the
+    stage as an error if the block raises. `write_report` saves the run
+    summary as JSON and as a Prometheus text-format file so throughput can be
+    compared between runs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.started_at = datetime.now(timezone.utc)
+            self.start = time.perf_counter()
+
+    def observe(self, stage: str, seconds: float, error: bool = False, nbytes: int = 0, items: int = 0):
+        with self.lock:
+            self.stages.setdefault(stage, StageMetrics()).observe(seconds, error, nbytes, items)
+
+    @contextmanager
+    def measure(self, stage: str):
+        measurement = Measurement()
+        start = time.perf_counter()
+        error = False
+        try:
+            yield measurement
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, error, measurement.bytes, measurement.items)
+
+    def summary(self) -> Dict:
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            return {
+                'started_at': self.started_at.isoformat(),
+                'elapsed_seconds': elapsed,
+                'stages': {
+                    stage: {**metrics.summary(), 'per_second': metrics.count / elapsed if elapsed else 0.0}
+                    for stage, metrics in self.stages.items()
+                }
+            }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            stages = list(self.stages.items())
+        for name, attribute, help_text in COUNTERS:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [f'{name}{{stage="{stage}"}} {getattr(metrics, attribute)}' for stage, metrics in stages]
+
+        lines += ["# HELP crawl_stage_latency_seconds Stage latency",
+                  "# TYPE crawl_stage_latency_seconds histogram"]
+        for stage, metrics in stages:
+            cumulative = 0
+            for upper_bound, n in zip(LATENCY_BUCKETS, metrics.buckets):
+                cumulative += n
+                le = '+Inf' if math.isinf(upper_bound) else str(upper_bound)
+                lines.append(f'crawl_stage_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'crawl_stage_latency_seconds_sum{{stage="{stage}"}} {metrics.latency_sum}')
+            lines.append(f'crawl_stage_latency_seconds_count{{stage="{stage}"}} {metrics.count}')
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, report_dir: str, extra: Dict = None) -> str:
+        """Writes crawl-<timestamp>.json and crawl-<timestamp>.prom, returns the JSON path."""
+        os.makedirs(report_dir, exist_ok=True)
+        name = f"crawl-{self.started_at.strftime('%Y%m%dT%H%M%SZ')}"
+        summary = self.summary()
+        if extra:
+            summary['run'] = extra
+        json_path = os.path.join(report_dir, f"{name}.json")
+        with open(json_path, 'w') as file:
+            json.dump(summary, file, indent=2, default=str)
+        with open(os.path.join(report_dir, f"{name}.prom"), 'w') as file:
+            file.write(self.to_prometheus())
+        logger.info(f"Crawl report written to {json_path}")
+        return json_path
+
+
+# shared by every module so one run report covers all stages
+crawl_metrics = CrawlMetrics()
@@ -0,0 +1,64 @@
+from typing import Dict, Optional, Tuple
+import re
+
+# metric units first, a size given in both systems is stored in its metric amount
+UNIT_ALIASES = {
+    'ml': ('ml', 1.0), 'l': ('ml', 1000.0),
+    'g': ('g', 1.0), 'kg': ('g', 1000.0), 'mg': ('g', 0.001),
+    'floz': ('oz', 1.0), 'oz': ('oz', 1.0), 'lb': ('lb', 1.0), 'lbs': ('lb', 1.0),
+}
+METRIC_UNITS = ('ml', 'g')
+PRICE_PATTERN = re.compile(r'(\d[\d,]*)(?:\.(\d{1,2}))?')
+SIZE_PATTERN = re.compile(r'(\d+(?:\.\d+)?|\.\d+)\s*(fl\.?\s*oz|ml|mg|kg|lbs?|oz|g|l)\b', re.IGNORECASE)
+MULTIPLIER_PATTERN = re.compile(r'^\s*(\d+)\s*x\s*(?=[\d.])', re.IGNORECASE)
+
+
+def parse_price_cents(price: str) -> Optional[int]:
+    """Parses a listPrice like "$42.00" or "$1,150.50" into integer cents, the first price of a range."""
+    if not price:
+        return None
+    match = PRICE_PATTERN.search(price)
+    if not match:
+        return None
+    dollars, cents = match.groups()
+    return int(dollars.replace(',', '')) * 100 + int((cents or '0').ljust(2, '0'))
+
+
+def parse_sizes(size: str) -> Dict[str, float]:
+    """Parses every amount in a size like "1.7 oz/ 50 mL" into {unit: amount}, e.g. {'oz': 1.7, 'ml': 50.0}.
+
+    Units are normalized to 'ml', 'g', 'oz' or 'lb' in the order the size gives them, the first amount
+    given in each unit is kept, and a leading "N x" pack multiplier is applied to every amount.
+    """
+    if not size:
+        return {}
+    multiplier = MULTIPLIER_PATTERN.match(size)
+    count = int(multiplier.group(1)) if multiplier else 1
+    amounts = {}
+    for amount, unit in SIZE_PATTERN.findall(size):
+        unit, scale = UNIT_ALIASES[re.sub(r'[\s.]', '', unit.lower())]
+        amounts.setdefault(unit, round(float(amount) * scale * count, 4))
+    return amounts
+
+
+def parse_size(size: str) -> Tuple[Optional[float], Optional[str]]:
+    """Parses a size like "1.7 oz/ 50 mL" or "4 x 0.25 oz/ 7 mL" into (amount, unit), see parse_sizes.
+
+    Metric amounts are preferred over oz and lb.
+
+    Returns:
+        (amount, unit), (None, None) when the size has no recognizable amount
+    """
+    amounts = parse_sizes(size)
+    if not amounts:
+        return None, None
+    unit = next((unit for unit in amounts if unit in METRIC_UNITS), next(iter(amounts)))
+    return amounts[unit], unit
+
+
+def typed_columns(price: str, size: str) -> Tuple:
+    """Returns the PRODUCT_DETAILS_TYPED_COLUMNS values parsed from a SKU's price and size text."""
+    price_cents = parse_price_cents(price)
+    size_amount, size_unit = parse_size(size)
+    unit_price_cents = price_cents / size_amount if price_cents is not None and size_amount else None
+    return price_cents, size_amount, size_unit, unit_price_cents
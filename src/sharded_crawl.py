@@ -0,0 +1,244 @@
+from typing import Dict, List
+import multiprocessing
+import argparse
+import queue
+import logging
+import requests
+from archive import ResponseArchive
+from driver_util import DriverPool, ChromeDriverFactory
+from fetcher import ConcurrentProductFetcher
+from http_util import SessionPool, SwatchDownloader
+from db_util import (configure_logging, connections, mark_crawl_completed, get_crawl_completed, dead_letter_row,
+                     record_dead_letters, clear_dead_letters)
+from metrics import crawl_metrics
+from webscraper import (BASE_URL, MAX_IN_FLIGHT, REQUESTS_PER_SECOND, PAGES_PER_DRIVER, ARCHIVE_DIR, REPORT_DIR,
+                        BRAND_PAGES_PHASE, PRODUCT_DETAILS_PHASE, BrandPageScraper, ProductScraper, create_tables,
+                        crawl_brand_list, get_remaining_product_codes, store_brand_products, dead_letter_payload,
+                        create_browser_limiter)
+
+logger = logging.getLogger(__name__)
+
+WRITE_QUEUE_SIZE = 1000
+
+
+def store_product(db_file, product_code, rows, payload=None):
+    """Stores one product's rows and checkpoint, a failed write is dead-lettered with the response body payload."""
+    try:
+        ProductScraper.store_product_records(db_file, rows)
+        mark_crawl_completed(db_file, PRODUCT_DETAILS_PHASE, [product_code])
+        clear_dead_letters(db_file, [product_code])
+    except Exception as e:
+        logger.error(f"Writer failed to store product {product_code}: {e}")
+        record_dead_letters(db_file, [dead_letter_row(product_code, PRODUCT_DETAILS_PHASE, e, payload)])
+
+
+# messages the writer process accepts, (kind, args)
+WRITERS = {
+    'brand_products': store_brand_products,
+    'product': store_product,
+    'dead_letters': record_dead_letters,
+}
+
+
+def shard(items: List, shards: int) -> List[List]:
+    """Splits items round robin into at most `shards` non-empty lists."""
+    return [items[i::shards] for i in range(shards) if items[i::shards]]
+
+
+def _writer(db_file, write_queue, flushed):
+    """Single writer process: the only process that writes to db_file."""
+    while True:
+        message = write_queue.get()
+        if message is None:
+            connections.close_all()
+            return
+        kind, args = message
+        if kind == 'flush':
+            flushed.set()
+            continue
+        try:
+            WRITERS[kind](db_file, *args)
+        except Exception as e:
+            logger.error(f"Writer failed to store {kind}: {e}")
+
+
+def _brand_worker(brands, write_queue, lean_browser, browser_shards):
+    driver_pool = DriverPool(ChromeDriverFactory(lean=lean_browser), size=1, max_pages_per_driver=PAGES_PER_DRIVER)
+    # the page load budget is shared by every brand worker, like the request budget by product workers
+    limiter = create_browser_limiter(browser_shards)
+    try:
+        for brand, product_urls in BrandPageScraper(driver_pool, limiter).scrape_brands(brands, workers=1):
+            write_queue.put(('brand_products', (brand, product_urls)))
+    finally:
+        driver_pool.close()
+
+
+def _product_worker(worker_id, product_codes, write_queue, result_queue, base_url, max_in_flight,
+                    requests_per_second, archive_dir, save_swatch, projection):
+    session_pool = SessionPool(base_url, size=max_in_flight, retry_status_codes=())
+    archive = ResponseArchive(archive_dir, writer_id=f"w{worker_id}") if archive_dir else None
+    swatch_downloader = SwatchDownloader() if save_swatch else None
+
+    def handle(product_code, response):
+        with crawl_metrics.measure('compress_product_data') as measurement:
+            rows = list(ProductScraper.iter_product_rows(response.data, save_swatch, swatch_downloader))
+            measurement.items = len(rows)
+        write_queue.put(('product', (product_code, rows, dead_letter_payload(response))))
+
+    def dead_letter(product_code, error, payload):
+        stage = 'product_api' if isinstance(error, requests.RequestException) else PRODUCT_DETAILS_PHASE
+        row = dead_letter_row(product_code, stage, error, dead_letter_payload(payload))
+        write_queue.put(('dead_letters', ([row],)))
+
+    fetcher = ConcurrentProductFetcher(
+        fetch_fn=lambda product_code: ProductScraper.fetch_product_response(product_code, base_url, session_pool,
+                                                                            projection, archive),
+        handle_fn=handle,
+        max_in_flight=max_in_flight,
+        requests_per_second=requests_per_second,
+        error_fn=dead_letter
+    )
+    try:
+        report = fetcher.run(product_codes)
+    finally:
+        session_pool.close()
+        if archive:
+            archive.close()
+        if swatch_downloader:
+            swatch_downloader.close()
+    report['stages'] = crawl_metrics.summary()['stages']
+    result_queue.put(report)
+
+
+class ShardedCrawl:
+    """Crawl split across worker processes with one database writer process.
+
+    Brand pages and product codes are sharded across `shards` worker
+    processes, each with its own driver or session pool. Workers never touch
+    the database; they send rows through a bounded queue to a single writer
+    process, so SQLite never sees concurrent writers. The global
+    requests-per-second budget is divided evenly between product workers,
+    and the browser page load budget between brand workers.
+    Brand workers use the lean browser profile unless lean_browser is False,
+    product workers make trimmed API requests with projection.
+
+    Usage:
+        with ShardedCrawl(db_file, shards=4) as crawl:
+            crawl.crawl_brand_pages(brands)
+            report = crawl.crawl_product_details()
+    """
+    def __init__(self, db_file: str, shards: int, base_url: str = BASE_URL, max_in_flight: int = MAX_IN_FLIGHT,
+                 requests_per_second: float = REQUESTS_PER_SECOND, archive_dir: str = None, save_swatch: bool = False,
+                 lean_browser: bool = True, projection: bool = False):
+        self.db_file = db_file
+        self.shards = shards
+        self.base_url = base_url
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+        self.archive_dir = archive_dir
+        self.save_swatch = save_swatch
+        self.lean_browser = lean_browser
+        self.projection = projection
+        self.context = multiprocessing.get_context()
+        self.write_queue = self.context.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.flushed = self.context.Event()
+        self.writer = None
+
+    def __enter__(self):
+        self.writer = self.context.Process(target=_writer, args=(self.db_file, self.write_queue, self.flushed),
+                                           name="db-writer")
+        self.writer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.write_queue.put(None)
+        self.writer.join()
+
+    def flush(self):
+        """Blocks until the writer has stored every row queued so far."""
+        self.flushed.clear()
+        self.write_queue.put(('flush', None))
+        self.flushed.wait()
+
+    def _run_workers(self, target, shards, extra_args=()):
+        processes = [self.context.Process(target=target, args=(*args, *extra_args)) for args in shards]
+        for process in processes:
+            process.start()
+        return processes
+
+    def crawl_brand_pages(self, brands: List[Dict]):
+        """Phase 2: scrapes brand pages not yet crawled, one driver per worker process."""
+        completed = get_crawl_completed(self.db_file, BRAND_PAGES_PHASE)
+        remaining = [brand for brand in brands if brand['brand_url'] not in completed]
+        logger.info(f"{len(remaining)} of {len(brands)} brand pages left to scrape across {self.shards} workers")
+        brand_shards = shard(remaining, self.shards)
+        processes = self._run_workers(_brand_worker, [(brands,) for brands in brand_shards],
+                                      (self.write_queue, self.lean_browser, len(brand_shards)))
+        for process in processes:
+            process.join()
+        self.flush()
+
+    def crawl_product_details(self) -> Dict:
+        """Phase 3: fetches remaining product details across worker processes, returns the combined report."""
+        product_shards = shard(get_remaining_product_codes(self.db_file), self.shards)
+        if not product_shards:
+            return {'requested': 0, 'succeeded': 0, 'failed': 0, 'workers': []}
+        result_queue = self.context.Queue()
+        processes = self._run_workers(
+            _product_worker,
+            [(i, product_codes) for i, product_codes in enumerate(product_shards)],
+            (self.write_queue, result_queue, self.base_url, self.max_in_flight,
+             self.requests_per_second / len(product_shards), self.archive_dir, self.save_swatch,
+             self.projection)
+        )
+        worker_reports = []
+        while len(worker_reports) < len(processes):
+            try:
+                worker_reports.append(result_queue.get(timeout=1))
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes) and result_queue.empty():
+                    logger.error(f"{len(processes) - len(worker_reports)} product workers exited without a report")
+                    break
+        for process in processes:
+            process.join()
+        self.flush()
+
+        report = {key: sum(worker[key] for worker in worker_reports) for key in ('requested', 'succeeded', 'failed')}
+        report['elapsed_seconds'] = max((worker['elapsed_seconds'] for worker in worker_reports), default=0.0)
+        report['products_per_second'] = report['succeeded'] / report['elapsed_seconds'] if report['elapsed_seconds'] else 0.0
+        report['workers'] = worker_reports
+        logger.info(f"Sharded crawl fetched {report['succeeded']}/{report['requested']} products "
+                    f"({report['products_per_second']:.2f} products/s)")
+        return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Sharded crawl across worker processes with a single DB writer.")
+    parser.add_argument("--db-file", default="data/db/products.db")
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    parser.add_argument("--report-dir", default=REPORT_DIR)
+    parser.add_argument("--full-browser", action="store_true",
+                        help="load images, fonts and trackers on brand pages instead of the lean browser profile")
+    parser.add_argument("--projection", action="store_true",
+                        help="request trimmed product API responses and keep only the fields product_details needs")
+    args = parser.parse_args()
+
+    configure_logging()
+    create_tables(args.db_file)
+
+    # the brand list is a single page, scraped before the writer process starts
+    driver_pool = DriverPool(ChromeDriverFactory(lean=not args.full_browser), size=1,
+                             max_pages_per_driver=PAGES_PER_DRIVER)
+    try:
+        brand_urls = crawl_brand_list(args.db_file, driver_pool)
+    finally:
+        driver_pool.close()
+
+    with ShardedCrawl(args.db_file, args.shards, archive_dir=args.archive_dir, save_swatch=True,
+                      lean_browser=not args.full_browser, projection=args.projection) as crawl:
+        crawl.crawl_brand_pages(brand_urls)
+        report = crawl.crawl_product_details()
+    connections.close_all()
+    crawl_metrics.write_report(args.report_dir, extra=report)
@@ -0,0 +1,80 @@
+from xml.etree.ElementTree import XMLPullParser, ParseError
+from typing import Iterator, List, Tuple
+import zlib
+import logging
+from http_util import SessionPool
+from metrics import crawl_metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+SITEMAP_ENTRY = 'sitemap'
+URL_ENTRY = 'url'
+
+
+def local_name(tag: str) -> str:
+    """Strips the XML namespace, '{http://www.sitemaps.org/...}loc' becomes 'loc'."""
+    return tag.rsplit('}', 1)[-1]
+
+
+class SitemapReader:
+    """Streams sitemap and sitemap index files over HTTP.
+
+    Files are parsed incrementally as chunks arrive, gzipped `.xml.gz`
+    files are decompressed on the fly, and parsed elements are dropped as
+    soon as their `<loc>` is yielded, so memory stays flat however large the
+    sitemap is.
+
+    Args:
+        session_pool (SessionPool): pool used for the requests, shares cookies with the API fetcher
+        chunk_size (int): bytes read from the response at a time
+    """
+    def __init__(self, session_pool: SessionPool, chunk_size: int = CHUNK_SIZE):
+        self.session_pool = session_pool
+        self.chunk_size = chunk_size
+
+    def find_sitemaps(self, base_url: str) -> List[str]:
+        """Returns the sitemaps listed in robots.txt, or /sitemap.xml when none are listed."""
+        response = self.session_pool.get(f"{base_url}/robots.txt")
+        sitemaps = []
+        if response.status_code == 200:
+            sitemaps = [line.split(':', 1)[1].strip() for line in response.text.splitlines()
+                        if line.lower().startswith('sitemap:')]
+        return sitemaps or [f"{base_url}/sitemap.xml"]
+
+    def iter_entries(self, sitemap_url: str) -> Iterator[Tuple[str, str]]:
+        """Yields (SITEMAP_ENTRY or URL_ENTRY, loc) for each entry of one sitemap file, as it is parsed."""
+        parser = XMLPullParser(events=('start', 'end'))
+        root = None
+        entries = 0
+        with crawl_metrics.measure('sitemap') as measurement, self.session_pool.session() as session:
+            with session.get(sitemap_url, stream=True, timeout=self.session_pool.timeout) as response:
+                response.raise_for_status()
+                decompressor = None
+                for chunk in response.iter_content(self.chunk_size):
+                    if not measurement.bytes and chunk.startswith(GZIP_MAGIC):
+                        # .xml.gz files are served as is, not with a gzip Content-Encoding
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    measurement.bytes += len(chunk)
+                    parser.feed(decompressor.decompress(chunk) if decompressor else chunk)
+                    for event, element in parser.read_events():
+                        if root is None:
+                            root = element
+                            continue
+                        if event != 'end':
+                            continue
+                        kind = local_name(element.tag)
+                        if kind in (SITEMAP_ENTRY, URL_ENTRY):
+                            loc = next((child.text for child in element if local_name(child.tag) == 'loc'), None)
+                            if loc:
+                                entries += 1
+                                yield kind, loc.strip()
+                            # drop parsed entries so the tree never holds more than one chunk
+                            root.clear()
+            try:
+                parser.close()
+            except ParseError as e:
+                logger.error(f"Truncated sitemap {sitemap_url}: {e}")
+            measurement.items = entries
+        logger.info(f"Read {entries} entries from sitemap {sitemap_url}")
@@ -0,0 +1,280 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, Optional
+from urllib.parse import parse_qs
+import threading
+import random
+import json
+import time
+import glob
+import gzip
+import html
+import os
+import logging
+from archive import ResponseArchive
+from webscraper import PRODUCT_API_PATH
+
+logger = logging.getLogger(__name__)
+
+BRAND_LIST_PATH = "/ca/en/brands-list"
+BRAND_PATH = "/ca/en/brand/"
+PRODUCT_PATH = "/ca/en/product/"
+SITEMAP_INDEX_PATH = "/sitemap_index.xml"
+SITEMAP_PATH = "/sitemaps/products-"
+SITEMAP_URLS_PER_FILE = 1000
+BRAND_LIST_FILE = "brands-list.html"
+BRANDS_DIR = "brands"
+PRODUCTS_DIR = "products"
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+# product API response fields served only when their query parameter is true, like the live API
+OPTIONAL_PRODUCT_FIELDS = {'ratingsAndReviews': 'includeRnR', 'regionsMap': 'includeRegionsMap'}
+REGIONS = ('CA-AB', 'CA-BC', 'CA-MB', 'CA-NB', 'CA-NL', 'CA-NS', 'CA-NT', 'CA-NU', 'CA-ON', 'CA-PE', 'CA-QC', 'CA-SK',
+           'CA-YT')
+
+
+def make_fixture_sku(sku_id: str, price: float) -> Dict:
+    return {
+        'skuId': sku_id, 'brandName': 'Fixture Brand', 'isLimitedEdition': False, 'isFirstAccess': False,
+        'isLimitedTimeOffer': False, 'isNew': False, 'isOnlineOnly': False, 'isOnlyFewLeft': False,
+        'isOutOfStock': False, 'listPrice': f'${price:.2f}', 'maxPurchaseQuantity': 10, 'size': '1 oz/ 30 mL',
+        'type': 'Standard', 'url': f'/ca/en/product/fixture?skuId={sku_id}', 'isReturnable': True,
+        'refinements': {'finishRefinements': ['Natural']}
+    }
+
+
+def make_fixture_review(product_code: str, n: int) -> Dict:
+    return {
+        'reviewId': f'{product_code}-R{n}', 'rating': n % 5 + 1, 'isRecommended': n % 3 != 0,
+        'title': f'Review {n} of {product_code}', 'reviewText': 'Lovely texture, lasts all day. ' * 12,
+        'userNickname': f'reviewer{n}', 'submissionTime': '2024-01-01T00:00:00Z',
+        'contextDataValues': {'skinType': 'combination', 'eyeColor': 'brown', 'hairColor': 'black'}
+    }
+
+
+def make_fixture_product(product_code: str, brand_id: str, skus: int = 3, reviews: int = 20) -> Dict:
+    """Builds a product API response with the fields the crawler reads, plus the heavy
+    OPTIONAL_PRODUCT_FIELDS it does not read: `reviews` reviews and a per-region stock map."""
+    sku_ids = [f'{product_code}{i}' for i in range(1, skus + 1)]
+    return {
+        'productId': product_code,
+        'targetUrl': f'{PRODUCT_PATH}fixture-{product_code.lower()}-{product_code}',
+        'fullSiteProductUrl': f'{PRODUCT_PATH}fixture-{product_code.lower()}-{product_code}',
+        'productDetails': {
+            'displayName': f'Fixture {product_code}', 'brand': {'brandId': brand_id}, 'lovesCount': 100,
+            'rating': 4.5, 'reviews': 20, 'shortDescription': 'Short description.',
+            'longDescription': 'Long description. ' * 20, 'suggestedUsage': 'Apply daily.',
+            'imageAltText': f'Fixture {product_code} product image'
+        },
+        'parentCategory': {'categoryId': 'cat2', 'displayName': 'Moisturizers', 'targetUrl': '/shop/moisturizer',
+                           'parentCategory': {'categoryId': 'cat1', 'displayName': 'Skincare',
+                                              'targetUrl': '/shop/skincare'}},
+        'currentSku': make_fixture_sku(f'{product_code}1', 10.0),
+        'regularChildSkus': [make_fixture_sku(f'{product_code}{i}', 10.0 * i) for i in range(2, skus + 1)],
+        'ratingsAndReviews': {
+            'reviewCount': reviews,
+            'reviews': [make_fixture_review(product_code, n) for n in range(reviews)]
+        },
+        'regionsMap': {region: {sku_id: {'isOutOfStock': False, 'isOnlyFewLeft': False} for sku_id in sku_ids}
+                       for region in REGIONS}
+    }
+
+
+class FixtureSite:
+    """Recorded pages and API responses served by the stub server.
+
+    A fixture directory holds `brands-list.html`, one `brands/<slug>.html`
+    brand grid page per brand and one `products/<product_code>.json` API
+    response per product. Pages saved from the live site can be dropped in
+    as is, `generate` builds a synthetic set of any size. Product codes
+    missing from `products` are built by `product_factory` when one is
+    given, a factory returning None answers that product with a 404.
+    """
+    def __init__(self, brand_list: str, brand_pages: Dict[str, str], products: Dict[str, bytes],
+                 product_factory: Callable[[str], Optional[Dict]] = None):
+        self.brand_list = brand_list
+        self.brand_pages = brand_pages
+        self.products = products
+        self.product_factory = product_factory
+        self.trimmed_products = {}
+
+    @classmethod
+    def load(cls, fixture_dir: str, archive_dir: str = None) -> 'FixtureSite':
+        """Reads a fixture directory, optionally adding product responses recorded in a ResponseArchive."""
+        with open(os.path.join(fixture_dir, BRAND_LIST_FILE)) as file:
+            brand_list = file.read()
+        brand_pages = {}
+        for path in glob.glob(os.path.join(fixture_dir, BRANDS_DIR, "*.html")):
+            with open(path) as file:
+                brand_pages[os.path.splitext(os.path.basename(path))[0]] = file.read()
+        products = {}
+        for path in glob.glob(os.path.join(fixture_dir, PRODUCTS_DIR, "*.json")):
+            with open(path, 'rb') as file:
+                products[os.path.splitext(os.path.basename(path))[0]] = file.read()
+        if archive_dir:
+            for product_code, data in ResponseArchive(archive_dir).replay():
+                products[product_code] = json.dumps(data).encode()
+        logger.info(f"Loaded fixtures: {len(brand_pages)} brand pages, {len(products)} products")
+        return cls(brand_list, brand_pages, products)
+
+    @classmethod
+    def generate(cls, brands: int = 10, products_per_brand: int = 20, skus_per_product: int = 3,
+                 reviews_per_product: int = 20) -> 'FixtureSite':
+        """Builds a synthetic site with `brands` brand pages of `products_per_brand` products each."""
+        brand_links = []
+        brand_pages = {}
+        products = {}
+        for b in range(brands):
+            slug = f'fixture-brand-{b}'
+            brand_links.append(f'<a data-at="brand_link" href="{BRAND_PATH}{slug}"><span>Fixture Brand {b}</span></a>')
+            tiles = []
+            for p in range(products_per_brand):
+                product_code = f'P{b:04d}{p:04d}'
+                data = make_fixture_product(product_code, str(b), skus_per_product, reviews_per_product)
+                products[product_code] = json.dumps(data).encode()
+                tiles.append(f'<a href="{data["targetUrl"]}?skuId={product_code}1">{html.escape(product_code)}</a>')
+            brand_pages[slug] = f"<html><body>{''.join(tiles)}</body></html>"
+        return cls(f"<html><body>{''.join(brand_links)}</body></html>", brand_pages, products)
+
+    def save(self, fixture_dir: str):
+        os.makedirs(os.path.join(fixture_dir, BRANDS_DIR), exist_ok=True)
+        os.makedirs(os.path.join(fixture_dir, PRODUCTS_DIR), exist_ok=True)
+        with open(os.path.join(fixture_dir, BRAND_LIST_FILE), 'w') as file:
+            file.write(self.brand_list)
+        for slug, page in self.brand_pages.items():
+            with open(os.path.join(fixture_dir, BRANDS_DIR, f"{slug}.html"), 'w') as file:
+                file.write(page)
+        for product_code, body in self.products.items():
+            with open(os.path.join(fixture_dir, PRODUCTS_DIR, f"{product_code}.json"), 'wb') as file:
+                file.write(body)
+
+    def product_urls(self):
+        return [json.loads(body).get('targetUrl', "") for body in self.products.values()]
+
+    def render_sitemap_index(self, base_url: str) -> str:
+        files = (len(self.products) + SITEMAP_URLS_PER_FILE - 1) // SITEMAP_URLS_PER_FILE
+        sitemaps = ''.join(f'<sitemap><loc>{base_url}{SITEMAP_PATH}{n}.xml.gz</loc></sitemap>' for n in range(files))
+        return f'<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="{SITEMAP_NS}">{sitemaps}</sitemapindex>'
+
+    def render_sitemap(self, base_url: str, n: int) -> str:
+        product_urls = self.product_urls()[n * SITEMAP_URLS_PER_FILE:(n + 1) * SITEMAP_URLS_PER_FILE]
+        urls = ''.join(f'<url><loc>{base_url}{html.escape(url)}</loc></url>' for url in product_urls)
+        return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{SITEMAP_NS}">{urls}</urlset>'
+
+    def product_response(self, product_code: str, query: str = "") -> bytes:
+        """Returns a product API response body, without the OPTIONAL_PRODUCT_FIELDS the query does not ask for."""
+        body = self.products.get(product_code)
+        if body is None and self.product_factory:
+            data = self.product_factory(product_code)
+            body = json.dumps(data).encode() if data is not None else None
+        params = parse_qs(query)
+        omitted = tuple(field for field, param in OPTIONAL_PRODUCT_FIELDS.items() if params.get(param) != ['true'])
+        if body is None or not omitted:
+            return body
+        key = (product_code, omitted)
+        if key not in self.trimmed_products:
+            data = json.loads(body)
+            for field in omitted:
+                data.pop(field, None)
+            self.trimmed_products[key] = json.dumps(data).encode()
+        return self.trimmed_products[key]
+
+    def route(self, path: str, base_url: str = ""):
+        """Returns (content_type, body) for a request path, or None when the path is unknown.
+
+        Sitemaps are rendered from the product responses, with absolute urls on base_url.
+        """
+        path, _, query = path.partition('?')
+        if path == '/robots.txt':
+            return 'text/plain', f"User-agent: *\nSitemap: {base_url}{SITEMAP_INDEX_PATH}\n".encode()
+        if path == SITEMAP_INDEX_PATH:
+            return 'application/xml', self.render_sitemap_index(base_url).encode()
+        if path.startswith(SITEMAP_PATH) and path.endswith('.xml.gz'):
+            return 'application/x-gzip', gzip.compress(self.render_sitemap(base_url, int(path[len(SITEMAP_PATH):-7])).encode())
+        if path.startswith(PRODUCT_API_PATH):
+            body = self.product_response(path[len(PRODUCT_API_PATH):], query)
+            return ('application/json', body) if body is not None else None
+        if path.rstrip('/') == BRAND_LIST_PATH:
+            return 'text/html', self.brand_list.encode()
+        if path.startswith(BRAND_PATH):
+            page = self.brand_pages.get(path[len(BRAND_PATH):].rstrip('/'))
+            return ('text/html', page.encode()) if page is not None else None
+        return 'text/html', b'<html></html>'
+
+
+class StubServer:
+    """Serves a FixtureSite on localhost with injected latency.
+
+    Every response is delayed by `latency` seconds plus up to `jitter`
+    seconds drawn uniformly, and `error_rate` of product API requests are
+    answered with `error_status`, a 503 by default, so throughput can be
+    measured under conditions close to the live site without touching it.
+
+    Usage:
+        with StubServer(FixtureSite.generate(), latency=0.05) as server:
+            crawl_product_details(db_file, base_url=server.url)
+    """
+    def __init__(self, site: FixtureSite, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 port: int = 0, error_status: int = 503):
+        self.site = site
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = None
+
+    def _handler(self):
+        stub = self
+
+        class FixtureHandler(BaseHTTPRequestHandler):
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client hung up first, a timed out or cancelled request
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                delay = stub.latency + random.uniform(0, stub.jitter)
+                if delay:
+                    time.sleep(delay)
+                response = stub.site.route(self.path, stub.url)
+                if response is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if self.path.startswith(PRODUCT_API_PATH) and random.random() < stub.error_rate:
+                    self.send_response(stub.error_status)
+                    self.end_headers()
+                    return
+                content_type, body = response
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return FixtureHandler
+
+    def start(self) -> 'StubServer':
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stub-server", daemon=True)
+        self.thread.start()
+        logger.info(f"Stub server listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
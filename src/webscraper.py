@@ -1,95 +1,272 @@
 from bs4 import BeautifulSoup
 from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-from selenium import webdriver
 from urllib.parse import parse_qs, urlparse
+from xml.etree.ElementTree import ParseError
 import requests
 import selenium
-from datetime import datetime
-from typing import List, Tuple, Dict
+from datetime import datetime, timezone
+from typing import List, Tuple, Dict, NamedTuple
 import json
+import hashlib
+import itertools
 import re
 import time
-import sqlite3
+import threading
 import os
+import argparse
 import logging
-from db_util import (execute_query, insert_product_details, insert_brand_products, insert_brands_data,
-                    create_brands_table_query, create_products_table_query, create_product_details_table_query)
+from fetcher import ConcurrentProductFetcher, AdaptiveRateLimiter
+from http_util import SessionPool, SwatchDownloader
+from driver_util import DriverPool, ChromeDriverFactory, BROWSER_CACHE_DIR
+from archive import ResponseArchive
+from sitemap import SitemapReader, SITEMAP_ENTRY
+from metrics import crawl_metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from db_util import (configure_logging, connections, execute_query, select_query, insert_product_detail_rows,
+                    insert_brand_products, insert_brands_data, mark_crawl_completed, get_crawl_completed,
+                    reset_crawl_state, migrate, background_writes, write_unit, get_content_hashes, save_content_hashes,
+                    dead_letter_row, record_dead_letters, clear_dead_letters, get_due_dead_letters,
+                    get_next_dead_letter_retry, get_last_price_history_id, stamp_price_history,
+                    PRODUCT_DETAILS_COLUMNS, PRODUCT_RECORD_KEYS,
+                    create_brands_table_query, create_products_table_query, create_product_details_table_query,
+                    create_crawl_state_table_query, create_product_hashes_table_query, create_sku_hashes_table_query)
 
 logger = logging.getLogger(__name__)
 
 BASE_URL = 'https://www.sephora.com'
 CRAWL_DELAY=5
-SCROLL_PAUSE_TIME = 0.2
+SCROLL_AMOUNT = 1000
+TILE_SETTLE_TIME = 0.3
+TILE_SETTLE_LIMIT = 2.0
+TILE_WAIT_TIMEOUT = 10.0
 CLICK_DELAY = 0.2
+PRODUCT_TILE_HREF = '/ca/en/product/'
 DRIVER_PATH = '../../../chrome-mac-x64/chromedriver'
 DATA_DIR = "data/"
-
-options = Options()
-options.add_argument("--headless")
-options.add_argument("--disable-gpu")
-options.add_argument("--no-sandbox")
-options.add_argument("--disable-dev-shm-usage")
-options.add_experimental_option("excludeSwitches", ["enable-automation"])
-options.add_experimental_option('useAutomationExtension', False)
-user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.50 Safari/537.36'
-options.add_argument('user-agent={0}'.format(user_agent))
-driver = webdriver.Chrome(options=options)
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,  # Set to DEBUG for more detailed logs
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("db_operations.log"),  # Logs to a file
-        logging.StreamHandler()  # Logs to the console
-    ]
-)
+ARCHIVE_DIR = "data/archive/"
+REPORT_DIR = "data/reports/"
+PRODUCT_API_PATH = "/api/v3/catalog/products/"
+MAX_IN_FLIGHT = 8
+REQUESTS_PER_SECOND = 2.0
+BROWSER_POOL_SIZE = 2
+BROWSER_PAGES_PER_SECOND = 1.0
+BROWSER_TARGET_LATENCY = 10.0
+PAGES_PER_DRIVER = 25
+MAX_RETRY_ATTEMPTS = 5
+MAX_RETRY_WAIT = 15 * 60
+SITEMAP_BATCH_SIZE = 500
+PRODUCT_URL_PATH = '/product/'
+BRAND_LIST_URL = 'https://www.sephora.com/ca/en/brands-list'
+
+# crawl phases checkpointed in the crawl_state table
+BRAND_LIST_PHASE = 'brand_list'
+BRAND_PAGES_PHASE = 'brand_pages'
+SITEMAP_PHASE = 'sitemap'
+PRODUCT_DETAILS_PHASE = 'product_details'
+
+CATEGORY_KEYS = ('categoryId', 'displayName', 'targetUrl')
+
+PRODUCT_API_QUERY = ("addCurrentSkuToProductChildSkus=true&includeRegionsMap=true&showContent=true&includeConfigurableSku=true"
+                     "&countryCode=CA&removePersonalizedData=true&includeReviewFilters=true&includeReviewImages=false"
+                     "&includeRnR=true&loc=en-CA&ch=rwd&sentiments=6")
+# smallest request that still fills product_details: no reviews, review filters, sentiments or regions map
+PRODUCT_API_PROJECTED_QUERY = ("addCurrentSkuToProductChildSkus=true&showContent=true&includeConfigurableSku=true"
+                               "&countryCode=CA&removePersonalizedData=true&includeRnR=false&loc=en-CA&ch=rwd")
+
+# Fields of a product API response read by iter_product_rows and the swatch download. A None leaf keeps the
+# whole value, dicts are projected key by key, lists item by item.
+SKU_PROJECTION = {key: None for key in (
+    'skuId', 'brandName', 'ingredientDesc', 'isLimitedEdition', 'isFirstAccess', 'isLimitedTimeOffer', 'isNew',
+    'isOnlineOnly', 'isOnlyFewLeft', 'isOutOfStock', 'listPrice', 'maxPurchaseQuantity', 'size', 'type', 'url',
+    'variationType', 'variationValue', 'isReturnable'
+)}
+SKU_PROJECTION['refinements'] = {'finishRefinements': None, 'sizeRefinements': None}
+SKU_PROJECTION['skuImages'] = {'image250': None}
+CATEGORY_PROJECTION = {key: None for key in CATEGORY_KEYS}
+CATEGORY_PROJECTION['parentCategory'] = CATEGORY_PROJECTION
+PRODUCT_PROJECTION = {
+    'targetUrl': None,
+    'fullSiteProductUrl': None,
+    'productId': None,
+    'productDetails': {
+        'displayName': None, 'lovesCount': None, 'rating': None, 'reviews': None, 'brand': {'brandId': None},
+        'shortDescription': None, 'longDescription': None, 'suggestedUsage': None
+    },
+    'parentCategory': CATEGORY_PROJECTION,
+    'currentSku': SKU_PROJECTION,
+    'regularChildSkus': SKU_PROJECTION,
+}
+PRODUCT_CODE_INDEX = PRODUCT_DETAILS_COLUMNS.index('product_code')
+SKU_ID_INDEX = PRODUCT_DETAILS_COLUMNS.index('sku_id')
+
+# Async script run once per scroll step of a brand page. Arguments: href substring of product tiles,
+# y to scroll to, whether to click "Show More Products", settle, settle limit and timeout in ms. It
+# resolves as soon as new tiles appear, when no element has been added for the settle time (unless it
+# clicked), or at the timeout, with the hrefs not returned before on this page, the page height and
+# whether a "Show More Products" button is left. Text and attribute churn, e.g. from countdowns, does
+# not restart the settle time, and elements added elsewhere, e.g. by carousels, only extend it up to
+# the settle limit.
+COLLECT_NEW_TILES_SCRIPT = """
+const [hrefPart, scrollTo, click, settleMs, settleLimitMs, timeoutMs, done] = arguments;
+const seen = window.__crawlSeenHrefs || (window.__crawlSeenHrefs = new Set());
+const tiles = () => document.querySelectorAll(`a[href*="${hrefPart}"]`);
+const showMore = () => Array.from(document.querySelectorAll('button'))
+    .find(button => button.textContent.trim() === 'Show More Products');
+const tileCount = tiles().length;
+let finished = false, settleTimer = null, timeoutTimer = null, observer = null;
+const finish = () => {
+    if (finished) return;
+    finished = true;
+    observer.disconnect();
+    clearTimeout(settleTimer);
+    clearTimeout(timeoutTimer);
+    const urls = [];
+    for (const tile of tiles()) {
+        if (!seen.has(tile.href)) {
+            seen.add(tile.href);
+            urls.push(tile.href);
+        }
+    }
+    done({urls: urls, height: document.body.scrollHeight, has_more: Boolean(showMore())});
+};
+const settleUntil = Date.now() + settleLimitMs;
+const settle = () => {
+    clearTimeout(settleTimer);
+    settleTimer = setTimeout(finish, Math.max(0, Math.min(settleMs, settleUntil - Date.now())));
+};
+let button = null;
+observer = new MutationObserver(mutations => {
+    if (tiles().length > tileCount) return finish();
+    // after a click, wait for the new tiles themselves rather than a quiet DOM
+    if (button) return;
+    const addedElement = mutations.some(mutation =>
+        Array.from(mutation.addedNodes).some(node => node.nodeType === Node.ELEMENT_NODE));
+    if (addedElement) settle();
+});
+observer.observe(document.body, {childList: true, subtree: true});
+window.scrollTo(0, scrollTo);
+button = click ? showMore() : null;
+if (button) button.click();
+else settle();
+timeoutTimer = setTimeout(finish, timeoutMs);
+"""
+
+_session_pools = {}
+_session_pools_lock = threading.Lock()
+
+
+def get_session_pool(base_url=BASE_URL, size=MAX_IN_FLIGHT):
+    """Returns the shared, pre-warmed pool of `size` sessions for base_url, creating it on first use.
+
+    `size` should match the number of requests in flight, extra requests wait for a free session.
+    Throttle responses are not retried by the pool, they are left to the fetcher's AdaptiveRateLimiter.
+    """
+    with _session_pools_lock:
+        if (base_url, size) not in _session_pools:
+            _session_pools[base_url, size] = SessionPool(base_url, size=size, retry_status_codes=())
+        return _session_pools[base_url, size]
+
+
+def create_browser_limiter(shards=1):
+    """Adaptive limiter for page loads, starting at the old fixed CRAWL_DELAY pace.
+
+    With shards, the limiter gets its share of the page load budget split between that many processes.
+    """
+    return AdaptiveRateLimiter(BROWSER_PAGES_PER_SECOND / shards, initial_rate=1 / CRAWL_DELAY / shards,
+                               target_latency=BROWSER_TARGET_LATENCY)
+
+
+def limited_browser_request(limiter, action):
+    """Runs a browser action that hits the site once, reporting its latency or failure to the limiter."""
+    limiter.acquire()
+    start = time.perf_counter()
+    try:
+        result = action()
+    except selenium.common.exceptions.WebDriverException:
+        limiter.record(time.perf_counter() - start, error=True)
+        raise
+    limiter.record(time.perf_counter() - start)
+    return result
 
 
 class BrandPageScraper:
-    def __init__(self, driver):
-        self.driver = driver
+    def __init__(self, driver_pool, limiter=None, base_url=BASE_URL):
+        self.driver_pool = driver_pool
+        self.base_url = base_url
+        self.limiter = limiter or create_browser_limiter()
 
     def get_product_urls(self, brand_url):
-        url = f"{BASE_URL}{brand_url}"
+        url = f"{self.base_url}{brand_url}"
         logging.info(f"Scraping brand page {url}")
-        self.driver.get(url)
+        with crawl_metrics.measure('brand_page') as measurement, self.driver_pool.driver() as driver:
+            limited_browser_request(self.limiter, lambda: driver.get(url))
+            driver.set_script_timeout(TILE_WAIT_TIMEOUT + 5)
+
+            product_urls = set()
+            y_height = 0
+            has_more = False
+            while True:
+                y_height += SCROLL_AMOUNT
+                result = self._collect_new_tiles(driver, y_height, click=has_more)
+                product_urls.update(result['urls'])
+                logging.debug(f"{len(result['urls'])} new products on brand page, {len(product_urls)} in total")
+                has_more = result['has_more']
+                if not has_more and result['height'] <= y_height:
+                    break
+            # the page as fully scrolled, every tile loaded
+            measurement.bytes = len(driver.page_source)
+            measurement.items = len(product_urls)
 
-        product_urls = set()
-        y_height = 0
-        while True:
-            logging.info("Finding products on brand page...")
-            logging.info(product_urls)
-            current_height = self.driver.execute_script("return document.body.scrollHeight")
-            product_urls.update(self._extract_visible_product_urls())
-            scrolled_height = self._scroll_down(y_height)
-            if not self._click_show_more_button() and current_height<=scrolled_height:
-                break
-            y_height = scrolled_height
-            
         return list(product_urls)
 
-    def _extract_visible_product_urls(self):
-        # Locate all product links
-        product_tiles = self.driver.find_elements(By.XPATH, '//a[contains(@href, "/ca/en/product/")]')
-        return [tile.get_attribute('href') for tile in product_tiles]
-    
-    def _scroll_down(self, y_height, scroll_amount=1000):
-        new_height = y_height + scroll_amount
-        self.driver.execute_script(f"window.scrollTo(0, {new_height});")
-        time.sleep(SCROLL_PAUSE_TIME)
-        return new_height
+    def _collect_new_tiles(self, driver, scroll_to, click):
+        """Scrolls, optionally clicks "Show More Products", and returns the product hrefs not seen before.
 
-    def _click_show_more_button(self):
+        Runs as a single async script, which waits for new tiles instead of sleeping a fixed delay.
+        """
+        def collect():
+            return driver.execute_async_script(COLLECT_NEW_TILES_SCRIPT, PRODUCT_TILE_HREF, scroll_to, click,
+                                               int(TILE_SETTLE_TIME * 1000), int(TILE_SETTLE_LIMIT * 1000),
+                                               int(TILE_WAIT_TIMEOUT * 1000))
+        if click:
+            # each click fetches the next page of products from the site
+            return limited_browser_request(self.limiter, collect)
+        return collect()
+
+    def scrape_brands(self, brands, workers=BROWSER_POOL_SIZE):
+        """Scrapes brand pages in parallel, one borrowed driver per worker.
+
+        At most `workers` brands are in flight, so when the consumer stops early, e.g. on a store
+        error, only the brands already being scraped are finished.
+
+        Yields:
+            (brand, product_urls) for each brand as it finishes
+        """
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = {}
         try:
-            button = self.driver.find_element(By.XPATH, '//button[text()="Show More Products"]')
-            button.click()
-            time.sleep(CLICK_DELAY)
-            return True
-        except:
-            return False
-        
+            for brand in brands:
+                if len(pending) >= workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from self._finished(done, pending)
+                pending[executor.submit(self.get_product_urls, brand['brand_url'])] = brand
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._finished(done, pending)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    @staticmethod
+    def _finished(done, pending):
+        for future in done:
+            brand = pending.pop(future)
+            try:
+                product_urls = future.result()
+            except selenium.common.exceptions.WebDriverException as e:
+                logging.error(f"Failed to scrape {brand['brand_url']}: {e}")
+                continue
+            yield brand, product_urls
+
     @staticmethod
     def extract_url_sku(product_url):
         parsed_url = urlparse(product_url)
@@ -107,15 +284,27 @@ class BrandPageScraper:
 
     
 class BrandListScraper:
-    def __init__(self, driver, base_url):
-        self.driver = driver
+    def __init__(self, driver_pool, base_url, limiter=None):
+        self.driver_pool = driver_pool
         self.base_url = base_url
+        self.limiter = limiter or create_browser_limiter()
 
     def get_brand_urls(self):
         """Scrapes the main brand list to extract brand URLs."""
+        with crawl_metrics.measure('brand_list') as measurement:
+            with self.driver_pool.driver() as driver:
+                limited_browser_request(self.limiter, lambda: driver.get(f"{self.base_url}"))
+                page_source = driver.page_source
+            brand_data = self.parse_brand_list(page_source)
+            measurement.bytes = len(page_source)
+            measurement.items = len(brand_data)
+        return brand_data
+
+    @staticmethod
+    def parse_brand_list(page_source):
+        """Extracts brand names and urls from the brand list page html."""
         brand_data = []
-        self.driver.get(f"{self.base_url}")
-        soup = BeautifulSoup(driver.page_source, 'html.parser')
+        soup = BeautifulSoup(page_source, 'html.parser')
         for brand_link in soup.findAll('a', attrs={"data-at": "brand_link"}):
             brand = {
                 'brand_name': brand_link.span.text,
@@ -124,29 +313,63 @@ class BrandListScraper:
             brand_data.append(brand)
         return brand_data
 
+class ProductResponse(NamedTuple):
+    """A product API response: the decoded, possibly projected, data and the raw body it was decoded from."""
+    data: Dict
+    body: bytes
+
+
+def dead_letter_payload(payload):
+    """The raw body of a ProductResponse handed to an error_fn, other payloads unchanged."""
+    return payload.body if isinstance(payload, ProductResponse) else payload
+
+
 class ProductScraper:
 
     def __init__(self, driver):
         self.driver = driver
 
     @staticmethod
-    def get_product_data_api(product_id):
+    def get_product_data_api(product_id, base_url=BASE_URL, session_pool=None, projection=False, archive=None):
+        """Fetches one product from the API and returns its decoded data, see fetch_product_response."""
+        return ProductScraper.fetch_product_response(product_id, base_url, session_pool, projection, archive).data
 
-        base_url = "https://www.sephora.com/api/v3/catalog/products/"
-        request_url = f"{base_url}{product_id}?addCurrentSkuToProductChildSkus=true&includeRegionsMap=true&showContent=true&includeConfigurableSku=true&countryCode=CA&removePersonalizedData=true&includeReviewFilters=true&includeReviewImages=false&includeRnR=true&loc=en-CA&ch=rwd&sentiments=6"
-        session = requests.Session()
-        headers = {
-            'User-Agent': 'Mozilla/5.0'
-        }
-        cookies = {'cookie_name': 'cookie_value'}
-        session.get(BASE_URL, headers=headers, cookies=cookies)
+    @staticmethod
+    def fetch_product_response(product_id, base_url=BASE_URL, session_pool=None, projection=False,
+                               archive=None) -> ProductResponse:
+        """Fetches one product from the API, returning its decoded data along with the raw body.
 
-        headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': 'Mozilla/5.0'
-        }
-        response = session.get(request_url, headers=headers)
-        return response.json()
+        With archive (ResponseArchive), the decoded response is archived as received. With projection,
+        the request leaves out reviews, sentiments and the regions map, and the response is cut down to
+        PRODUCT_PROJECTION after it is archived, so only the fields product_details needs are passed on.
+        """
+        query = PRODUCT_API_PROJECTED_QUERY if projection else PRODUCT_API_QUERY
+        request_url = f"{base_url}{PRODUCT_API_PATH}{product_id}?{query}"
+        # sessions are warmed up against base_url once and reused across products
+        session_pool = session_pool or get_session_pool(base_url)
+        with crawl_metrics.measure('product_api') as measurement:
+            response = session_pool.get(request_url)
+            measurement.bytes = len(response.content)
+            response.raise_for_status()
+        with crawl_metrics.measure('parse_product_json') as measurement:
+            received = response.json()
+            data = ProductScraper.project(received, PRODUCT_PROJECTION) if projection else received
+            measurement.bytes = len(response.content)
+            measurement.items = 1
+        if archive:
+            archive.write(product_id, received)
+        return ProductResponse(data, response.content)
+
+    @staticmethod
+    def project(data, projection):
+        """Returns the parts of a decoded JSON value named by a projection, see PRODUCT_PROJECTION."""
+        if projection is None:
+            return data
+        if isinstance(data, list):
+            return [ProductScraper.project(item, projection) for item in data]
+        if isinstance(data, dict):
+            return {key: ProductScraper.project(data[key], projection[key]) for key in projection if key in data}
+        return data
     
     @staticmethod
     def map_product_response_to_record(data):
@@ -190,14 +413,19 @@ class ProductScraper:
         return data[col]+" --- "+ProductScraper.compress_categories(data['parentCategory'], col)
 
     @staticmethod
-    def get_product_swatch(data, path, fname):
+    def get_product_swatch(data, path, fname, swatch_downloader=None):
         sku_images = data.get("skuImages",{})
         if sku_images.get('image250'):
+            fname = f"{path}{fname}"
+            if swatch_downloader:
+                swatch_downloader.submit(sku_images.get('image250'), fname)
+                return
+            if os.path.exists(fname):
+                return
             response = requests.get(sku_images.get('image250'))
             if response.status_code != 200:
                 logging.error("Failed to download image!")
             else:
-                fname = f"{path}{fname}"
                 os.makedirs(os.path.dirname(fname), exist_ok=True)
                 with open(fname, 'wb') as file:
                     file.write(response.content)
@@ -205,44 +433,184 @@ class ProductScraper:
 
 
     @staticmethod
-    def compress_product_data(data, save_swatch=False):
-        product_variations = []
-        product_details = data.get('productDetails',{})
-        parent_sku = {
-            'target_url':data.get('targetUrl',""),
-            'full_product_url':data.get('fullSiteProductUrl',""),
-            'product_code':data.get('productId',""),
-            'display_name':product_details.get('displayName',""),
-            'loves_count':product_details.get('lovesCount',-1),
-            'rating':product_details.get('rating', -1),
-            'reviews':product_details.get('reviews',-1),
-            'brand_id':product_details.get('brand',{}).get('brandId',""),
-            'short_description':product_details.get('shortDescription',""),
-            'long_description':product_details.get('longDescription',""),
-            'suggested_usage':product_details.get('suggestedUsage',""),
-            'category_id':"",
-            'category_name':"",
-            'category_url':""
-        }
-        if 'parentCategory' in data.keys():
-            parent_sku['category_id']=ProductScraper.compress_categories(data['parentCategory'], 'categoryId')
-            parent_sku['category_name']=ProductScraper.compress_categories(data['parentCategory'], 'displayName')
-            parent_sku['category_url']=ProductScraper.compress_categories(data['parentCategory'], 'targetUrl')
+    def compress_product_data(data, save_swatch=False, swatch_downloader=None):
+        """Returns one record dict per SKU, keyed by PRODUCT_RECORD_KEYS."""
+        return [dict(zip(PRODUCT_RECORD_KEYS, row))
+                for row in ProductScraper.iter_product_rows(data, save_swatch, swatch_downloader)]
 
-        product_details = ProductScraper.map_product_response_to_record(data['currentSku'])
-        product_variations.append({**parent_sku, **product_details})
+    @staticmethod
+    def compress_category_chain(category):
+        """Walks the parentCategory chain once, returning the ' --- ' joined ids, names and urls.
+
+        Matches compress_categories for each key: a level missing a key contributes "" and ends that key's chain.
+        """
+        parts = ([], [], [])
+        open_keys = [True, True, True]
+        while category is not None and any(open_keys):
+            for i, key in enumerate(CATEGORY_KEYS):
+                if open_keys[i]:
+                    parts[i].append(category.get(key, ""))
+                    open_keys[i] = key in category
+            category = category.get('parentCategory')
+        return tuple(" --- ".join(part) for part in parts)
+
+    @staticmethod
+    def iter_product_rows(data, save_swatch=False, swatch_downloader=None):
+        """Yields one ready-to-insert product_details row per SKU, in PRODUCT_DETAILS_COLUMNS order.
 
-        if 'regularChildSkus' in data.keys():
-            for child_sku in data['regularChildSkus']:
-                product_details = ProductScraper.map_product_response_to_record(child_sku)
-                product_variations.append({**parent_sku, **product_details})
+        Product level values are computed once and shared by every SKU row, and the category
+        chain is walked in a single pass.
+        """
+        product_details = data.get('productDetails',{})
+        category_id, category_name, category_url = ProductScraper.compress_category_chain(data.get('parentCategory'))
+        brand_id = product_details.get('brand',{}).get('brandId',"")
+        display_name = product_details.get('displayName',"")
+        product_prefix = (
+            data.get('targetUrl',""),
+            data.get('fullSiteProductUrl',""),
+            data.get('productId',""),
+            product_details.get('lovesCount',-1),
+            product_details.get('rating', -1),
+            product_details.get('reviews',-1),
+            brand_id,
+            category_id,
+            category_name,
+            category_url
+        )
+        product_suffix = (
+            product_details.get('shortDescription',""),
+            product_details.get('longDescription',""),
+            product_details.get('suggestedUsage',"")
+        )
+
+        current_sku = data['currentSku']
+        for sku in itertools.chain((current_sku,), data.get('regularChildSkus', ())):
+            refinements = sku.get('refinements', {})
+            yield product_prefix + (
+                sku['skuId'], # str
+                sku['brandName'], # str
+                display_name, # str
+                sku.get('ingredientDesc',""), # str
+                sku['isLimitedEdition'], # bool
+                sku['isFirstAccess'], # bool
+                sku['isLimitedTimeOffer'],# bool
+                sku['isNew'],# bool
+                sku['isOnlineOnly'],# bool
+                sku['isOnlyFewLeft'],# bool
+                sku['isOutOfStock'],# bool
+                sku['listPrice'], # str
+                sku['maxPurchaseQuantity'], # int
+                sku.get('size', ""), # str
+                sku['type'], # str
+                sku['url'],# str
+                sku.get('variationType',""),# str
+                sku.get('variationValue',""),# str
+                sku['isReturnable'], #bool
+                ' '.join(refinements['finishRefinements']) if 'finishRefinements' in refinements else "", # str
+                ' '.join(refinements['sizeRefinements']) if 'sizeRefinements' in refinements else "" # str
+            ) + product_suffix
 
         if save_swatch:
-            path = f"data/swatches/{parent_sku['brand_id']}/{parent_sku['product_code']}/"
-            fname = f"{data['currentSku'].get('skuId')}.jpg"
-            ProductScraper.get_product_swatch(data['currentSku'], path, fname)
-        return product_variations
+            path = f"data/swatches/{brand_id}/{data.get('productId','')}/"
+            fname = f"{current_sku.get('skuId')}.jpg"
+            ProductScraper.get_product_swatch(current_sku, path, fname, swatch_downloader)
+
+    @staticmethod
+    def content_hash(record):
+        """Stable sha256 of a JSON-serializable row or record, independent of dict key order."""
+        return hashlib.sha256(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def save_product_details(db_file, product_data, save_swatch=False, swatch_downloader=None):
+        """Compresses an API response and inserts the SKU rows that changed since they were last stored.
 
+        Returns:
+            int: number of SKU rows written, 0 when the product is unchanged
+        """
+        with crawl_metrics.measure('compress_product_data') as measurement:
+            rows = list(ProductScraper.iter_product_rows(product_data, save_swatch, swatch_downloader))
+            measurement.items = len(rows)
+        return ProductScraper.store_product_records(db_file, rows)
+
+    @staticmethod
+    def store_product_records(db_file, rows):
+        """Inserts the product_details rows of one product whose content changed since they were last stored.
+
+        Returns:
+            int: number of SKU rows written, 0 when the product is unchanged
+        """
+        product_code = rows[0][PRODUCT_CODE_INDEX]
+        sku_hashes = {row[SKU_ID_INDEX]: ProductScraper.content_hash(row) for row in rows}
+        product_hash = ProductScraper.content_hash(sku_hashes)
+
+        stored_product_hash, stored_sku_hashes = get_content_hashes(db_file, product_code)
+        if stored_product_hash == product_hash:
+            logging.debug(f"Product {product_code} unchanged, skipping write")
+            return 0
+
+        changed = [row for row in rows if stored_sku_hashes.get(row[SKU_ID_INDEX]) != sku_hashes[row[SKU_ID_INDEX]]]
+        insert_product_detail_rows(db_file, changed)
+        save_content_hashes(db_file, product_code, product_hash, sku_hashes)
+        return len(changed)
+
+    @staticmethod
+    def fetch_product_details(db_file, product_codes, base_url=BASE_URL, max_in_flight=MAX_IN_FLIGHT,
+                              requests_per_second=REQUESTS_PER_SECOND, save_swatch=False, checkpoint=False,
+                              archive=None, projection=False):
+        """Fetches product details concurrently and stores each response as it arrives, through a background writer.
+        With checkpoint, each stored product is recorded in crawl_state so a restarted crawl skips it.
+        With projection, trimmed API requests are made and only the fields product_details needs are kept.
+        With archive (ResponseArchive), every response is archived as received, before projection and parsing.
+        With save_swatch, swatch images are downloaded in the background by a SwatchDownloader.
+        Each product's rows, content hashes and checkpoint are written as one unit. Products whose fetch,
+        parsing or write fails are recorded in dead_letters for retry_dead_letters, and products stored
+        are removed from it.
+
+        Returns:
+            Dict: throughput report from ConcurrentProductFetcher.run with unchanged products and
+                per-request latency added
+        """
+        unchanged = []
+        write_failed = []
+        swatch_downloader = SwatchDownloader() if save_swatch else None
+
+        def handle(product_code, response):
+            def write_failure(error):
+                write_failed.append(product_code)
+                dead_letter(product_code, error, response)
+
+            # rows, content hashes and checkpoint are committed together or not at all
+            with write_unit(db_file, product_code, on_error=write_failure):
+                if not ProductScraper.save_product_details(db_file, response.data, save_swatch, swatch_downloader):
+                    unchanged.append(product_code)
+                if checkpoint:
+                    mark_crawl_completed(db_file, PRODUCT_DETAILS_PHASE, [product_code])
+                clear_dead_letters(db_file, [product_code])
+
+        def dead_letter(product_code, error, payload):
+            stage = 'product_api' if isinstance(error, requests.RequestException) else PRODUCT_DETAILS_PHASE
+            record_dead_letters(db_file, [dead_letter_row(product_code, stage, error, dead_letter_payload(payload))])
+
+        session_pool = get_session_pool(base_url, max_in_flight)
+        fetcher = ConcurrentProductFetcher(
+            fetch_fn=lambda product_code: ProductScraper.fetch_product_response(product_code, base_url, session_pool,
+                                                                                projection, archive),
+            handle_fn=handle,
+            max_in_flight=max_in_flight,
+            requests_per_second=requests_per_second,
+            error_fn=dead_letter
+        )
+        with background_writes(db_file):
+            report = fetcher.run(product_codes)
+        # products whose write failed after they were handled were dead-lettered by the writer
+        report['succeeded'] -= len(write_failed)
+        report['failed'] += len(write_failed)
+        report['unchanged'] = len(unchanged)
+        if swatch_downloader:
+            report['swatches'] = swatch_downloader.close()
+        report['request_latency'] = session_pool.latency_summary()
+        logging.info(f"Product API latency: {report['request_latency']}")
+        return report
 
     def get_product_data_scrape(self, url):
         #TODO not tested since update to using api for product details
@@ -381,73 +749,268 @@ class ProductScraper:
         return product_options
 
 
+def create_tables(db_file):
+    for query in (create_brands_table_query, create_products_table_query, create_product_details_table_query,
+                  create_crawl_state_table_query, create_product_hashes_table_query, create_sku_hashes_table_query):
+        execute_query(db_file, query)
+    migrate(db_file)
+
+
+def crawl_brand_list(db_file, driver_pool, brand_list_url=BRAND_LIST_URL):
+    """Phase 1: scrapes brand names and urls from /brands-list, or loads them if already crawled."""
+    if brand_list_url in get_crawl_completed(db_file, BRAND_LIST_PHASE):
+        logging.info("Brand list already crawled, loading brands from database")
+        return [{'brand_name': brand_name, 'brand_url': brand_url}
+                for brand_name, brand_url in select_query(db_file, """SELECT brand_name, brand_url FROM brands""")]
+
+    brand_urls = BrandListScraper(driver_pool, brand_list_url).get_brand_urls()
+    insert_brands_data(db_file, brand_urls, "brands")
+    mark_crawl_completed(db_file, BRAND_LIST_PHASE, [brand_list_url])
+    return brand_urls
+
+
+def crawl_brand_pages(db_file, brands, driver_pool, base_url=BASE_URL):
+    """Phase 2: scrapes product urls from brand pages not yet crawled and inserts them into products."""
+    completed = get_crawl_completed(db_file, BRAND_PAGES_PHASE)
+    remaining = [brand for brand in brands if brand['brand_url'] not in completed]
+    logging.info(f"{len(remaining)} of {len(brands)} brand pages left to scrape")
+
+    with background_writes(db_file):
+        for brand, product_urls in BrandPageScraper(driver_pool, base_url=base_url).scrape_brands(remaining):
+            store_brand_products(db_file, brand, product_urls)
+
+
+def store_brand_products(db_file, brand, product_urls):
+    """Inserts the product urls scraped from one brand page and checkpoints the brand."""
+    rows = select_query(db_file, """SELECT id FROM brands where brand_url=?""", (brand['brand_url'],))
+    if not rows:
+        logging.error(f"Brand {brand['brand_url']} missing from brands table")
+        return
+    brand_id = rows[0][0]
+    batch_data = [
+        (brand_id, url, BrandPageScraper.extract_url_sku(url), BrandPageScraper.extract_url_product_code(url))
+        for url in product_urls
+    ]
+
+    def write_failure(error):
+        logging.error(f"Products of brand {brand['brand_url']} not stored, it is scraped again next crawl: {error}")
+
+    # the brand is only checkpointed together with its products
+    with write_unit(db_file, brand['brand_url'], on_error=write_failure):
+        insert_brand_products(db_file, brand_id, batch_data, "products")
+        mark_crawl_completed(db_file, BRAND_PAGES_PHASE, [brand['brand_url']])
+
+
+def crawl_sitemaps(db_file, base_url=BASE_URL, sitemap_urls=None, batch_size=SITEMAP_BATCH_SIZE):
+    """Phase 2 without a browser: streams the sitemaps and inserts product urls into products.
+
+    Sitemap indexes are followed, product urls are inserted in batches of batch_size while the
+    file is still downloading, and each finished url sitemap is checkpointed so a restart skips it.
+    Products come without a brand, the product API fills that in.
+
+    Returns:
+        int: number of new products found
+    """
+    reader = SitemapReader(get_session_pool(base_url))
+    pending = list(sitemap_urls or reader.find_sitemaps(base_url))
+    completed = get_crawl_completed(db_file, SITEMAP_PHASE)
+    known = {product_code for (product_code,) in select_query(db_file, """SELECT DISTINCT product_code FROM products""")}
+    found = 0
+    while pending:
+        sitemap_url = pending.pop(0)
+        if sitemap_url in completed:
+            continue
+        is_index = False
+        batch_data = []
+        for kind, url in reader.iter_entries(sitemap_url):
+            if kind == SITEMAP_ENTRY:
+                is_index = True
+                pending.append(url)
+                continue
+            product_code = BrandPageScraper.extract_url_product_code(url)
+            if product_code is None or product_code in known or PRODUCT_URL_PATH not in urlparse(url).path:
+                continue
+            known.add(product_code)
+            batch_data.append((None, url, BrandPageScraper.extract_url_sku(url), product_code))
+            if len(batch_data) >= batch_size:
+                insert_brand_products(db_file, None, batch_data, "products")
+                found += len(batch_data)
+                batch_data = []
+        if batch_data:
+            insert_brand_products(db_file, None, batch_data, "products")
+            found += len(batch_data)
+        # indexes are cheap to re-read, only url sitemaps are checkpointed so no child is lost on restart
+        if not is_index:
+            mark_crawl_completed(db_file, SITEMAP_PHASE, [sitemap_url])
+    logging.info(f"Found {found} new products in sitemaps")
+    return found
+
+
+def get_remaining_product_codes(db_file):
+    """Returns product codes found on brand pages whose details have not been fetched yet."""
+    rows = select_query(db_file, """
+        SELECT DISTINCT product_code FROM products
+        WHERE product_code IS NOT NULL
+        AND product_code NOT IN (SELECT item_key FROM crawl_state WHERE phase=?)
+    """, (PRODUCT_DETAILS_PHASE,))
+    logging.info(f"{len(rows)} products left to fetch")
+    return [product_code for (product_code,) in rows]
+
+
+def crawl_product_details(db_file, base_url=BASE_URL, save_swatch=True, archive=None, projection=False):
+    """Phase 3: uses the API to get product information for products not yet fetched."""
+    return ProductScraper.fetch_product_details(
+        db_file, get_remaining_product_codes(db_file), base_url=base_url, save_swatch=save_swatch, checkpoint=True,
+        archive=archive, projection=projection
+    )
+
+
+def replay_archive(db_file, archive_dir=ARCHIVE_DIR):
+    """Re-runs compress_product_data and the product_details insert over archived responses, without network access.
+
+    Price history recorded by the replay is stamped with when each response was originally fetched.
+    """
+    report = {'replayed': 0, 'written': 0, 'failed': 0}
+    start = time.perf_counter()
+    for product_code, fetched_at, product_data in ResponseArchive(archive_dir).replay_records():
+        report['replayed'] += 1
+        try:
+            last_history_id = get_last_price_history_id(db_file)
+            written = ProductScraper.save_product_details(db_file, product_data)
+            if written and fetched_at:
+                observed_at = datetime.fromisoformat(fetched_at).astimezone(timezone.utc)
+                stamp_price_history(db_file, product_code, last_history_id,
+                                    observed_at.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])
+            report['written'] += written
+        except KeyError as e:
+            logging.error(f"Failed to parse archived product {product_code}: {e}")
+            record_dead_letters(db_file, [dead_letter_row(product_code, 'replay', e, product_data)])
+            report['failed'] += 1
+    report['elapsed_seconds'] = time.perf_counter() - start
+    logging.info(f"Replayed {report['replayed']} archived responses in {report['elapsed_seconds']:.1f}s")
+    return report
+
+
+def retry_dead_letters(db_file, base_url=BASE_URL, max_attempts=MAX_RETRY_ATTEMPTS, limit=None, wait=False,
+                       archive=None, projection=False):
+    """Re-fetches only the products in dead_letters whose backoff has expired.
+
+    Products that fail again are rescheduled with a longer backoff, products that failed
+    max_attempts times stay in dead_letters for inspection. With wait, sleeps until the next
+    retry is due, at most MAX_RETRY_WAIT seconds at a time, until no product has attempts left.
+
+    Returns:
+        Dict: requested, succeeded and failed counts summed over every retry round
+    """
+    totals = {'requested': 0, 'succeeded': 0, 'failed': 0, 'rounds': 0}
+    while True:
+        product_codes = get_due_dead_letters(db_file, max_attempts, limit)
+        if product_codes:
+            logging.info(f"Retrying {len(product_codes)} failed products")
+            report = ProductScraper.fetch_product_details(db_file, product_codes, base_url=base_url, checkpoint=True,
+                                                          archive=archive, projection=projection)
+            for key in ('requested', 'succeeded', 'failed'):
+                totals[key] += report[key]
+            totals['rounds'] += 1
+            continue
+        next_retry_at = get_next_dead_letter_retry(db_file, max_attempts)
+        if not wait or next_retry_at is None:
+            break
+        next_retry = datetime.strptime(next_retry_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        wait_seconds = (next_retry - datetime.now(timezone.utc)).total_seconds()
+        logging.info(f"Next retry due at {next_retry_at} UTC")
+        time.sleep(min(MAX_RETRY_WAIT, max(1.0, wait_seconds)))
+    logging.info(f"Retried failed products: {totals}")
+    return totals
+
+
+def refresh_product_details(db_file, base_url=BASE_URL, limit=None, save_swatch=False, archive=None,
+                            projection=False):
+    """Re-fetches stored products, most recently changed first, writing only products whose content changed.
+
+    New products come first, then products ordered by when they last changed, so a time-boxed
+    nightly refresh covers the volatile part of the catalogue before the stable part.
+    """
+    rows = select_query(db_file, """
+        SELECT p.product_code FROM (SELECT DISTINCT product_code FROM products WHERE product_code IS NOT NULL) p
+        LEFT JOIN product_hashes h ON h.product_code = p.product_code
+        ORDER BY h.changed_at IS NOT NULL, h.changed_at DESC
+        LIMIT ?
+    """, (-1 if limit is None else limit,))
+    report = ProductScraper.fetch_product_details(
+        db_file, [product_code for (product_code,) in rows], base_url=base_url, save_swatch=save_swatch, archive=archive,
+        projection=projection
+    )
+    logging.info(f"Refreshed {report['succeeded']} products, {report['unchanged']} unchanged")
+    return report
+
+
 if __name__ == "__main__":
 
-    DB_FILE = "data/db/products.db"
+    parser = argparse.ArgumentParser(description="Crawl brands, product urls and product details into SQLite.")
+    parser.add_argument("--db-file", default="data/db/products.db")
+    parser.add_argument("--fresh", action="store_true", help="ignore checkpoints and crawl everything again")
+    parser.add_argument("--refresh", action="store_true",
+                        help="re-fetch known products and write only those that changed")
+    parser.add_argument("--limit", type=int, default=None, help="maximum number of products to refresh, or to retry per round")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR, help="where raw API responses are archived")
+    parser.add_argument("--report-dir", default=REPORT_DIR, help="where the JSON and Prometheus run reports go")
+    parser.add_argument("--discovery", choices=("sitemap", "browser"), default="sitemap",
+                        help="find product urls from the sitemaps, or by scrolling brand pages in a browser; "
+                             "sitemap falls back to the browser when it finds nothing")
+    parser.add_argument("--full-browser", action="store_true",
+                        help="load images, fonts and trackers on brand pages instead of the lean browser profile")
+    parser.add_argument("--browser-cache-dir", default=BROWSER_CACHE_DIR,
+                        help="where browsers keep their HTTP cache between runs")
+    parser.add_argument("--projection", action="store_true",
+                        help="request trimmed product API responses and keep only the fields product_details needs")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="re-fetch only products in the dead-letter table whose retry is due")
+    parser.add_argument("--wait", action="store_true",
+                        help="with --retry-failed, keep waiting for scheduled retries until none are left")
+    parser.add_argument("--max-attempts", type=int, default=MAX_RETRY_ATTEMPTS,
+                        help="failures after which a product is no longer retried")
+    parser.add_argument("--replay", action="store_true",
+                        help="rebuild product_details from the archive instead of crawling")
+    args = parser.parse_args()
+
+    configure_logging()
+    DB_FILE = args.db_file
 
     # create tables 
-    execute_query(DB_FILE, create_brands_table_query)
-    execute_query(DB_FILE, create_products_table_query)
-    execute_query(DB_FILE, create_product_details_table_query)
-
-    # scrape brand names and urls from /brands-list
-    brand_urls = []
-    brand_list_url = 'https://www.sephora.com/ca/en/brands-list'
-    with webdriver.Chrome(options=options) as driver:
-        brands = BrandListScraper(driver, brand_list_url)
-        brand_urls = brands.get_brand_urls()
-
-    conn = None
-    insert_brands_data(DB_FILE, brand_urls, "brands")
-
-    # scrape products from brand pages and insert into products table
-    for brand in brand_urls:
-        time.sleep(5)
-        with webdriver.Chrome(options=options) as driver:
-            brand_page = BrandPageScraper(driver)
+    create_tables(DB_FILE)
+    if args.fresh:
+        reset_crawl_state(DB_FILE)
+
+    archive = ResponseArchive(args.archive_dir)
+    if args.replay:
+        report = replay_archive(DB_FILE, args.archive_dir)
+    elif args.retry_failed:
+        report = retry_dead_letters(DB_FILE, max_attempts=args.max_attempts, limit=args.limit, wait=args.wait,
+                                    archive=archive, projection=args.projection)
+    elif args.refresh:
+        report = refresh_product_details(DB_FILE, limit=args.limit, save_swatch=True, archive=archive,
+                                         projection=args.projection)
+    else:
+        use_browser = args.discovery == 'browser'
+        if not use_browser:
             try:
-                product_urls = brand_page.get_product_urls(brand['brand_url'])
-            except selenium.common.exceptions.InvalidArgumentException as e:
-                logging.error(f"{e}")
-                continue
-
+                crawl_sitemaps(DB_FILE)
+            except (requests.RequestException, ParseError) as e:
+                logging.error(f"Sitemap discovery failed, falling back to brand pages: {e}")
+                use_browser = True
+            use_browser = use_browser or not select_query(DB_FILE, """SELECT 1 FROM products LIMIT 1""")
+        if use_browser:
+            driver_factory = ChromeDriverFactory(lean=not args.full_browser, cache_dir=args.browser_cache_dir)
+            driver_pool = DriverPool(driver_factory, size=BROWSER_POOL_SIZE, max_pages_per_driver=PAGES_PER_DRIVER)
             try:
-                conn = sqlite3.connect(DB_FILE)
-                cursor = conn.cursor()
-                cursor.execute("""SELECT id FROM brands where brand_url=?""", (brand['brand_url'],))
-                brand_id = cursor.fetchone()[0]
-            except sqlite3.Error as e:
-                logging.error(f"SQLite error: {e}")
+                brand_urls = crawl_brand_list(DB_FILE, driver_pool)
+                crawl_brand_pages(DB_FILE, brand_urls, driver_pool)
             finally:
-                if conn:
-                    conn.close()
-                batch_data = [
-                    (brand_id, url, BrandPageScraper.extract_url_sku(url), BrandPageScraper.extract_url_product_code(url))
-                    for url in product_urls
-                ]
-                insert_brand_products(DB_FILE, brand_id, batch_data, "products")
-
-    # use API to get product information based on products collected in previous scraping step 
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("""SELECT product_code FROM products""")
-        found_products = cursor.fetchall()    
-
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error: {e}")
-    finally:
-        if conn:
-            conn.close()
-        
-        for product_code in found_products:
-            time.sleep(4)
-            product_data = ProductScraper.get_product_data_api(product_code)
-            logging.info(f"GET data for {product_data}")
-            # with open('../data/product_sample.json', 'w') as file:
-            #     json.dump(product_data, file)
-            try:
-                insert_product_details(DB_FILE, ProductScraper.compress_product_data(product_data, save_swatch=True), 'product_details')
-            except KeyError as e:
-                logging.error(f"{e}")
-                continue
+                driver_pool.close()
+
+        report = crawl_product_details(DB_FILE, archive=archive, projection=args.projection)
+    archive.close()
+    connections.close_all()
+    logging.info(f"Product detail crawl finished: {report}")
+    crawl_metrics.write_report(args.report_dir, extra=report)
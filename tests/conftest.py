@@ -0,0 +1,22 @@
+import pytest
+import sys
+sys.path.insert(0,'../src')
+from stub_server import FixtureSite, StubServer, make_fixture_product
+
+# product code the stub server answers with a 404
+MISSING_PRODUCT = 'MISSING'
+
+
+def make_product(product_code):
+    return make_fixture_product(product_code, '1', skus=2)
+
+
+def stub_product(product_code):
+    return make_product(product_code) if product_code != MISSING_PRODUCT else None
+
+
+@pytest.fixture
+def stub_server():
+    site = FixtureSite('<html></html>', {}, {}, product_factory=stub_product)
+    with StubServer(site) as server:
+        yield server.url
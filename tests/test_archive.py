@@ -0,0 +1,41 @@
+import pytest
+import sys
+import os
+sys.path.insert(0,'../src')
+from archive import ResponseArchive
+
+
+def test_archive_round_trip(tmp_path):
+    archive = ResponseArchive(str(tmp_path))
+    archive.write('P1', {'productId': 'P1', 'version': 1})
+    archive.write('P2', {'productId': 'P2'})
+    archive.write('P1', {'productId': 'P1', 'version': 2})
+    archive.close()
+
+    assert [code for code, _ in ResponseArchive(str(tmp_path)).replay()] == ['P1', 'P2', 'P1']
+    assert ResponseArchive(str(tmp_path)).read('P1') == {'productId': 'P1', 'version': 2}
+    assert ResponseArchive(str(tmp_path)).read('P3') is None
+
+
+def test_archive_rotates_segments_and_never_appends_to_old_ones(tmp_path):
+    archive = ResponseArchive(str(tmp_path), segment_bytes=1)
+    for i in range(3):
+        archive.write(f'P{i}', {'i': i})
+    archive.close()
+    archive = ResponseArchive(str(tmp_path))
+    archive.write('P3', {'i': 3})
+    archive.close()
+
+    assert len(archive.segments()) == 4
+    assert [data['i'] for _, data in archive.replay()] == [0, 1, 2, 3]
+
+
+def test_archive_replay_survives_truncated_segment(tmp_path):
+    archive = ResponseArchive(str(tmp_path))
+    archive.write('P1', {'i': 1})
+    archive.write('P2', {'i': 2})
+    archive.close()
+    path = archive.segments()[0]
+    os.truncate(path, os.path.getsize(path) - 20)
+
+    assert [code for code, _ in ResponseArchive(str(tmp_path)).replay()] == ['P1']
@@ -0,0 +1,66 @@
+import pytest
+import sys
+import json
+import requests
+sys.path.insert(0,'../src')
+from benchmark import run_benchmark
+from stub_server import FixtureSite, StubServer, BRAND_LIST_PATH
+from webscraper import PRODUCT_API_PATH, BrandListScraper
+from archive import ResponseArchive
+from conftest import make_product
+from db_util import select_query
+
+
+def test_fixture_site_round_trips_through_fixture_dir(tmp_path):
+    FixtureSite.generate(brands=2, products_per_brand=3).save(str(tmp_path / 'fixtures'))
+    archive = ResponseArchive(str(tmp_path / 'archive'))
+    archive.write('RECORDED', make_product('RECORDED'))
+    archive.close()
+
+    site = FixtureSite.load(str(tmp_path / 'fixtures'), str(tmp_path / 'archive'))
+
+    assert len(site.brand_pages) == 2
+    assert len(site.products) == 7
+    assert [brand['brand_name'] for brand in BrandListScraper.parse_brand_list(site.brand_list)] == [
+        'Fixture Brand 0', 'Fixture Brand 1']
+    content_type, body = site.route(f'{PRODUCT_API_PATH}RECORDED?loc=en-CA')
+    assert json.loads(body)['productId'] == 'RECORDED'
+
+
+def test_stub_server_injects_latency_and_errors():
+    site = FixtureSite.generate(brands=1, products_per_brand=1)
+    with StubServer(site, latency=0.05) as server:
+        response = requests.get(f'{server.url}{BRAND_LIST_PATH}')
+        assert response.status_code == 200
+        assert response.elapsed.total_seconds() >= 0.05
+        assert requests.get(f'{server.url}{PRODUCT_API_PATH}UNKNOWN').status_code == 404
+    with StubServer(site, error_rate=1.0) as server:
+        assert requests.get(f'{server.url}{PRODUCT_API_PATH}P00000000').status_code == 503
+        assert server.requests == 1
+
+
+def test_run_benchmark_with_sitemap_discovery(tmp_path):
+    db_file = str(tmp_path / 'benchmark.db')
+    results = run_benchmark(FixtureSite.generate(brands=2, products_per_brand=5), db_file, latency=0.01,
+                            requests_per_second=500)
+
+    assert results['products'] == 10
+    assert results['failed'] == 0
+    assert results['products_per_second'] > 0
+    assert 0.01 <= results['request_latency_p50'] <= results['request_latency_p99']
+    assert results['db_rows_inserted'] >= 30
+    assert results['db_insert_rows_per_second'] > 0
+    assert select_query(db_file, "SELECT COUNT(*) FROM product_details") == [(30,)]
+
+
+def test_projection_shrinks_product_responses_and_their_parse_time(tmp_path):
+    site = FixtureSite.generate(brands=1, products_per_brand=10, reviews_per_product=100)
+    full = run_benchmark(site, str(tmp_path / 'full.db'), max_in_flight=1, requests_per_second=500)
+    projected = run_benchmark(site, str(tmp_path / 'projected.db'), max_in_flight=1, requests_per_second=500,
+                              projection=True)
+
+    assert full['products'] == projected['products'] == 10
+    assert projected['response_bytes_per_product'] < full['response_bytes_per_product'] / 5
+    assert projected['parse_seconds_per_product'] < full['parse_seconds_per_product']
+    assert select_query(str(tmp_path / 'full.db'), "SELECT COUNT(*) FROM product_details") == \
+        select_query(str(tmp_path / 'projected.db'), "SELECT COUNT(*) FROM product_details")
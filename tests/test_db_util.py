@@ -0,0 +1,256 @@
+import pytest
+import sys
+import threading
+import logging
+import sqlite3
+import time
+sys.path.insert(0,'../src')
+from db_util import (ConnectionManager, BackgroundWriter, connections, get_db_connection, execute_query, select_query, bulk_load,
+                     insert_batch, insert_brands_data, insert_brand_products, insert_product_detail_rows, migrate, get_price_at,
+                     get_price_changes_since, get_schema_version, MIGRATIONS,
+                     create_brands_table_query, create_products_table_query, create_product_details_table_query,
+                     create_crawl_state_table_query, create_product_hashes_table_query, create_sku_hashes_table_query,
+                     PRODUCT_DETAILS_COLUMNS)
+
+CREATE_TABLE_QUERIES = (create_brands_table_query, create_products_table_query, create_product_details_table_query,
+                        create_crawl_state_table_query, create_product_hashes_table_query, create_sku_hashes_table_query)
+
+# lookups the crawl runs once per brand, product or SKU
+HOT_LOOKUPS = (
+    ("""SELECT id FROM brands where brand_url=?""", ('/brand/a',)),
+    ("""SELECT product_id, brand_id FROM products WHERE product_code=?""", ('P1',)),
+    ("""SELECT product_code FROM products WHERE brand_id=?""", (1,)),
+    ("""SELECT * FROM product_details WHERE product_code=?""", ('P1',)),
+    ("""SELECT * FROM product_details WHERE sku_id=?""", ('P11',)),
+    ("""SELECT content_hash FROM product_hashes WHERE product_code=?""", ('P1',)),
+    ("""SELECT sku_id, content_hash FROM sku_hashes WHERE product_code=?""", ('P1',)),
+    ("""SELECT item_key FROM crawl_state WHERE phase=?""", ('product_details',)),
+    ("""SELECT sku_id FROM product_details WHERE price_cents BETWEEN ? AND ?""", (1000, 2000)),
+    ("""SELECT sku_id FROM product_details WHERE size_unit=? ORDER BY unit_price_cents LIMIT 10""", ('ml',)),
+    ("""SELECT price_cents FROM price_history WHERE sku_id=? AND observed_at<=? ORDER BY observed_at DESC, id DESC LIMIT 1""",
+     ('P11', '2024-01-01 00:00:00')),
+    ("""SELECT sku_id, price_cents FROM price_history WHERE observed_at>? ORDER BY observed_at, id""",
+     ('2024-01-01 00:00:00',)),
+)
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    db_file = str(tmp_path / 'test.db')
+    execute_query(db_file, """CREATE TABLE items (name TEXT)""")
+    return db_file
+
+
+def test_connection_is_reused_and_tuned(db_file):
+    conn = get_db_connection(db_file)
+    assert get_db_connection(db_file) is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ('wal',)
+    assert conn.execute("PRAGMA synchronous").fetchone() == (1,)  # NORMAL
+    assert conn.execute("PRAGMA cache_size").fetchone() == (-64000,)
+
+
+def test_each_thread_gets_its_own_connection(db_file):
+    other = []
+    thread = threading.Thread(target=lambda: other.append(get_db_connection(db_file)))
+    thread.start()
+    thread.join()
+    assert other[0] is not get_db_connection(db_file)
+
+
+def test_close_all_reconnects_on_next_query(db_file):
+    manager = ConnectionManager()
+    conn = manager.connection(db_file)
+    manager.close_all()
+    assert manager.connection(db_file) is not conn
+    execute_query(db_file, """INSERT INTO items (name) VALUES (?)""", ('a',))
+    connections.close_all()
+    assert select_query(db_file, """SELECT name FROM items""") == [('a',)]
+
+
+def test_bulk_load_streams_a_generator_in_chunks(db_file, caplog):
+    committed = []
+
+    def rows():
+        for i in range(25):
+            # rows before the current chunk are already committed
+            committed.append(select_query(db_file, """SELECT COUNT(*) FROM items""")[0][0])
+            yield (f'secret ingredient {i}',)
+
+    with caplog.at_level(logging.DEBUG, logger='db_util'):
+        assert bulk_load(db_file, """INSERT INTO items (name) VALUES (?)""", rows(), chunk_size=10) == 25
+    assert select_query(db_file, """SELECT COUNT(*) FROM items""") == [(25,)]
+    assert committed[10] == 10 and committed[20] == 20
+    assert 'secret ingredient' not in caplog.text
+
+
+def test_bulk_load_rolls_back_only_the_failing_chunk(db_file):
+    execute_query(db_file, """CREATE TABLE unique_items (name TEXT PRIMARY KEY)""")
+    with pytest.raises(sqlite3.IntegrityError):
+        bulk_load(db_file, """INSERT INTO unique_items (name) VALUES (?)""", [('a',), ('b',), ('c',), ('c',)],
+                  chunk_size=2)
+    assert select_query(db_file, """SELECT name FROM unique_items ORDER BY name""") == [('a',), ('b',)]
+    insert_batch(db_file, """INSERT INTO unique_items (name) VALUES (?)""", [('d',)])
+    assert len(select_query(db_file, """SELECT name FROM unique_items""")) == 3
+
+
+@pytest.fixture
+def crawl_db(tmp_path):
+    db_file = str(tmp_path / 'products.db')
+    for query in CREATE_TABLE_QUERIES:
+        execute_query(db_file, query)
+    return db_file
+
+
+def test_natural_keys_migration_removes_duplicates_of_earlier_runs(crawl_db):
+    for brand_name in ('Old Name', 'New Name'):
+        execute_query(crawl_db, """INSERT INTO brands (brand_name, brand_url) VALUES (?, '/brand/a')""", (brand_name,))
+    for url in ('first', 'second'):
+        execute_query(crawl_db, """INSERT INTO products (brand_id, product_url, product_code) VALUES (2, ?, 'P1')""",
+                      (url,))
+    execute_query(crawl_db, """INSERT INTO products (brand_id, product_url, product_code) VALUES (2, 'x', NULL)""")
+
+    migrate(crawl_db)
+    migrate(crawl_db)
+
+    assert select_query(crawl_db, """SELECT id, brand_name FROM brands""") == [(1, 'Old Name')]
+    assert select_query(crawl_db, """SELECT brand_id, product_url, product_code FROM products ORDER BY product_id""") == [
+        (1, 'second', 'P1'), (1, 'x', None)]
+
+
+def test_upserts_keep_one_row_per_natural_key(crawl_db):
+    migrate(crawl_db)
+    for _ in range(3):
+        insert_brands_data(crawl_db, [{'brand_name': 'Brand A', 'brand_url': '/brand/a'}], 'brands')
+        insert_brand_products(crawl_db, 1, [(1, 'url', 's1', 'P1')], 'products')
+    insert_brand_products(crawl_db, None, [(None, 'sitemap url', None, 'P1')], 'products')
+
+    assert select_query(crawl_db, """SELECT id FROM brands""") == [(1,)]
+    assert select_query(crawl_db, """SELECT brand_id, product_url FROM products""") == [(1, 'sitemap url')]
+
+
+def test_migrate_applies_each_migration_once(crawl_db):
+    assert get_schema_version(crawl_db) == 0
+    assert migrate(crawl_db) == len(MIGRATIONS)
+    applied = []
+
+    def add_logo_url(conn):
+        applied.append(1)
+        conn.execute("""ALTER TABLE brands ADD COLUMN logo_url TEXT""")
+
+    migrations = MIGRATIONS + (add_logo_url,)
+    assert migrate(crawl_db, migrations) == len(MIGRATIONS) + 1
+    assert migrate(crawl_db, migrations) == len(MIGRATIONS) + 1
+    assert len(applied) == 1
+    assert select_query(crawl_db, """SELECT logo_url FROM brands""") == []
+
+
+def test_failed_migration_leaves_the_schema_version_alone(crawl_db):
+    migrate(crawl_db)
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(crawl_db, MIGRATIONS + (["""CREATE TABLE extra (id INTEGER)""", """ALTER TABLE missing ADD x"""],))
+    assert get_schema_version(crawl_db) == len(MIGRATIONS)
+    assert select_query(crawl_db, """SELECT name FROM sqlite_master WHERE name='extra'""") == []
+
+
+@pytest.mark.parametrize("sql_query, params", HOT_LOOKUPS)
+def test_hot_lookups_use_an_index(crawl_db, sql_query, params):
+    migrate(crawl_db)
+    plan = [detail for (_, _, _, detail) in select_query(crawl_db, f"EXPLAIN QUERY PLAN {sql_query}", params)]
+    assert plan and not any(detail.startswith('SCAN') for detail in plan), plan
+
+
+def product_details_row(sku_id, price, size, out_of_stock=False):
+    values = {'product_code': 'P1', 'sku_id': sku_id, 'price': price, 'size': size, 'out_of_stock': out_of_stock}
+    return tuple(values.get(column) for column in PRODUCT_DETAILS_COLUMNS)
+
+
+def test_typed_columns_are_backfilled_and_written_at_ingest(crawl_db):
+    migrate(crawl_db, MIGRATIONS[:2])
+    execute_query(crawl_db, """INSERT INTO product_details (product_code, sku_id, price, size)
+                               VALUES ('P1', 'S1', '$42.00', '1.7 oz/ 50 mL')""")
+    migrate(crawl_db)
+    insert_product_detail_rows(crawl_db, [product_details_row('S2', '$10.50', '.28 oz / 8 g')])
+
+    assert select_query(crawl_db, """
+        SELECT sku_id, price_cents, size_amount, size_unit, unit_price_cents FROM product_details ORDER BY sku_id
+    """) == [('S1', 4200, 50.0, 'ml', 84.0), ('S2', 1050, 8.0, 'g', 131.25)]
+
+
+def test_background_writer_commits_in_groups_and_flushes_on_close(db_file):
+    with BackgroundWriter(db_file, group_size=10, group_interval=60) as writer:
+        assert insert_batch(db_file, """INSERT INTO items (name) VALUES (?)""", [(str(i),) for i in range(25)]) == 25
+        writer.flush()
+        assert select_query(db_file, """SELECT COUNT(*) FROM items""") == [(25,)]
+        insert_batch(db_file, """INSERT INTO items (name) VALUES (?)""", [('last',)])
+    assert select_query(db_file, """SELECT COUNT(*) FROM items""") == [(26,)]
+    assert writer.stats == {'queued': 26, 'written': 26, 'failed': 0, 'commits': 4}
+
+
+def test_background_writer_commits_a_partial_group_after_the_interval(db_file):
+    with BackgroundWriter(db_file, group_size=1000, group_interval=0.05):
+        insert_batch(db_file, """INSERT INTO items (name) VALUES (?)""", [('a',)])
+        time.sleep(0.5)
+        assert select_query(db_file, """SELECT COUNT(*) FROM items""") == [(1,)]
+
+
+def test_background_writer_keeps_the_good_rows_of_a_failed_group(db_file):
+    execute_query(db_file, """CREATE TABLE unique_items (name TEXT PRIMARY KEY)""")
+    with BackgroundWriter(db_file, max_queued=2) as writer:
+        insert_batch(db_file, """INSERT INTO unique_items (name) VALUES (?)""", [('a',), ('b',), ('a',), ('c',)])
+    assert select_query(db_file, """SELECT name FROM unique_items ORDER BY name""") == [('a',), ('b',), ('c',)]
+    assert writer.stats['failed'] == 1
+
+
+def test_background_writer_commits_a_unit_all_or_nothing(db_file):
+    execute_query(db_file, """CREATE TABLE unique_items (name TEXT PRIMARY KEY)""")
+    failed = []
+    with BackgroundWriter(db_file) as writer:
+        for key, names in (('first', ['a', 'b']), ('second', ['c', 'a']), ('third', ['d'])):
+            with writer.unit(key, on_error=lambda error, key=key: failed.append((key, type(error)))):
+                insert_batch(db_file, """INSERT INTO unique_items (name) VALUES (?)""", [(name,) for name in names])
+                insert_batch(db_file, """INSERT INTO items (name) VALUES (?)""", [(key,)])
+    assert select_query(db_file, """SELECT name FROM unique_items ORDER BY name""") == [('a',), ('b',), ('d',)]
+    assert select_query(db_file, """SELECT name FROM items ORDER BY name""") == [('first',), ('third',)]
+    assert failed == [('second', sqlite3.IntegrityError)]
+    assert writer.stats['failed'] == 3
+
+
+def test_background_writer_closes_its_connection_when_it_stops(db_file):
+    select_query(db_file, """SELECT COUNT(*) FROM items""")
+    open_before = len(connections.open_connections)
+    for i in range(5):
+        with BackgroundWriter(db_file):
+            insert_batch(db_file, """INSERT INTO items (name) VALUES (?)""", [(str(i),)])
+    assert len(connections.open_connections) == open_before
+    assert select_query(db_file, """SELECT COUNT(*) FROM items""") == [(5,)]
+
+
+def test_price_history_records_only_changes(crawl_db):
+    migrate(crawl_db)
+    for price, out_of_stock in (('$10.00', False), ('$10.00', False), ('$12.00', False), ('$12.00', False),
+                                ('$12.00', True)):
+        insert_product_detail_rows(crawl_db, [product_details_row('S1', price, '1 oz')])
+        insert_product_detail_rows(crawl_db, [product_details_row('S1', price, '2 oz', out_of_stock)])
+        time.sleep(0.002)
+
+    changes = get_price_changes_since(crawl_db, '2000-01-01 00:00:00')
+    assert [(price_cents, out_of_stock) for _, _, price_cents, _, out_of_stock, _, _ in changes] == [
+        (1000, 0), (1200, 0), (1200, 1)]
+    assert get_price_changes_since(crawl_db, changes[1][-1]) == changes[2:]
+    assert get_price_at(crawl_db, 'S1', changes[1][-1]) == (1200, '$12.00', 0, None)
+    assert get_price_at(crawl_db, 'S1', '2000-01-01 00:00:00') is None
+
+
+def test_price_history_orders_changes_written_in_the_same_millisecond(crawl_db):
+    migrate(crawl_db)
+    for price in ('$10.00', '$12.00', '$10.00'):
+        insert_product_detail_rows(crawl_db, [product_details_row('S1', price, '1 oz')])
+        # a clock that does not move between writes
+        execute_query(crawl_db, """UPDATE price_history SET observed_at='2024-01-01 00:00:00.000'""")
+        execute_query(crawl_db, """DELETE FROM product_details""")
+
+    assert [price_cents for _, _, price_cents, *_ in get_price_changes_since(crawl_db, '2000-01-01')] == [
+        1000, 1200, 1000]
+    assert get_price_at(crawl_db, 'S1', '2024-01-01 00:00:00.000')[0] == 1000
+    triggers = select_query(crawl_db, """SELECT sql FROM sqlite_master WHERE name LIKE 'product_details_price_history_%'""")
+    assert len(triggers) == 2 and all('observed_at DESC, id DESC' in sql for (sql,) in triggers)
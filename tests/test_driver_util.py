@@ -0,0 +1,107 @@
+import pytest
+import sys
+import threading
+sys.path.insert(0,'../src')
+from selenium.common.exceptions import WebDriverException
+import driver_util
+from driver_util import DriverPool, ChromeDriverFactory, chrome_options, LEAN_BLOCKED_URLS
+
+
+class FakeDriver:
+    def __init__(self):
+        self.crashed = False
+        self.quit_called = False
+
+    @property
+    def current_url(self):
+        if self.crashed:
+            raise WebDriverException("chrome not reachable")
+        return "about:blank"
+
+    def quit(self):
+        self.quit_called = True
+
+
+class FakeChrome(FakeDriver):
+    def __init__(self, options=None):
+        super().__init__()
+        self.options = options
+        self.cdp_commands = []
+
+    def execute_cdp_cmd(self, cmd, params):
+        self.cdp_commands.append((cmd, params))
+
+
+def test_driver_pool_reuses_drivers():
+    launched = []
+    pool = DriverPool(lambda: launched.append(FakeDriver()) or launched[-1], size=2, max_pages_per_driver=100)
+    for _ in range(10):
+        with pool.driver() as driver:
+            assert isinstance(driver, FakeDriver)
+    assert len(launched) == 1
+    pool.close()
+    assert launched[0].quit_called
+
+
+def test_driver_pool_recycles_after_max_pages():
+    launched = []
+    pool = DriverPool(lambda: launched.append(FakeDriver()) or launched[-1], size=1, max_pages_per_driver=3)
+    for _ in range(7):
+        with pool.driver():
+            pass
+    assert len(launched) == 3
+    assert launched[0].quit_called and launched[1].quit_called
+
+
+def test_driver_pool_replaces_crashed_driver():
+    launched = []
+    pool = DriverPool(lambda: launched.append(FakeDriver()) or launched[-1], size=1)
+    with pool.driver() as driver:
+        driver.crashed = True
+    with pool.driver() as driver:
+        assert driver is launched[1]
+    assert launched[0].quit_called
+
+
+def test_driver_pool_never_exceeds_size():
+    launched = []
+    pool = DriverPool(lambda: launched.append(FakeDriver()) or launched[-1], size=2)
+    barrier = threading.Barrier(2)
+
+    def borrow():
+        with pool.driver():
+            barrier.wait(timeout=1)
+
+    threads = [threading.Thread(target=borrow) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(launched) == 2
+
+
+def test_lean_chrome_options_disable_images_and_keep_cache(tmp_path):
+    options = chrome_options(lean=True, cache_dir=str(tmp_path))
+    assert "--blink-settings=imagesEnabled=false" in options.arguments
+    assert f"--disk-cache-dir={tmp_path}" in options.arguments
+    assert options.experimental_options['prefs']['profile.managed_default_content_settings.images'] == 2
+    default_options = chrome_options()
+    assert 'prefs' not in default_options.experimental_options
+    assert not any(argument.startswith("--disk-cache-dir") for argument in default_options.arguments)
+
+
+def test_chrome_driver_factory_blocks_resources_and_reuses_cache_slots(tmp_path, monkeypatch):
+    monkeypatch.setattr(driver_util.webdriver, 'Chrome', FakeChrome)
+    factory = ChromeDriverFactory(lean=True, cache_dir=str(tmp_path))
+    pool = DriverPool(factory, size=2, max_pages_per_driver=1)
+    with pool.driver() as first, pool.driver() as second:
+        cache_dirs = {argument for driver in (first, second) for argument in driver.options.arguments
+                      if argument.startswith("--disk-cache-dir")}
+        assert len(cache_dirs) == 2
+        assert ('Network.setBlockedURLs', {'urls': LEAN_BLOCKED_URLS}) in first.cdp_commands
+    # the recycled driver takes over the cache directory of the one it replaces
+    with pool.driver() as third:
+        assert first.quit_called or second.quit_called
+        assert any(argument in cache_dirs for argument in third.options.arguments)
+    pool.close()
+    assert factory.slot_locks == {}
@@ -0,0 +1,131 @@
+import pytest
+import sys
+import sqlite3
+import threading
+import time
+import requests
+sys.path.insert(0,'../src')
+from fetcher import RateLimiter, AdaptiveRateLimiter, ConcurrentProductFetcher
+from webscraper import ProductScraper, create_tables
+from stub_server import FixtureSite, StubServer
+
+
+def test_rate_limiter_caps_request_rate():
+    limiter = RateLimiter(requests_per_second=50, burst=1)
+    start = time.perf_counter()
+    for _ in range(11):
+        limiter.acquire()
+    assert time.perf_counter() - start >= 0.19
+
+
+def test_adaptive_rate_limiter_grows_to_ceiling_on_fast_responses():
+    limiter = AdaptiveRateLimiter(max_rate=10)
+    assert limiter.rate == 5
+    for _ in range(50):
+        limiter.record(0.1)
+    assert limiter.rate == 10
+
+
+def test_adaptive_rate_limiter_backs_off_on_throttling_and_slow_responses():
+    limiter = AdaptiveRateLimiter(max_rate=10, target_latency=1.0, base_backoff=0.05, max_backoff=0.1)
+    limiter.record(0.1, status_code=429)
+    assert limiter.rate == 2.5
+    assert limiter.blocked_until > 0
+    limiter.record(0.1, status_code=503)
+    assert limiter.rate == 1.25
+    assert limiter.consecutive_failures == 2
+    limiter.record(5.0)
+    assert limiter.rate == pytest.approx(1.125)
+    assert limiter.consecutive_failures == 0
+
+    start = time.perf_counter()
+    limiter.acquire()
+    assert time.perf_counter() - start < 0.5
+
+
+def test_fetcher_feeds_status_codes_to_limiter(stub_server):
+    limiter = AdaptiveRateLimiter(max_rate=100, base_backoff=0.01)
+    fetcher = ConcurrentProductFetcher(lambda code: ProductScraper.get_product_data_api(code, stub_server),
+                                       lambda code, data: None, max_in_flight=1, limiter=limiter)
+    fetcher.run(['P1', 'P2'])
+    assert limiter.rate == 60
+
+    # throttle responses reach the limiter unretried
+    site = FixtureSite.generate(brands=1, products_per_brand=2)
+    with StubServer(site, error_rate=1.0, error_status=429) as server:
+        fetcher = ConcurrentProductFetcher(lambda code: ProductScraper.get_product_data_api(code, server.url),
+                                           lambda code, data: None, max_in_flight=1, limiter=limiter)
+        report = fetcher.run(list(site.products))
+        assert server.requests == 1 + 2  # the session pool warm-up, then one request per product
+    assert report['failed'] == 2
+    assert limiter.consecutive_failures == 2
+    assert limiter.rate == 15
+
+
+def test_fetcher_hands_failures_to_error_fn(stub_server):
+    failures = {}
+
+    def handle(code, data):
+        if code == 'P2':
+            raise KeyError('currentSku')
+
+    fetcher = ConcurrentProductFetcher(lambda code: ProductScraper.get_product_data_api(code, stub_server), handle,
+                                       requests_per_second=100,
+                                       error_fn=lambda code, error, payload: failures.update({code: (error, payload)}))
+    report = fetcher.run(['P1', 'P2', 'MISSING'])
+    assert report['succeeded'] == 1 and report['failed'] == 2
+    assert isinstance(failures['P2'][0], KeyError) and failures['P2'][1]['productId'] == 'P2'
+    assert failures['MISSING'][0].response.status_code == 404 and failures['MISSING'][1] == ''
+
+
+def test_fetcher_hands_undecodable_bodies_to_error_fn():
+    site = FixtureSite.generate(brands=1, products_per_brand=1)
+    site.products['GARBLED'] = b'{"productId": "GARB'
+    failures = {}
+    with StubServer(site) as server:
+        fetcher = ConcurrentProductFetcher(lambda code: ProductScraper.get_product_data_api(code, server.url),
+                                           lambda code, data: None, requests_per_second=100,
+                                           error_fn=lambda code, error, payload: failures.update({code: (error, payload)}))
+        assert fetcher.run(['GARBLED'])['failed'] == 1
+    assert isinstance(failures['GARBLED'][0], requests.JSONDecodeError)
+    assert failures['GARBLED'][1] == '{"productId": "GARB'
+
+
+def test_fetcher_bounds_in_flight_requests():
+    lock = threading.Lock()
+    in_flight = {'now': 0, 'max': 0}
+
+    def fetch(product_code):
+        with lock:
+            in_flight['now'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['now'])
+        time.sleep(0.01)
+        with lock:
+            in_flight['now'] -= 1
+        return product_code
+
+    handled = []
+    fetcher = ConcurrentProductFetcher(fetch, lambda code, data: handled.append(data),
+                                       max_in_flight=3, requests_per_second=1000)
+    report = fetcher.run(str(i) for i in range(20))
+    assert in_flight['max'] <= 3
+    assert sorted(handled) == sorted(str(i) for i in range(20))
+    assert report['succeeded'] == 20
+
+
+def test_fetch_product_details_end_to_end(stub_server, tmp_path):
+    db_file = str(tmp_path / 'products.db')
+    create_tables(db_file)
+
+    report = ProductScraper.fetch_product_details(db_file, ['P1', 'P2', 'MISSING', 'P3'], base_url=stub_server,
+                                                  max_in_flight=4, requests_per_second=100)
+
+    assert report['requested'] == 4
+    assert report['succeeded'] == 3
+    assert report['failed'] == 1
+    assert report['products_per_second'] > 0
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute("SELECT product_code, sku_id, category_name FROM product_details ORDER BY sku_id").fetchall()
+    conn.close()
+    assert len(rows) == 6
+    assert rows[0] == ('P1', 'P11', 'Moisturizers --- Skincare')
@@ -0,0 +1,94 @@
+import pytest
+import sys
+import threading
+import time
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+sys.path.insert(0,'../src')
+from http_util import SessionPool, SwatchDownloader
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    hits = {}
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client hung up first, e.g. /stalled after a timeout
+
+    def do_GET(self):
+        FlakyHandler.hits[self.path] = FlakyHandler.hits.get(self.path, 0) + 1
+        if self.path == '/stalled':
+            time.sleep(1)
+        # first request to /flaky fails, the retry succeeds
+        status = 503 if self.path == '/flaky' and FlakyHandler.hits[self.path] == 1 else 200
+        status = 404 if self.path == '/missing.jpg' else status
+        body = b'x' * 100000 if self.path.endswith('.jpg') else b'{}'
+        self.send_response(status)
+        if self.path == '/':
+            self.send_header('Set-Cookie', 'session=abc')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    FlakyHandler.hits = {}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_session_pool_warms_up_once_and_shares_cookies(stub_server):
+    pool = SessionPool(stub_server, size=2, backoff_factor=0)
+    for i in range(5):
+        assert pool.get(f'{stub_server}/item/{i}').status_code == 200
+    assert FlakyHandler.hits['/'] == 1
+    assert all(session.cookies.get('session') == 'abc' for session in pool.all_sessions)
+    assert pool.latency_summary()['count'] == 5
+    pool.close()
+
+
+def test_session_pool_retries_idempotent_failures(stub_server):
+    pool = SessionPool(stub_server, size=1, backoff_factor=0)
+    assert pool.get(f'{stub_server}/flaky').status_code == 200
+    assert FlakyHandler.hits['/flaky'] == 2
+    pool.close()
+
+
+def test_session_pool_times_out_stalled_requests(stub_server):
+    pool = SessionPool(stub_server, size=1, max_retries=0, timeout=0.2)
+    start = time.perf_counter()
+    with pytest.raises(requests.RequestException, match='timed out'):
+        pool.get(f'{stub_server}/stalled')
+    assert time.perf_counter() - start < 0.9
+    assert pool.get(f'{stub_server}/item/1').status_code == 200
+    pool.close()
+
+
+def test_swatch_downloader_skips_existing_and_duplicate_files(stub_server, tmp_path):
+    existing = tmp_path / 'brand' / 'existing.jpg'
+    existing.parent.mkdir()
+    existing.write_bytes(b'old')
+
+    downloader = SwatchDownloader(workers=2)
+    assert downloader.submit(f'{stub_server}/a.jpg', str(tmp_path / 'brand' / 'a.jpg'))
+    assert not downloader.submit(f'{stub_server}/a.jpg', str(tmp_path / 'brand' / 'a.jpg'))
+    assert not downloader.submit(f'{stub_server}/existing.jpg', str(existing))
+    assert downloader.submit(f'{stub_server}/missing.jpg', str(tmp_path / 'brand' / 'missing.jpg'))
+    stats = downloader.close()
+
+    assert stats == {'queued': 2, 'downloaded': 1, 'skipped': 2, 'failed': 1, 'bytes': 100000}
+    assert (tmp_path / 'brand' / 'a.jpg').stat().st_size == 100000
+    assert existing.read_bytes() == b'old'
+    assert sorted(p.name for p in (tmp_path / 'brand').iterdir()) == ['a.jpg', 'existing.jpg']
+    assert FlakyHandler.hits.get('/existing.jpg') is None
@@ -0,0 +1,46 @@
+import pytest
+import sys
+import json
+import os
+sys.path.insert(0,'../src')
+from metrics import CrawlMetrics
+
+
+def test_measure_records_counts_errors_bytes_and_latency():
+    metrics = CrawlMetrics()
+    for i in range(3):
+        with metrics.measure('product_api') as measurement:
+            measurement.bytes = 100
+    with pytest.raises(KeyError):
+        with metrics.measure('product_api'):
+            raise KeyError('currentSku')
+
+    stage = metrics.summary()['stages']['product_api']
+    assert stage['count'] == 4
+    assert stage['errors'] == 1
+    assert stage['error_rate'] == 0.25
+    assert stage['bytes'] == 300
+    assert sum(stage['latency_seconds']['histogram'].values()) == 4
+
+
+def test_prometheus_histogram_is_cumulative():
+    metrics = CrawlMetrics()
+    metrics.observe('insert_batch', 0.003, items=10)
+    metrics.observe('insert_batch', 0.2, items=5)
+    text = metrics.to_prometheus()
+    assert 'crawl_stage_items_total{stage="insert_batch"} 15' in text
+    assert 'crawl_stage_latency_seconds_bucket{stage="insert_batch",le="0.005"} 1' in text
+    assert 'crawl_stage_latency_seconds_bucket{stage="insert_batch",le="0.25"} 2' in text
+    assert 'crawl_stage_latency_seconds_bucket{stage="insert_batch",le="+Inf"} 2' in text
+    assert 'crawl_stage_latency_seconds_count{stage="insert_batch"} 2' in text
+
+
+def test_write_report_creates_json_and_prometheus_files(tmp_path):
+    metrics = CrawlMetrics()
+    metrics.observe('brand_page', 1.5, items=40)
+    json_path = metrics.write_report(str(tmp_path), extra={'succeeded': 1})
+    with open(json_path) as file:
+        report = json.load(file)
+    assert report['stages']['brand_page']['items'] == 40
+    assert report['run'] == {'succeeded': 1}
+    assert os.path.exists(json_path.replace('.json', '.prom'))
@@ -0,0 +1,47 @@
+import pytest
+import sys
+sys.path.insert(0,'../src')
+from product_fields import parse_price_cents, parse_size, parse_sizes, typed_columns
+
+
+@pytest.mark.parametrize("price, cents", [
+    ("$42.00", 4200),
+    ("$9.5", 950),
+    ("$1,150.00", 115000),
+    ("$25", 2500),
+    ("$12.00 - $30.00", 1200),
+    ("", None),
+    (None, None),
+    ("free", None),
+])
+def test_parse_price_cents(price, cents):
+    assert parse_price_cents(price) == cents
+
+
+@pytest.mark.parametrize("size, parsed", [
+    ("1 oz/ 30 mL", (30.0, 'ml')),
+    ("1.7 oz / 50 mL Eau de Parfum Spray", (50.0, 'ml')),
+    (".28 oz / 8 g", (8.0, 'g')),
+    ("4 x 0.25 oz/ 7 mL", (28.0, 'ml')),
+    ("3.4 fl. oz", (3.4, 'oz')),
+    ("1 L", (1000.0, 'ml')),
+    ("500 mg", (0.5, 'g')),
+    ("1 lb", (1.0, 'lb')),
+    ("2 lbs / 907 g", (907.0, 'g')),
+    ("3 Lipsticks", (None, None)),
+    ("", (None, None)),
+    (None, (None, None)),
+])
+def test_parse_size(size, parsed):
+    assert parse_size(size) == parsed
+
+
+def test_parse_sizes_keeps_every_unit_given():
+    assert parse_sizes("1.7 oz / 50 mL") == {'oz': 1.7, 'ml': 50.0}
+    assert parse_sizes("4 x 0.25 oz/ 7 mL") == {'oz': 1.0, 'ml': 28.0}
+    assert parse_sizes("3 Lipsticks") == {}
+
+
+def test_typed_columns_unit_price():
+    assert typed_columns("$30.00", "1 oz/ 30 mL") == (3000, 30.0, 'ml', 100.0)
+    assert typed_columns("$30.00", "Mini") == (3000, None, None, None)
@@ -0,0 +1,56 @@
+import pytest
+import sys
+sys.path.insert(0,'../src')
+from sharded_crawl import ShardedCrawl, shard, store_product
+from webscraper import create_tables, create_browser_limiter, ProductScraper, BROWSER_PAGES_PER_SECOND, CRAWL_DELAY
+from db_util import select_query, execute_query, insert_brand_products
+from conftest import make_product
+from archive import ResponseArchive
+
+
+def test_shard_splits_round_robin():
+    assert shard(list(range(5)), 2) == [[0, 2, 4], [1, 3]]
+    assert shard([1], 4) == [[1]]
+    assert shard([], 4) == []
+
+
+def test_brand_workers_split_the_page_load_budget():
+    limiter = create_browser_limiter(4)
+    assert limiter.max_rate == pytest.approx(BROWSER_PAGES_PER_SECOND / 4)
+    assert limiter.rate == pytest.approx(1 / CRAWL_DELAY / 4)
+
+
+def test_sharded_crawl_single_writer(stub_server, tmp_path):
+    db_file = str(tmp_path / 'products.db')
+    create_tables(db_file)
+    product_codes = [f'P{i}' for i in range(12)] + ['MISSING']
+    insert_brand_products(db_file, 1, [(1, 'url', None, code) for code in product_codes], 'products')
+
+    with ShardedCrawl(db_file, shards=3, base_url=stub_server, requests_per_second=300,
+                      archive_dir=str(tmp_path / 'archive')) as crawl:
+        report = crawl.crawl_product_details()
+
+    assert len(report['workers']) == 3
+    assert report['requested'] == 13
+    assert report['succeeded'] == 12
+    assert report['failed'] == 1
+    assert select_query(db_file, "SELECT COUNT(*) FROM product_details") == [(24,)]
+    assert select_query(db_file, "SELECT COUNT(*) FROM crawl_state WHERE phase='product_details'") == [(12,)]
+    assert len(list(ResponseArchive(str(tmp_path / 'archive')).replay())) == 12
+
+    with ShardedCrawl(db_file, shards=3, base_url=stub_server) as crawl:
+        assert crawl.crawl_product_details()['requested'] == 1
+
+
+def test_writer_dead_letters_a_failed_product_write(tmp_path):
+    db_file = str(tmp_path / 'products.db')
+    create_tables(db_file)
+    execute_query(db_file, """
+        CREATE TRIGGER fail_p1 BEFORE INSERT ON product_details WHEN NEW.product_code = 'P1'
+        BEGIN SELECT RAISE(ABORT, 'bad row'); END
+    """)
+    store_product(db_file, 'P1', list(ProductScraper.iter_product_rows(make_product('P1'))), b'{"productId": "P1"}')
+
+    assert select_query(db_file, "SELECT product_code, stage, error_type, payload FROM dead_letters") == [
+        ('P1', 'product_details', 'IntegrityError', '{"productId": "P1"}')]
+    assert select_query(db_file, "SELECT COUNT(*) FROM crawl_state") == [(0,)]
@@ -0,0 +1,29 @@
+import pytest
+import sys
+sys.path.insert(0,'../src')
+from sitemap import SitemapReader, SITEMAP_ENTRY, URL_ENTRY
+from stub_server import FixtureSite, StubServer, SITEMAP_INDEX_PATH
+from http_util import SessionPool
+
+
+@pytest.fixture
+def fixture_server():
+    with StubServer(FixtureSite.generate(brands=3, products_per_brand=4)) as server:
+        yield server
+
+
+def test_find_sitemaps_reads_robots_txt(fixture_server):
+    reader = SitemapReader(SessionPool(fixture_server.url, size=1))
+    assert reader.find_sitemaps(fixture_server.url) == [f'{fixture_server.url}{SITEMAP_INDEX_PATH}']
+
+
+def test_iter_entries_streams_index_and_gzipped_sitemaps(fixture_server):
+    reader = SitemapReader(SessionPool(fixture_server.url, size=1), chunk_size=64)
+
+    index = list(reader.iter_entries(f'{fixture_server.url}{SITEMAP_INDEX_PATH}'))
+    assert [kind for kind, _ in index] == [SITEMAP_ENTRY]
+
+    entries = list(reader.iter_entries(index[0][1]))
+    assert len(entries) == 12
+    assert all(kind == URL_ENTRY for kind, _ in entries)
+    assert entries[0][1] == f'{fixture_server.url}/ca/en/product/fixture-p00000000-P00000000'
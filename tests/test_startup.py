@@ -0,0 +1,35 @@
+import pytest
+import sys
+import os
+import subprocess
+
+SRC_DIR = os.path.abspath('../src')
+
+# third-party imports each module pays regardless of this repo's code
+MODULE_DEPENDENCIES = {
+    'webscraper': 'import requests, bs4, selenium.webdriver',
+    'clean_product_data': 'import pandas',
+}
+
+STARTUP_BENCHMARK = """
+import time, selenium.webdriver
+def no_browser(*args, **kwargs):
+    raise AssertionError('browser launched at import time')
+selenium.webdriver.Chrome = no_browser
+{dependencies}
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+@pytest.mark.parametrize("module", ['webscraper', 'clean_product_data'])
+def test_import_has_no_side_effects_and_takes_milliseconds(module, tmp_path):
+    code = STARTUP_BENCHMARK.format(dependencies=MODULE_DEPENDENCIES[module], module=module)
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, capture_output=True, text=True,
+                            env={**os.environ, 'PYTHONPATH': SRC_DIR})
+    assert result.returncode == 0, result.stderr
+    import_seconds = float(result.stdout.strip())
+    print(f"import {module}: {import_seconds * 1000:.1f} ms")
+    assert import_seconds < 0.1
+    assert os.listdir(tmp_path) == []
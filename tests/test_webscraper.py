@@ -0,0 +1,330 @@
+import pytest
+import sys
+import requests
+import time
+from datetime import datetime
+sys.path.insert(0,'../src')
+from webscraper import (create_tables, crawl_brand_list, crawl_brand_pages, crawl_product_details, crawl_sitemaps,
+                        refresh_product_details, replay_archive, retry_dead_letters, BrandListScraper, BrandPageScraper, ProductScraper,
+                        PRODUCT_PROJECTION, PRODUCT_API_PATH, PRODUCT_API_PROJECTED_QUERY)
+from archive import ResponseArchive
+from conftest import make_product
+from stub_server import FixtureSite, StubServer
+from driver_util import DriverPool
+from fetcher import RateLimiter
+from metrics import crawl_metrics
+from db_util import select_query, execute_query, insert_brand_products, PRODUCT_DETAILS_COLUMNS, PRODUCT_RECORD_KEYS
+
+BRANDS = [{'brand_name': 'Brand A', 'brand_url': '/brand/a'}, {'brand_name': 'Brand B', 'brand_url': '/brand/b'}]
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    db_file = str(tmp_path / 'products.db')
+    create_tables(db_file)
+    return db_file
+
+
+def test_crawl_brand_list_runs_once(db_file, monkeypatch):
+    calls = []
+    monkeypatch.setattr(BrandListScraper, 'get_brand_urls', lambda self: calls.append(1) or BRANDS)
+    assert crawl_brand_list(db_file, driver_pool=None) == BRANDS
+    assert crawl_brand_list(db_file, driver_pool=None) == BRANDS
+    assert len(calls) == 1
+    assert len(select_query(db_file, "SELECT * FROM brands")) == 2
+
+
+def test_crawl_brand_pages_resumes_after_failure(db_file, monkeypatch):
+    monkeypatch.setattr(BrandListScraper, 'get_brand_urls', lambda self: BRANDS)
+    brands = crawl_brand_list(db_file, driver_pool=None)
+    scraped = []
+
+    def scrape_brands(self, brands):
+        for brand in brands:
+            scraped.append(brand['brand_url'])
+            if brand['brand_url'] == '/brand/b' and scraped.count('/brand/b') == 1:
+                raise RuntimeError("crawl died")
+            yield brand, [f"https://www.sephora.com/ca/en/product/x-P{brand['brand_url'][-1].upper()}1"]
+
+    monkeypatch.setattr(BrandPageScraper, 'scrape_brands', scrape_brands)
+    with pytest.raises(RuntimeError):
+        crawl_brand_pages(db_file, brands, driver_pool=None)
+    crawl_brand_pages(db_file, brands, driver_pool=None)
+
+    assert scraped == ['/brand/a', '/brand/b', '/brand/b']
+    assert select_query(db_file, "SELECT product_code FROM products ORDER BY product_code") == [('PA1',), ('PB1',)]
+
+
+def test_failed_brand_products_write_leaves_brand_unchecked(db_file, monkeypatch):
+    monkeypatch.setattr(BrandListScraper, 'get_brand_urls', lambda self: BRANDS[:1])
+    brands = crawl_brand_list(db_file, driver_pool=None)
+    monkeypatch.setattr(BrandPageScraper, 'scrape_brands',
+                        lambda self, brands: ((brand, ["https://www.sephora.com/ca/en/product/x-PA1"]) for brand in brands))
+    execute_query(db_file, """
+        CREATE TRIGGER fail_products BEFORE INSERT ON products
+        BEGIN SELECT RAISE(ABORT, 'bad row'); END
+    """)
+    crawl_brand_pages(db_file, brands, driver_pool=None)
+
+    assert select_query(db_file, "SELECT product_code FROM products") == []
+    assert select_query(db_file, "SELECT item_key FROM crawl_state WHERE phase='brand_pages'") == []
+
+    execute_query(db_file, "DROP TRIGGER fail_products")
+    crawl_brand_pages(db_file, brands, driver_pool=None)
+    assert select_query(db_file, "SELECT product_code FROM products") == [('PA1',)]
+    assert select_query(db_file, "SELECT item_key FROM crawl_state WHERE phase='brand_pages'") == [('/brand/a',)]
+
+
+class ScriptedBrandPage:
+    """Fake driver answering the tile collection script with one scripted result per scroll step."""
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = []
+        self.current_url = 'about:blank'
+        self.page_source = '<html>' + 'x' * 100 + '</html>'
+
+    def get(self, url):
+        self.current_url = url
+
+    def set_script_timeout(self, seconds):
+        pass
+
+    def execute_async_script(self, script, href_part, scroll_to, click, settle_ms, settle_limit_ms, timeout_ms):
+        self.calls.append((scroll_to, click))
+        return self.results.pop(0)
+
+    def quit(self):
+        pass
+
+
+class CountingLimiter(RateLimiter):
+    def __init__(self):
+        super().__init__(1000)
+        self.requests = 0
+
+    def record(self, latency, status_code=None, error=False):
+        self.requests += 1
+
+
+def test_get_product_urls_collects_new_tiles_once_per_scroll_step():
+    driver = ScriptedBrandPage([
+        {'urls': ['/ca/en/product/a-P1', '/ca/en/product/b-P2'], 'height': 3000, 'has_more': False},
+        {'urls': [], 'height': 3000, 'has_more': True},
+        {'urls': ['/ca/en/product/c-P3'], 'height': 4000, 'has_more': False},
+        {'urls': [], 'height': 4000, 'has_more': False},
+    ])
+    limiter = CountingLimiter()
+    scraper = BrandPageScraper(DriverPool(lambda: driver, size=1), limiter=limiter)
+    crawl_metrics.reset()
+
+    product_urls = scraper.get_product_urls('/brand/a')
+
+    assert sorted(product_urls) == ['/ca/en/product/a-P1', '/ca/en/product/b-P2', '/ca/en/product/c-P3']
+    assert driver.calls == [(1000, False), (2000, False), (3000, True), (4000, False)]
+    # the page load and the one "Show More Products" click go through the limiter
+    assert limiter.requests == 2
+    stage = crawl_metrics.summary()['stages']['brand_page']
+    assert stage['items'] == 3 and stage['bytes'] == len(driver.page_source)
+
+
+def test_scrape_brands_stops_scraping_when_the_consumer_stops(monkeypatch):
+    scraped = []
+    monkeypatch.setattr(BrandPageScraper, 'get_product_urls', lambda self, brand_url: scraped.append(brand_url) or [])
+    brands = [{'brand_name': f'Brand {i}', 'brand_url': f'/brand/{i}'} for i in range(20)]
+
+    results = BrandPageScraper(driver_pool=None, limiter=CountingLimiter()).scrape_brands(brands, workers=2)
+    next(results)
+    results.close()
+    assert len(scraped) <= 2
+
+
+def test_crawl_sitemaps_fills_products_and_resumes(db_file):
+    with StubServer(FixtureSite.generate(brands=2, products_per_brand=3)) as server:
+        assert crawl_sitemaps(db_file, base_url=server.url, batch_size=4) == 6
+        requests_before = server.requests
+        assert crawl_sitemaps(db_file, base_url=server.url) == 0
+        # only robots.txt and the index are read again, the finished url sitemap is skipped
+        assert server.requests - requests_before == 2
+
+    rows = select_query(db_file, "SELECT brand_id, sku, product_code FROM products ORDER BY product_code")
+    assert rows[0] == (None, None, 'P00000000')
+    assert len(rows) == 6
+
+
+def test_crawl_product_details_skips_fetched_products(db_file, stub_server):
+    insert_brand_products(db_file, 1, [(1, 'url', None, code) for code in ['P1', 'P2', 'MISSING']], 'products')
+
+    report = crawl_product_details(db_file, base_url=stub_server, save_swatch=False)
+    assert report['requested'] == 3 and report['succeeded'] == 2
+
+    report = crawl_product_details(db_file, base_url=stub_server, save_swatch=False)
+    assert report['requested'] == 1
+    assert len(select_query(db_file, "SELECT * FROM product_details")) == 4
+
+
+def test_iter_product_rows_matches_record_mapping():
+    product = make_product('P1')
+    product['productDetails']['shortDescription'] = 'short'
+    product['regularChildSkus'][0]['refinements'] = {'finishRefinements': ['Matte', 'Natural']}
+
+    rows = list(ProductScraper.iter_product_rows(product))
+
+    assert [len(row) for row in rows] == [len(PRODUCT_DETAILS_COLUMNS)] * 2
+    for row, sku in zip(rows, [product['currentSku']] + product['regularChildSkus']):
+        record = dict(zip(PRODUCT_RECORD_KEYS, row))
+        assert ProductScraper.map_product_response_to_record(sku).items() <= record.items()
+        assert record['product_code'] == 'P1'
+        assert record['display_name'] == 'Fixture P1'
+        assert record['short_description'] == 'short'
+        assert record['category_name'] == 'Moisturizers --- Skincare'
+    assert rows[1][PRODUCT_DETAILS_COLUMNS.index('finish_refinement')] == 'Matte Natural'
+
+
+def test_projection_keeps_every_product_details_field():
+    product = make_product('P1')
+    product['productDetails']['shortDescription'] = 'short'
+    product['currentSku']['refinements'] = {'sizeRefinements': ['Mini'], 'colorRefinements': ['Red']}
+    product['currentSku']['skuImages'] = {'image250': 'https://example.com/1.jpg', 'image1500': 'big.jpg'}
+    product['reviews'] = [{'text': 'lovely'}] * 50
+    product['regionsMap'] = {'CA': True}
+
+    projected = ProductScraper.project(product, PRODUCT_PROJECTION)
+
+    assert list(ProductScraper.iter_product_rows(projected)) == list(ProductScraper.iter_product_rows(product))
+    assert 'reviews' not in projected and 'regionsMap' not in projected
+    assert projected['currentSku']['skuImages'] == {'image250': 'https://example.com/1.jpg'}
+    assert projected['parentCategory']['parentCategory']['displayName'] == 'Skincare'
+
+
+def test_fetch_product_details_with_projection(db_file, stub_server):
+    report = ProductScraper.fetch_product_details(db_file, ['P1', 'P2'], base_url=stub_server, projection=True)
+    assert report['succeeded'] == 2
+    assert len(select_query(db_file, "SELECT * FROM product_details")) == 4
+
+
+def test_projection_archives_the_response_as_received(db_file, tmp_path):
+    site = FixtureSite.generate(brands=1, products_per_brand=2)
+    archive = ResponseArchive(str(tmp_path / 'archive'))
+    with StubServer(site) as server:
+        report = ProductScraper.fetch_product_details(db_file, list(site.products), base_url=server.url,
+                                                      projection=True, archive=archive)
+    archive.close()
+
+    assert report['succeeded'] == 2
+    archived = ResponseArchive(str(tmp_path / 'archive')).read('P00000000')
+    assert archived['productDetails']['imageAltText'] == 'Fixture P00000000 product image'
+    # the trimmed request leaves the heavy fields out
+    assert 'ratingsAndReviews' not in archived and 'regionsMap' not in archived
+
+
+def test_fetch_product_details_keeps_max_in_flight_requests_in_flight(db_file):
+    site = FixtureSite.generate(brands=1, products_per_brand=16, reviews_per_product=0)
+    with StubServer(site, latency=0.5) as server:
+        start = time.perf_counter()
+        report = ProductScraper.fetch_product_details(db_file, list(site.products), base_url=server.url,
+                                                      max_in_flight=16, requests_per_second=1000)
+        elapsed = time.perf_counter() - start
+
+    assert report['succeeded'] == 16
+    # the pool warm-up and one round trip, a pool of the default 8 sessions would need two round trips
+    assert elapsed < 1.3
+
+
+def test_compress_category_chain_stops_each_key_where_it_is_missing():
+    category = {'categoryId': 'c3', 'displayName': 'Face',
+                'parentCategory': {'categoryId': 'c2', 'targetUrl': '/shop/skincare',
+                                   'parentCategory': {'categoryId': 'c1', 'displayName': 'All'}}}
+    expected = tuple(ProductScraper.compress_categories(category, key) for key in ('categoryId', 'displayName', 'targetUrl'))
+    assert ProductScraper.compress_category_chain(category) == expected == ('c3 --- c2 --- c1', 'Face --- ', '')
+    assert ProductScraper.compress_category_chain(None) == ('', '', '')
+
+
+def test_save_product_details_writes_only_changed_skus(db_file):
+    product = make_product('P1')
+    assert ProductScraper.save_product_details(db_file, product) == 2
+    assert ProductScraper.save_product_details(db_file, product) == 0
+
+    product['regularChildSkus'][0]['listPrice'] = '$12.00'
+    assert ProductScraper.save_product_details(db_file, product) == 1
+    assert select_query(db_file, "SELECT sku_id, price FROM product_details WHERE sku_id='P12' ORDER BY id") == [
+        ('P12', '$12.00')]
+
+
+def test_refresh_product_details_skips_unchanged_products(db_file, stub_server):
+    insert_brand_products(db_file, 1, [(1, 'url', None, code) for code in ['P1', 'P2']], 'products')
+    crawl_product_details(db_file, base_url=stub_server, save_swatch=False)
+
+    report = refresh_product_details(db_file, base_url=stub_server)
+    assert report['succeeded'] == 2
+    assert report['unchanged'] == 2
+    assert len(select_query(db_file, "SELECT * FROM product_details")) == 4
+
+
+def test_replay_archive_rebuilds_product_details_offline(db_file, stub_server, tmp_path):
+    insert_brand_products(db_file, 1, [(1, 'url', None, code) for code in ['P1', 'P2']], 'products')
+    archive = ResponseArchive(str(tmp_path / 'archive'))
+    crawl_product_details(db_file, base_url=stub_server, save_swatch=False, archive=archive)
+    archive.close()
+
+    replay_db = str(tmp_path / 'replay.db')
+    create_tables(replay_db)
+    report = replay_archive(replay_db, str(tmp_path / 'archive'))
+    assert report['replayed'] == 2 and report['written'] == 4
+    assert select_query(replay_db, "SELECT sku_id FROM product_details ORDER BY sku_id") == \
+        select_query(db_file, "SELECT sku_id FROM product_details ORDER BY sku_id")
+    # replayed history is stamped with when each response was fetched, not when it was replayed
+    fetched_at = {product_code: datetime.fromisoformat(fetched_at).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+                  for product_code, fetched_at, _ in ResponseArchive(str(tmp_path / 'archive')).replay_records()}
+    assert sorted(select_query(replay_db, "SELECT DISTINCT product_code, observed_at FROM price_history")) == \
+        sorted(fetched_at.items())
+
+
+def test_failed_products_are_dead_lettered_and_retried_with_backoff(db_file, stub_server, monkeypatch):
+    insert_brand_products(db_file, 1, [(1, 'url', None, code) for code in ['P1', 'P2', 'MISSING']], 'products')
+    save_product_details = ProductScraper.save_product_details
+
+    def fail_on_p2(db_file, product_data, *args):
+        if product_data['productId'] == 'P2':
+            raise KeyError('currentSku')
+        return save_product_details(db_file, product_data, *args)
+
+    monkeypatch.setattr(ProductScraper, 'save_product_details', staticmethod(fail_on_p2))
+    crawl_product_details(db_file, base_url=stub_server, save_swatch=False, projection=True)
+    assert select_query(db_file, "SELECT product_code, stage, error_type, attempts FROM dead_letters ORDER BY 1") == [
+        ('MISSING', 'product_api', 'HTTPError', 1), ('P2', 'product_details', 'KeyError', 1)]
+    # the raw body as served, not the projected copy the handler failed on
+    raw_body = requests.get(f'{stub_server}{PRODUCT_API_PATH}P2?{PRODUCT_API_PROJECTED_QUERY}').text
+    assert select_query(db_file, "SELECT payload FROM dead_letters WHERE product_code='P2'") == [(raw_body,)]
+
+    # nothing is due until the backoff expires
+    assert retry_dead_letters(db_file, base_url=stub_server)['requested'] == 0
+    monkeypatch.setattr(ProductScraper, 'save_product_details', staticmethod(save_product_details))
+    execute_query(db_file, "UPDATE dead_letters SET next_retry_at = datetime('now', '-1 seconds')")
+    report = retry_dead_letters(db_file, base_url=stub_server)
+
+    assert report['requested'] == 2 and report['succeeded'] == 1
+    assert select_query(db_file, """
+        SELECT product_code, attempts, next_retry_at > datetime('now', '+100 seconds') FROM dead_letters
+    """) == [('MISSING', 2, 1)]
+    assert select_query(db_file, "SELECT COUNT(*) FROM product_details WHERE product_code='P2'") == [(2,)]
+
+
+def test_failed_product_write_is_dead_lettered_with_its_checkpoint_and_hashes(db_file, stub_server):
+    insert_brand_products(db_file, 1, [(1, 'url', None, code) for code in ['P1', 'P2']], 'products')
+    execute_query(db_file, """
+        CREATE TRIGGER fail_p11 BEFORE INSERT ON product_details WHEN NEW.sku_id = 'P11'
+        BEGIN SELECT RAISE(ABORT, 'bad row'); END
+    """)
+    report = crawl_product_details(db_file, base_url=stub_server, save_swatch=False)
+
+    assert report['succeeded'] == 1 and report['failed'] == 1
+    assert select_query(db_file, "SELECT sku_id FROM product_details ORDER BY sku_id") == [('P21',), ('P22',)]
+    assert select_query(db_file, "SELECT item_key FROM crawl_state") == [('P2',)]
+    assert select_query(db_file, "SELECT product_code FROM product_hashes") == [('P2',)]
+    assert select_query(db_file, "SELECT product_code, stage, error_type FROM dead_letters") == [
+        ('P1', 'product_details', 'IntegrityError')]
+
+    execute_query(db_file, "DROP TRIGGER fail_p11")
+    assert crawl_product_details(db_file, base_url=stub_server, save_swatch=False)['succeeded'] == 1
+    assert select_query(db_file, "SELECT COUNT(*) FROM product_details WHERE product_code='P1'") == [(2,)]
+    assert select_query(db_file, "SELECT COUNT(*) FROM dead_letters") == [(0,)]